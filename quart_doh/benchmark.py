@@ -0,0 +1,262 @@
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from typing import List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import dns.message
+import dns.rdatatype
+import dns.rrset
+
+from quart_doh import server
+from quart_doh.cache import ResponseCache
+from quart_doh.constants import DOH_CONTENT_TYPE, DOH_DNS_PARAM
+from quart_doh.dns_resolver import DNSResolverClient
+from quart_doh.utils import doh_b64_decode, doh_b64_encode
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+# only in a source checkout, the file is not installed with the package
+URLS = os.path.join(dir_path, "..", "benchmark_get_url.txt")
+STUB_ANSWERS = {dns.rdatatype.A: "127.0.0.1", dns.rdatatype.AAAA: "::1"}
+# modules importable without the web stack, and the web stack
+LIGHT_MODULES = ("quart_doh.codec", "quart_doh.constants", "quart_doh.client")
+HEAVY_MODULES = ("quart", "hypercorn", "requests", "httpx")
+IMPORT_CODE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(" ".join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+def load_queries(path: str) -> List[bytes]:
+    """
+    :param path: file of GET URLs with the dns parameter, one per line.
+    :return: the DNS queries in wire format.
+    """
+    queries = []
+    with open(path, "r", encoding="UTF-8") as urls:
+        for url in urls:
+            params = parse_qs(urlparse(url.strip()).query)
+            if DOH_DNS_PARAM in params:
+                queries.append(doh_b64_decode(params[DOH_DNS_PARAM][0]))
+    return queries
+
+
+class StubDNSServer(asyncio.DatagramProtocol):
+    """Upstream answering A and AAAA questions with a loopback address, so that
+    the benchmark runs offline.
+    """
+
+    def __init__(self, ttl: int = 300):
+        self.ttl = ttl
+        self.transport = None
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        query = dns.message.from_wire(data)
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        if question.rdtype in STUB_ANSWERS:
+            response.answer.append(
+                dns.rrset.from_text(
+                    question.name, self.ttl, "IN", question.rdtype, STUB_ANSWERS[question.rdtype]
+                )
+            )
+        self.transport.sendto(response.to_wire(), addr)
+
+
+def _run_stub_server(ports: multiprocessing.Queue) -> None:  # pragma: no cover
+    loop = asyncio.new_event_loop()
+    transport, _ = loop.run_until_complete(
+        loop.create_datagram_endpoint(StubDNSServer, local_addr=("127.0.0.1", 0))
+    )
+    ports.put(transport.get_extra_info("sockname")[1])
+    loop.run_forever()
+
+
+def start_stub_server() -> Tuple[multiprocessing.Process, int]:
+    """Run the stub upstream in its own process, to keep it out of the CPU measure.
+    :return: the process and the UDP port of the stub upstream.
+    """
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_stub_server, args=(ports,), daemon=True)
+    process.start()
+    return process, ports.get(timeout=10)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    :param values: sorted values.
+    :param q: the percentile, between 0 and 100.
+    :return: the nearest-rank percentile, 0 without values.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+async def run_benchmark(
+    queries: List[bytes], method: str = "both", concurrency: int = 10, requests: int = 1000
+) -> dict:
+    """Replay the queries against the Quart app, with GET, POST or both alternately.
+    :return: qps, latency percentiles in milliseconds, error rate and CPU time per query.
+    """
+    client = server.app.test_client()
+    if method == "both":
+        methods = itertools.cycle(["GET", "POST"])
+    else:
+        methods = itertools.repeat(method.upper())
+    jobs = iter(list(zip(itertools.islice(itertools.cycle(queries), requests), methods)))
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for data, query_method in jobs:
+            start = time.perf_counter()
+            if query_method == "GET":
+                response = await client.get(
+                    "/dns-query",
+                    query_string={DOH_DNS_PARAM: doh_b64_encode(data)},
+                    headers={"accept": DOH_CONTENT_TYPE},
+                )
+            else:
+                response = await client.post(
+                    "/dns-query", data=data, headers={"content-type": DOH_CONTENT_TYPE}
+                )
+            await response.get_data()
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != 200:
+                errors += 1
+
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "method": method,
+        "duration": duration,
+        "qps": len(latencies) / duration,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "error_rate": errors / len(latencies) if latencies else 0.0,
+        "cpu_per_query_ms": cpu / len(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+def measure_import(module: str, runs: int = 5) -> Tuple[float, List[str]]:
+    """Import the module in new interpreters, the import cache of this one
+    would hide the cost.
+    :return: the best import time in seconds, and the heavy modules it loaded.
+    """
+    best = None
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_CODE.format(module=module, heavy=HEAVY_MODULES)],
+            check=True,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        ).stdout.split("\n")
+        duration = float(output[0])
+        best = duration if best is None else min(best, duration)
+    return best, output[1].split()
+
+
+def parse_args(argv: Optional[list] = None):  # pragma: no cover
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--urls",
+        default=URLS if os.path.isfile(URLS) else None,
+        help="File of GET URLs to replay, required outside a source checkout. "
+        "Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--method",
+        choices=["get", "post", "both"],
+        default="both",
+        help="HTTP method of the requests. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=10, help="Concurrent clients. Default [%(default)s]"
+    )
+    parser.add_argument(
+        "--requests", type=int, default=1000, help="Total number of requests. Default [%(default)s]"
+    )
+    parser.add_argument(
+        "--resolver",
+        nargs="+",
+        default=None,
+        help="DNS resolvers to use instead of the local stub upstream.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=0,
+        help="Maximum number of cached responses, 0 to disable. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--imports",
+        action="store_true",
+        help="Measure the import time of the modules instead of the requests.",
+    )
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    return parser.parse_args(argv)
+
+
+def main(args: Optional[argparse.Namespace] = None):
+    if args is None:  # pragma: no cover
+        args = parse_args()
+    if getattr(args, "imports", False):
+        result = {}
+        for module in LIGHT_MODULES + ("quart_doh.server",):
+            duration, heavy = measure_import(module)
+            result[module + "_ms"] = duration * 1000
+            result[module + "_heavy"] = " ".join(heavy)
+        return print_result(result, args.json)
+    if args.urls is None:
+        raise SystemExit("--urls is required outside a source checkout")
+    queries = load_queries(args.urls)
+    stub = None
+    if args.resolver:
+        server.resolver_dns = DNSResolverClient(args.resolver)
+    else:
+        stub, port = start_stub_server()
+        server.resolver_dns = DNSResolverClient("127.0.0.1", port=port)
+    server.response_cache = ResponseCache(args.cache_size) if args.cache_size > 0 else None
+    try:
+        result = asyncio.run(
+            run_benchmark(queries, args.method, args.concurrency, args.requests)
+        )
+    finally:
+        if stub is not None:
+            stub.terminate()
+    return print_result(result, args.json)
+
+
+def print_result(result: dict, as_json: bool = False) -> dict:
+    if as_json:
+        print(json.dumps(result))
+    else:
+        width = max(len(key) for key in result) + 2
+        for key, value in result.items():
+            print("{:<{}}{}".format(key, width, round(value, 3) if isinstance(value, float) else value))
+    return result
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main(parse_args())
@@ -0,0 +1,414 @@
+import mmap
+import os
+import struct
+import tempfile
+import time
+import zlib
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+from dns.message import Message
+
+from quart_doh import ecs, wire
+from quart_doh.constants import SERVFAIL_TTL, SHARED_CACHE_SLOT_SIZE, STALE_TTL
+
+
+def get_ttl(message: Message, servfail_ttl: int = SERVFAIL_TTL) -> Optional[int]:
+    """Time a response may be cached, negative answers included (RFC 2308).
+    :param message: a DNS response.
+    :param servfail_ttl: (optional) TTL of a SERVFAIL response.
+    :return: the minimum TTL of the answer section, the SOA minimum of the
+        authority section for NXDOMAIN/NODATA, None if not cacheable.
+    """
+    rcode = message.rcode()
+    if rcode == dns.rcode.SERVFAIL:
+        return servfail_ttl
+    if rcode not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+        return None
+    if message.answer:
+        return min(r.ttl for r in message.answer)
+    for rrset in message.authority:
+        if rrset.rdtype == dns.rdatatype.SOA:
+            return min(rrset.ttl, rrset[0].minimum)
+    return None
+
+
+def cache_key(message: Message) -> Optional[tuple]:
+    """
+    :param message: a DNS query.
+    :return: (qname, qtype, qclass, EDNS, DO bit, CD bit), None without question.
+        A response to a query with EDNS has an OPT record, not to be served to
+        a client without EDNS (RFC 6891).
+    """
+    if not message.question:
+        return None
+    question = message.question[0]
+    return (
+        question.name.to_wire().lower(),
+        question.rdtype,
+        question.rdclass,
+        message.edns >= 0,
+        bool(message.ednsflags & dns.flags.DO),
+        bool(message.flags & dns.flags.CD),
+    )
+
+
+class ResponseCache:
+    """Bounded LRU cache of DNS responses, honouring their TTL.
+    Popular responses can be refreshed before they expire (prefetch), when
+    they are hit in the last prefetch_ratio of their TTL. Expired responses
+    are kept for stale seconds, to be served when the resolvers do not
+    answer (RFC 8767).
+    Responses to queries with an EDNS Client Subnet option are stored for the
+    networks of their scope, and only served to the clients of these networks
+    (RFC 7871).
+    """
+
+    prefetch_ratio = 0.1
+
+    def __init__(
+        self,
+        max_size: int = 10000,
+        servfail_ttl: int = SERVFAIL_TTL,
+        prefetch_hits: int = 0,
+        stale: int = 0,
+    ):
+        """
+        :param max_size: (optional) maximum number of responses.
+        :param servfail_ttl: (optional) TTL of a SERVFAIL response.
+        :param prefetch_hits: (optional) hits after which a response is prefetched, 0 to disable.
+        :param stale: (optional) seconds an expired response can be served, 0 to disable.
+        """
+        self.max_size = max_size
+        self.servfail_ttl = servfail_ttl
+        self.prefetch_hits = prefetch_hits
+        self.stale = stale
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+        self.stale_hits = 0
+        self._entries = OrderedDict()
+        self._popularity = {}
+        self._refreshing = set()
+        self._scopes = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_wire(
+        self,
+        key: tuple,
+        query_id: int = 0,
+        refresh: Optional[Callable[[], None]] = None,
+        subnet: Optional[bytes] = None,
+    ) -> Optional[bytes]:
+        """
+        :param key: the cache key of the DNS query.
+        :param query_id: (optional) message ID of the DNS query.
+        :param refresh: (optional) called once to start the prefetch of the response.
+        :param subnet: (optional) the EDNS Client Subnet option of the DNS query.
+        :return: the cached response in wire format with TTLs decremented, or None.
+        """
+        result = self.lookup(key, query_id, refresh, subnet)
+        return result[0] if result is not None else None
+
+    def lookup(
+        self,
+        key: tuple,
+        query_id: int = 0,
+        refresh: Optional[Callable[[], None]] = None,
+        subnet: Optional[bytes] = None,
+    ) -> Optional[Tuple[bytes, int]]:
+        """Same as get_wire, with the age of the response.
+        :return: the cached response in wire format with TTLs decremented and
+            its age in seconds, or None.
+        """
+        key, entry = self._find(key, subnet)
+        if entry is None:
+            self.misses += 1
+            return None
+        data, stored_at, ttl = entry
+        age = int(time.monotonic() - stored_at)
+        if age >= ttl:
+            if age >= ttl + self.stale:
+                self._discard(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.prefetch_hits and refresh is not None:
+            self._prefetch(key, ttl - age <= ttl * self.prefetch_ratio, refresh)
+        if age:
+            data = wire.decrement_ttls(data, age)
+        return wire.set_id(data, query_id), age
+
+    def _prefetch(self, key: tuple, expiring: bool, refresh: Callable[[], None]) -> None:
+        hits = self._popularity.get(key, 0) + 1
+        if len(self._popularity) >= self.max_size:
+            self._popularity.clear()
+            self._refreshing.clear()
+        self._popularity[key] = hits
+        if expiring and hits >= self.prefetch_hits and key not in self._refreshing:
+            self._refreshing.add(key)
+            self.prefetches += 1
+            refresh()
+
+    def get_stale(
+        self, key: tuple, query_id: int = 0, subnet: Optional[bytes] = None
+    ) -> Optional[bytes]:
+        """
+        :param key: the cache key of the DNS query.
+        :param query_id: (optional) message ID of the DNS query.
+        :param subnet: (optional) the EDNS Client Subnet option of the DNS query.
+        :return: the cached response, expired for less than stale seconds, with
+            a TTL of STALE_TTL, or None.
+        """
+        _, entry = self._find(key, subnet)
+        if entry is None:
+            return None
+        data, stored_at, ttl = entry
+        if time.monotonic() - stored_at >= ttl + self.stale:
+            return None
+        self.stale_hits += 1
+        return wire.set_id(wire.set_ttls(data, STALE_TTL), query_id)
+
+    def set_wire(
+        self,
+        key: tuple,
+        data: bytes,
+        max_age: Optional[int] = None,
+        subnet: Optional[bytes] = None,
+    ) -> None:
+        """
+        :param key: the cache key of the DNS query.
+        :param data: the DNS response in wire format.
+        :param max_age: (optional) upper bound of the TTL, as the HTTP cache-control max-age.
+        :param subnet: (optional) the EDNS Client Subnet option of the DNS response,
+            its scope prefix length telling the networks the response is valid for.
+        """
+        ttl = wire.get_ttl(data, self.servfail_ttl)
+        if max_age is not None and ttl:
+            ttl = min(ttl, max_age)
+        if key is None or not ttl or wire.is_truncated(data):
+            return
+        if subnet is not None:
+            family, source, scope, address = ecs.parse(subnet)
+            scope = min(scope, source)
+            if scope:
+                scopes = self._scopes.get(key, ())
+                if (family, scope) not in scopes:
+                    if len(self._scopes) >= self.max_size:
+                        self._scopes.clear()
+                    self._scopes[key] = tuple(sorted(scopes + ((family, scope),), reverse=True))
+                key = ecs.scoped_key(key, family, scope, address)
+        self._set_entry(key, data, ttl)
+        if self.prefetch_hits:
+            self._popularity.pop(key, None)
+            self._refreshing.discard(key)
+
+    def _find(
+        self, key: tuple, subnet: Optional[bytes]
+    ) -> Tuple[tuple, Optional[Tuple[bytes, float, int]]]:
+        """
+        :return: the key of the response for the network of the client, the most
+            specific scope first, and the entry of the response or None.
+        """
+        scopes = self._scopes.get(key) if subnet is not None else None
+        if scopes:
+            family, source, _, address = ecs.parse(subnet)
+            for scope_family, scope in scopes:
+                if scope_family == family and scope <= source:
+                    scoped = ecs.scoped_key(key, family, scope, address)
+                    entry = self._get_entry(scoped)
+                    if entry is not None:
+                        return scoped, entry
+        return key, self._get_entry(key)
+
+    def _get_entry(self, key: tuple) -> Optional[Tuple[bytes, float, int]]:
+        """
+        :return: the response, the time it was stored and its TTL, or None.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _set_entry(self, key: tuple, data: bytes, ttl: int) -> None:
+        self._entries[key] = (data, time.monotonic(), ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _discard(self, key: tuple) -> None:
+        del self._entries[key]
+
+    def get(self, message: Message) -> Optional[Message]:
+        """
+        :param message: the DNS query.
+        :return: the cached response with TTLs decremented, or None.
+        """
+        data = self.get_wire(cache_key(message), message.id)
+        if data is None:
+            return None
+        return dns.message.from_wire(data)
+
+    def set(self, message: Message, response: Message) -> None:
+        """
+        :param message: the DNS query, used as the key.
+        :param response: the DNS response to store.
+        """
+        self.set_wire(cache_key(message), response.to_wire())
+
+
+class SharedResponseCache(ResponseCache):
+    """Fixed-size hash table of DNS responses in a memory-mapped file, shared by
+    the worker processes of one host: a response cached by a worker is a hit
+    for all of them.
+
+    Each slot holds a header, the key and the response. Readers never lock: a
+    sequence number, odd while the slot is written, and a CRC32 of the key and
+    response detect a torn read, which is then a miss. Responses larger than a
+    slot are not cached. time.monotonic is the system-wide CLOCK_MONOTONIC on
+    Linux, so expiry times are comparable between the processes. Hits counted
+    for the prefetch and the EDNS Client Subnet scopes seen are per process.
+    """
+
+    # sequence, key hash, stored at, TTL, key length, response length, CRC32
+    SLOT = struct.Struct("!IIdIHHI")
+    SEQUENCE = struct.Struct("!I")
+    KEY = struct.Struct("!HH???")
+    SCOPE = struct.Struct("!HB")
+    probes = 4
+
+    def __init__(
+        self,
+        path: str,
+        max_size: int = 10000,
+        slot_size: int = SHARED_CACHE_SLOT_SIZE,
+        servfail_ttl: int = SERVFAIL_TTL,
+        prefetch_hits: int = 0,
+        stale: int = 0,
+    ):
+        """
+        :param path: the file backing the table, created if needed.
+        :param max_size: (optional) number of slots.
+        :param slot_size: (optional) size in bytes of a slot.
+        :param prefetch_hits: (optional) hits after which a response is prefetched, 0 to disable.
+        :param stale: (optional) seconds an expired response can be served, 0 to disable.
+        """
+        super().__init__(max_size, servfail_ttl, prefetch_hits, stale)
+        self.path = path
+        self.slot_size = slot_size
+        self.owner = False
+        size = max_size * slot_size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def create(cls, max_size: int = 10000, **kwargs) -> "SharedResponseCache":
+        """Create a table in a new file, removed by close().
+        :param max_size: (optional) number of slots.
+        """
+        directory = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        fd, path = tempfile.mkstemp(prefix="doh-cache-", dir=directory)
+        os.close(fd)
+        cache = cls(path, max_size, **kwargs)
+        cache.owner = True
+        return cache
+
+    def __reduce__(self):
+        # workers started with spawn map the same file
+        return self.__class__, (
+            self.path, self.max_size, self.slot_size, self.servfail_ttl, self.prefetch_hits, self.stale
+        )
+
+    def __len__(self) -> int:
+        now = time.monotonic()
+        count = 0
+        for offset in range(0, self.max_size * self.slot_size, self.slot_size):
+            _, _, stored_at, ttl, _, _, _ = self.SLOT.unpack_from(self._map, offset)
+            if ttl and stored_at + ttl > now:
+                count += 1
+        return count
+
+    def _slots(self, key_hash: int):
+        for probe in range(self.probes):
+            yield ((key_hash + probe) % self.max_size) * self.slot_size
+
+    def _encode_key(self, key: tuple) -> bytes:
+        encoded = key[0] + self.KEY.pack(*key[1:6])
+        if len(key) > 6:
+            # scoped by EDNS Client Subnet: family, scope, address
+            encoded += self.SCOPE.pack(*key[6:8]) + key[8]
+        return encoded
+
+    def _get_entry(self, key: tuple) -> Optional[Tuple[bytes, float, int]]:
+        encoded = self._encode_key(key)
+        key_hash = zlib.crc32(encoded)
+        for offset in self._slots(key_hash):
+            sequence, slot_hash, stored_at, ttl, key_length, length, crc = self.SLOT.unpack_from(
+                self._map, offset
+            )
+            if sequence & 1 or slot_hash != key_hash or not ttl:
+                continue
+            start = offset + self.SLOT.size
+            body = self._map[start:start + key_length + length]
+            if self.SEQUENCE.unpack_from(self._map, offset)[0] != sequence or zlib.crc32(body) != crc:
+                continue
+            if body[:key_length] == encoded:
+                return body[key_length:], stored_at, ttl
+        return None
+
+    def _set_entry(self, key: tuple, data: bytes, ttl: int) -> None:
+        encoded = self._encode_key(key)
+        body = encoded + data
+        if self.SLOT.size + len(body) > self.slot_size:
+            return
+        key_hash = zlib.crc32(encoded)
+        now = time.monotonic()
+        target = None
+        oldest = None
+        for offset in self._slots(key_hash):
+            _, slot_hash, stored_at, slot_ttl, key_length, _, _ = self.SLOT.unpack_from(self._map, offset)
+            start = offset + self.SLOT.size
+            if slot_hash == key_hash and self._map[start:start + key_length] == encoded:
+                target = offset
+                break
+            if target is None and (not slot_ttl or stored_at + slot_ttl + self.stale <= now):
+                target = offset
+            if oldest is None or stored_at < oldest[0]:
+                oldest = (stored_at, offset)
+        if target is None:
+            target = oldest[1]
+        writing = (self.SEQUENCE.unpack_from(self._map, target)[0] + 1 | 1) & 0xFFFFFFFF
+        self.SEQUENCE.pack_into(self._map, target, writing)
+        start = target + self.SLOT.size
+        self._map[start:start + len(body)] = body
+        self.SLOT.pack_into(
+            self._map,
+            target,
+            (writing + 1) & 0xFFFFFFFF,
+            key_hash,
+            now,
+            ttl,
+            len(encoded),
+            len(data),
+            zlib.crc32(body),
+        )
+
+    def _discard(self, key: tuple) -> None:
+        # expired slots are reused by _set_entry
+        pass
+
+    def close(self) -> None:
+        self._map.close()
+        if self.owner:
+            os.unlink(self.path)
@@ -1,35 +1,303 @@
 import argparse
+import asyncio
+import logging
+from typing import Iterable, List, Mapping, Optional, Tuple, Union
 
+import dns.flags
 import dns.message
-import requests
+import dns.rcode
 
+from quart_doh import wire
+from quart_doh.cache import ResponseCache
+from quart_doh.codec import doh_b64_encode
 from quart_doh.constants import DOH_CONTENT_TYPE
-from quart_doh.utils import doh_b64_encode
+
+HEADERS = {"accept": DOH_CONTENT_TYPE, "content-type": DOH_CONTENT_TYPE}
+
+
+def make_query(qname: str, rdtype: str, dnssec: bool = False) -> bytes:
+    """
+    :return: the DNS query in wire format, with an ID of 0 to be HTTP cache friendly.
+    """
+    q = dns.message.make_query(qname=qname, rdtype=rdtype, want_dnssec=dnssec)
+    q.id = 0
+    return q.to_wire()
+
+
+def get_max_age(headers: Mapping[str, str]) -> Optional[int]:
+    """
+    :param headers: the headers of the HTTP response.
+    :return: the max-age of the cache-control header minus the Age header, or None.
+    """
+    for directive in headers.get("cache-control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name.lower() == "max-age" and value.isdigit():
+            age = headers.get("age", "0")
+            return max(int(value) - (int(age) if age.isdigit() else 0), 0)
+    return None
 
 
 class ClientDOH:
-    def __init__(self, server, verify: bool = True):
+    """Requests share one session, so the connection to the server is reused.
+    Responses are optionally cached, for their TTL bounded by the max-age of
+    the HTTP response.
+    """
+
+    def __init__(self, server, verify: bool = True, cache_size: int = 0):
+        """
+        :param cache_size: (optional) maximum number of cached responses, 0 to disable.
+        """
         self.server = server
         self.verify = verify
+        self.cache = ResponseCache(cache_size) if cache_size > 0 else None
+        # imported on first use, the stub resolver and the async client do not need it
+        import requests
+
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
 
     def make_request(
         self, qname: str, rdtype: str, get: bool = False, dnssec: bool = False
     ) -> bytes:
-        q = dns.message.make_query(qname=qname, rdtype=rdtype, want_dnssec=dnssec)
-        q.id = 0
-        data = q.to_wire()
-        headers = {"accept": DOH_CONTENT_TYPE, "content-type": DOH_CONTENT_TYPE}
+        data = make_query(qname, rdtype, dnssec)
+        if self.cache is not None:
+            key = wire.query_key(data)
+            cached = self.cache.get_wire(key)
+            if cached is not None:
+                return cached
         if get:
             payload = {"dns": doh_b64_encode(data)}
-            r = requests.get(
-                self.server, params=payload, headers=headers, verify=self.verify
-            )
-            return r.content
+            r = self.session.get(self.server, params=payload, verify=self.verify)
+        else:
+            r = self.session.post(self.server, data=data, verify=self.verify)
+        if self.cache is not None and r.status_code == 200:
+            self.cache.set_wire(key, r.content, get_max_age(r.headers))
+        return r.content
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self) -> "ClientDOH":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class AsyncClientDOH:
+    """Asynchronous client keeping a pool of connections to the server, the
+    queries are multiplexed over HTTP/2 connections. Requires httpx, installed
+    with the async extra. Responses are optionally cached, as by ClientDOH.
+    """
+
+    def __init__(
+        self,
+        server: str,
+        verify: bool = True,
+        http2: bool = True,
+        max_connections: int = 10,
+        cache_size: int = 0,
+        **kwargs
+    ):
+        """
+        :param server: URL of the DoH server.
+        :param verify: (optional) verify the certificate of the server.
+        :param http2: (optional) use HTTP/2 when the server supports it.
+        :param max_connections: (optional) size of the connection pool.
+        :param cache_size: (optional) maximum number of cached responses, 0 to disable.
+        :param kwargs: (optional) other options of httpx.AsyncClient.
+        """
+        try:
+            import httpx
+        except ImportError:  # pragma: no cover
+            raise ImportError("AsyncClientDOH requires httpx: pip install quart-doh[async]")
+        self.server = server
+        self.cache = ResponseCache(cache_size) if cache_size > 0 else None
+        self.client = httpx.AsyncClient(
+            verify=verify,
+            http2=http2,
+            headers=HEADERS,
+            limits=httpx.Limits(max_connections=max_connections),
+            **kwargs
+        )
+
+    async def make_request(
+        self, qname: str, rdtype: str, get: bool = False, dnssec: bool = False
+    ) -> bytes:
+        return await self.query_wire(make_query(qname, rdtype, dnssec), get)
+
+    async def query_wire(self, data: bytes, get: bool = False) -> bytes:
+        """
+        :param data: a DNS query in wire format, sent with an ID of 0.
+        :param get: (optional) use the GET method instead of POST.
+        :return: the DNS response in wire format, with the ID of the query.
+        """
+        query_id = wire.get_id(data)
+        if self.cache is not None:
+            key = wire.query_key(data)
+            cached = self.cache.get_wire(key, query_id)
+            if cached is not None:
+                return wire.copy_question(cached, data)
+        if query_id:
+            data = wire.set_id(data, 0)
+        if get:
+            r = await self.client.get(self.server, params={"dns": doh_b64_encode(data)})
         else:
-            r = requests.post(
-                self.server, data=data, headers=headers, verify=self.verify
-            )
-            return r.content
+            r = await self.client.post(self.server, content=data)
+        r.raise_for_status()
+        if self.cache is not None:
+            self.cache.set_wire(key, r.content, get_max_age(r.headers))
+        if query_id:
+            return wire.set_id(r.content, query_id)
+        return r.content
+
+    async def resolve(
+        self, qname: str, rdtype: str = "A", get: bool = False, dnssec: bool = False
+    ) -> dns.message.Message:
+        return dns.message.from_wire(await self.make_request(qname, rdtype, get, dnssec))
+
+    async def resolve_many(
+        self,
+        names: Iterable[str],
+        rdtype: str = "A",
+        concurrency: int = 100,
+        get: bool = False,
+        dnssec: bool = False,
+    ) -> List[Union[dns.message.Message, Exception]]:
+        """Resolve the names concurrently, at most concurrency queries at a time.
+        :return: the responses in the order of the names, or the exception raised
+            for a name.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def resolve(qname: str) -> dns.message.Message:
+            async with semaphore:
+                return await self.resolve(qname, rdtype, get, dnssec)
+
+        return await asyncio.gather(*(resolve(name) for name in names), return_exceptions=True)
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+    async def __aenter__(self) -> "AsyncClientDOH":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+
+class StubDatagramProtocol(asyncio.DatagramProtocol):
+    """Relay the plain DNS queries received over UDP to the DoH server."""
+
+    def __init__(self, client: AsyncClientDOH):
+        self.client = client
+        self.transport = None
+        self.tasks = set()
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        task = asyncio.ensure_future(self._answer(data, addr))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _answer(self, data: bytes, addr: tuple) -> None:
+        response = await relay(self.client, data)
+        if response is None:
+            return
+        if len(response) > 512:
+            response = truncate(data, response)
+        self.transport.sendto(response, addr)
+
+
+class StubStreamProtocol(asyncio.Protocol):
+    """Relay the length-prefixed DNS queries received over TCP to the DoH server,
+    answered in the order the responses arrive.
+    """
+
+    def __init__(self, client: AsyncClientDOH):
+        self.client = client
+        self.transport = None
+        self.buffer = b""
+        self.tasks = set()
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+
+    def data_received(self, data: bytes) -> None:
+        self.buffer += data
+        while len(self.buffer) >= 2:
+            length = int.from_bytes(self.buffer[:2], "big")
+            if len(self.buffer) < length + 2:
+                return
+            query, self.buffer = self.buffer[2:length + 2], self.buffer[length + 2:]
+            task = asyncio.ensure_future(self._answer(query))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _answer(self, data: bytes) -> None:
+        response = await relay(self.client, data)
+        if response is not None and not self.transport.is_closing():
+            self.transport.write(len(response).to_bytes(2, "big") + response)
+
+
+async def relay(client: AsyncClientDOH, data: bytes) -> Optional[bytes]:
+    """
+    :return: the response of the DoH server, SERVFAIL if it failed, None if the
+        query is malformed.
+    """
+    try:
+        return await client.query_wire(data)
+    except ValueError:
+        return None
+    except Exception as ex:
+        logging.getLogger("doh-client").warning("[DOH] %s", ex)
+        try:
+            response = dns.message.make_response(dns.message.from_wire(data))
+        except Exception:
+            return None
+        response.set_rcode(dns.rcode.SERVFAIL)
+        return response.to_wire()
+
+
+def truncate(query: bytes, response: bytes) -> bytes:
+    """
+    :return: the response with the TC flag set and no records when larger than
+        the UDP payload of the query, else the response.
+    """
+    payload = max(dns.message.from_wire(query).payload, 512)
+    if len(response) <= payload:
+        return response
+    message = dns.message.from_wire(response)
+    truncated = dns.message.make_response(dns.message.from_wire(query))
+    truncated.flags = message.flags | dns.flags.TC
+    truncated.set_rcode(message.rcode())
+    return truncated.to_wire()
+
+
+async def serve_stub(
+    client: AsyncClientDOH, host: str = "127.0.0.1", port: int = 53
+) -> Tuple[asyncio.DatagramTransport, asyncio.AbstractServer]:
+    """Listen for plain DNS queries over UDP and TCP, relayed to the DoH server.
+    :return: the UDP transport and the TCP server, to be closed by the caller.
+    """
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: StubDatagramProtocol(client), local_addr=(host, port)
+    )
+    port = transport.get_extra_info("sockname")[1]
+    server = await loop.create_server(lambda: StubStreamProtocol(client), host, port)
+    return transport, server
+
+
+async def run_stub(args) -> None:  # pragma: no cover
+    async with AsyncClientDOH(args.server, args.noverify, cache_size=args.cache_size) as client:
+        transport, server = await serve_stub(client, args.listen_host, args.listen_port)
+        try:
+            await server.serve_forever()
+        finally:
+            transport.close()
 
 
 def parse_args():  # pragma: no cover
@@ -58,10 +326,37 @@ def parse_args():  # pragma: no cover
         action="store_false",
         help="Disable verify certificates in SSL handshake.",
     )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1000,
+        help="Maximum number of cached responses, 0 to disable. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--stub",
+        action="store_true",
+        help="Listen for plain DNS queries and relay them to the server.",
+    )
+    parser.add_argument(
+        "--listen-host",
+        default="127.0.0.1",
+        help="Address of the stub listener. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--listen-port",
+        type=int,
+        default=53,
+        help="UDP and TCP port of the stub listener. Default [%(default)s]",
+    )
     return parser.parse_args()
 
 
-def main(args):
+def main(args=None):
+    if args is None:  # pragma: no cover
+        args = parse_args()
+    if getattr(args, "stub", False):  # pragma: no cover
+        asyncio.run(run_stub(args))
+        exit(0)
     client_doh = ClientDOH(args.server, args.noverify)
     response_body = client_doh.make_request(
         qname=args.qname, rdtype=args.qtype, get=args.get, dnssec=args.dnssec
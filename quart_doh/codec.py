@@ -0,0 +1,33 @@
+"""Encoding helpers shared by the server and the client, importing neither
+Quart nor dnspython so that the client starts fast.
+"""
+import base64
+import json
+
+try:
+    import orjson
+
+    def json_dumps(obj: dict) -> bytes:
+        return orjson.dumps(obj)
+
+except ImportError:
+
+    def json_dumps(obj: dict) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def doh_b64_decode(s: str) -> bytes:
+    """Base 64 urlsafe decode, add padding as needed.
+    :param s: input base64 encoded string with potentially missing padding.
+    :return: decodes bytes
+    """
+    padding = "=" * (-len(s) % 4)
+    return base64.urlsafe_b64decode(s + padding)
+
+
+def doh_b64_encode(s: bytes) -> str:
+    """Base 64 urlsafe encode and remove padding.
+    :param s: input bytes-like object to be encoded.
+    :return: urlsafe base 64 encoded string.
+    """
+    return base64.urlsafe_b64encode(s).decode("utf-8").rstrip("=")
@@ -1,5 +1,21 @@
 DOH_CONTENT_TYPE = "application/dns-message"
 DOH_JSON_CONTENT_TYPE = "application/dns-json"
+DOH_BULK_JSON_CONTENT_TYPE = "application/x-ndjson"
+DOH_BULK_CONTENT_TYPE = "application/dns-message-stream"
 DOH_DNS_PARAM = "dns"
 DOH_DNS_JSON_PARAM = {"name": "name", "type": "type"}
 AUTHORITY = "quart_doh"
+SERVFAIL_TTL = 5
+RESOLVER_TIMEOUT = 0.4
+RESOLVER_ATTEMPTS = 4
+RESOLVER_SOCKETS = 4
+SHARED_CACHE_SLOT_SIZE = 1024
+STALE_TTL = 30
+STALE_ANSWER_TIMEOUT = 1.8
+POLICY_TTL = 60
+BULK_MAX_QUERIES = 10000
+BULK_CONCURRENCY = 100
+WORKER_MIN_UPTIME = 5
+WORKER_RESTART_DELAY = 0.5
+WORKER_MAX_FAILURES = 5
+WORKER_READY_TIMEOUT = 30
@@ -1,27 +1,506 @@
+import abc
+import asyncio
+import collections
+import functools
 import logging
+import random
+import ssl
+import struct
+import time
+from typing import Iterable, List, Optional, Tuple, Union
 
 from dns import resolver, query, exception
 from dns.message import Message
+import dns.flags
+import dns.message
+
+from quart_doh import metrics, wire
+from quart_doh.constants import RESOLVER_ATTEMPTS, RESOLVER_SOCKETS, RESOLVER_TIMEOUT
+
+
+TRANSPORTS = {"udp": 53, "tcp": 53, "tls": 853}
+
+
+class PendingQueries(abc.ABC):
+    """In-flight queries of one upstream connection.
+    Replies are demultiplexed by DNS message ID and question.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+        self.queries = 0
+        self.opened = None
+        self.retired = False
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport
+        self.opened = time.monotonic()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.transport = None
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Upstream connection closed"))
+
+    def reply_received(self, data: bytes) -> None:
+        try:
+            query_id, question, _ = wire.parse_question(data)
+        except ValueError:
+            return
+        future = self.pending.get((query_id, question))
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def _new_id(self, key: tuple) -> int:
+        while True:
+            query_id = random.getrandbits(16)
+            if (query_id, key) not in self.pending:
+                return query_id
+
+    @abc.abstractmethod
+    def send(self, data: bytes) -> None:
+        """Write a DNS query in wire format to the transport."""
+
+    def retire(self) -> None:
+        """No new query is sent, the connection is closed once the replies of
+        the pending ones are received."""
+        self.retired = True
+        if not self.pending and self.transport is not None:
+            self.transport.close()
+
+    async def query(self, data: bytes, question: tuple, timeout: float) -> bytes:
+        """
+        :param data: the DNS query in wire format.
+        :param question: (qname, qtype, qclass) of the query.
+        :param timeout: time to wait for the reply.
+        :return: the DNS response in wire format, with the ID of the query.
+        """
+        loop = asyncio.get_running_loop()
+        query_id = self._new_id(question)
+        future = loop.create_future()
+        self.pending[(query_id, question)] = future
+        self.queries += 1
+        try:
+            self.send(wire.set_id(data, query_id))
+            response = await asyncio.wait_for(future, timeout)
+        finally:
+            del self.pending[(query_id, question)]
+            if self.retired and not self.pending and self.transport is not None:
+                self.transport.close()
+        return data[:2] + response[2:]
+
+
+class DNSDatagramProtocol(PendingQueries, asyncio.DatagramProtocol):
+    """Long-lived UDP socket serving any number of in-flight queries."""
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        self.reply_received(data)
+
+    def send(self, data: bytes) -> None:
+        self.transport.sendto(data)
+
+
+class DNSStreamProtocol(PendingQueries, asyncio.Protocol):
+    """Persistent TCP or TLS connection with pipelined queries and
+    out-of-order replies (RFC 7766).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._buffer = bytearray()
+
+    def data_received(self, data: bytes) -> None:
+        self._buffer += data
+        while len(self._buffer) >= 2:
+            length = struct.unpack_from("!H", self._buffer)[0]
+            if len(self._buffer) < length + 2:
+                break
+            reply = bytes(self._buffer[2:length + 2])
+            del self._buffer[:length + 2]
+            self.reply_received(reply)
+
+    def send(self, data: bytes) -> None:
+        self.transport.write(struct.pack("!H", len(data)) + data)
+
+
+class Upstream:
+    """An upstream DNS server with its connections and health statistics.
+    The smoothed RTT and the failure rate are exponentially weighted moving averages.
+    UDP sockets are replaced after socket_queries queries or socket_lifetime
+    seconds, so that the source port of the queries changes (RFC 5452).
+    """
+
+    alpha = 0.125
+    max_failure_rate = 0.5
+    min_timeout = 0.05
+    rtt_samples = 100
+    socket_queries = 1000
+    socket_lifetime = 60.0
+
+    def __init__(
+        self,
+        address: str,
+        port: Optional[int] = None,
+        sockets: int = RESOLVER_SOCKETS,
+        transport: str = "udp",
+    ):
+        if transport not in TRANSPORTS:
+            raise ValueError("Invalid transport : %s" % transport)
+        self.address = address
+        self.port = port or TRANSPORTS[transport]
+        self.sockets = sockets
+        self.transport = transport
+        self.srtt = None
+        self.failure_rate = 0.0
+        self._rtts = collections.deque(maxlen=self.rtt_samples)
+        self._adaptive_timeout = None
+        self._datagrams = []
+        self._streams = []
+        self._connecting = {False: None, True: None}
+        self._next = 0
+
+    def __repr__(self) -> str:
+        return self.address
+
+    @property
+    def healthy(self) -> bool:
+        return self.failure_rate < self.max_failure_rate
+
+    def _record_rtt(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt = rtt
+        else:
+            self.srtt += self.alpha * (rtt - self.srtt)
+
+    def record_success(self, rtt: float) -> None:
+        self._record_rtt(rtt)
+        self.failure_rate -= self.alpha * self.failure_rate
+        self._rtts.append(rtt)
+        self._adaptive_timeout = None
+
+    def attempt_timeout(self, timeout: float, attempt: int = 0) -> float:
+        """Twice the 99th percentile of the recent RTTs, bounded by min_timeout
+        and the configured timeout, which is used until enough RTTs are known.
+        The timeout doubles on each retry of the same query.
+        :param timeout: the configured timeout.
+        :param attempt: (optional) number of the attempt, starting at 0.
+        :return: the timeout of the next attempt.
+        """
+        if len(self._rtts) < 10:
+            return timeout
+        if self._adaptive_timeout is None:
+            rtts = sorted(self._rtts)
+            self._adaptive_timeout = 2 * rtts[int(0.99 * (len(rtts) - 1))]
+        return min(max(self._adaptive_timeout, self.min_timeout) * 2 ** attempt, timeout)
+
+    def record_failure(self, timeout: float) -> None:
+        """A timeout counts as an RTT sample of the timeout itself, so that
+        the adaptive timeout widens after failures.
+        """
+        self._record_rtt(timeout)
+        self.failure_rate += self.alpha * (1.0 - self.failure_rate)
+        self._rtts.append(timeout)
+        self._adaptive_timeout = None
+
+    async def _connect(self, stream: bool) -> PendingQueries:
+        loop = asyncio.get_running_loop()
+        if not stream:
+            _, protocol = await loop.create_datagram_endpoint(
+                DNSDatagramProtocol, remote_addr=(self.address, self.port)
+            )
+        elif self.transport == "tls":
+            _, protocol = await loop.create_connection(
+                DNSStreamProtocol,
+                self.address,
+                self.port,
+                ssl=ssl.create_default_context(),
+                server_hostname=self.address,
+            )
+        else:
+            _, protocol = await loop.create_connection(
+                DNSStreamProtocol, self.address, self.port
+            )
+        return protocol
+
+    async def _add_connection(self, pool: list, stream: bool) -> PendingQueries:
+        try:
+            protocol = await self._connect(stream)
+            pool.append(protocol)
+            return protocol
+        finally:
+            self._connecting[stream] = None
+
+    async def get_protocol(self, stream: bool = False) -> PendingQueries:
+        """Connections are opened one at a time, up to the number of sockets,
+        and then used in turn.
+        """
+        pool = self._streams if stream else self._datagrams
+        pool[:] = [p for p in pool if p.transport is not None]
+        if not stream:
+            self._rotate(pool)
+        if len(pool) < self.sockets:
+            if self._connecting[stream] is None:
+                self._connecting[stream] = asyncio.ensure_future(
+                    self._add_connection(pool, stream)
+                )
+            if not pool:
+                return await asyncio.shield(self._connecting[stream])
+        self._next = (self._next + 1) % len(pool)
+        return pool[self._next]
+
+    def _rotate(self, pool: List[PendingQueries]) -> None:
+        now = time.monotonic()
+        for protocol in list(pool):
+            if protocol.queries >= self.socket_queries or now - protocol.opened >= self.socket_lifetime:
+                pool.remove(protocol)
+                protocol.retire()
+
+    async def query(self, data: bytes, question: tuple, timeout: float) -> bytes:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            if self.transport == "udp":
+                protocol = await self.get_protocol()
+                response = await protocol.query(data, question, timeout)
+                if wire.is_truncated(response):
+                    response = await self._query_stream(data, question, timeout)
+            else:
+                response = await self._query_stream(data, question, timeout)
+        except (asyncio.TimeoutError, OSError):
+            self.record_failure(timeout)
+            metrics.RESOLVE_TIME.observe(loop.time() - start, self.address, "failure")
+            raise
+        rtt = loop.time() - start
+        self.record_success(rtt)
+        metrics.RESOLVE_TIME.observe(rtt, self.address, "success")
+        return response
+
+    async def _query_stream(self, data: bytes, question: tuple, timeout: float) -> bytes:
+        protocol = await asyncio.wait_for(self.get_protocol(stream=True), timeout)
+        return await protocol.query(data, question, timeout)
+
+    def close(self) -> None:
+        for protocol in self._datagrams + self._streams:
+            if protocol.transport is not None:
+                protocol.transport.close()
+        self._datagrams = []
+        self._streams = []
 
 
 class DNSResolverClient:
-    def __init__(self, name_server: str = "internal"):
-        self.name_server = name_server
+    def __init__(
+        self,
+        name_server: Union[str, List[str]] = "internal",
+        port: Optional[int] = None,
+        sockets: int = RESOLVER_SOCKETS,
+        race: bool = False,
+        transport: str = "udp",
+        timeout: float = RESOLVER_TIMEOUT,
+        maximum: int = RESOLVER_ATTEMPTS,
+        adaptive: bool = False,
+        deadline: Optional[float] = None,
+    ):
+        """
+        :param timeout: (optional) timeout of each attempt, the upper bound if adaptive.
+        :param maximum: (optional) maximum number of attempts.
+        :param adaptive: (optional) derive the timeout of each attempt from the observed RTTs.
+        :param deadline: (optional) maximum total time spent on a query.
+        """
+        if isinstance(name_server, str):
+            name_server = [name_server]
+        name_servers = []
+        for address in name_server:
+            if address == "internal":
+                name_servers.extend(resolver.get_default_resolver().nameservers)
+            else:
+                name_servers.append(address)
+        self.upstreams = [
+            Upstream(address, port, sockets, transport) for address in name_servers
+        ]
+        self.race = race
+        self.timeout = timeout
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.deadline = deadline
+        self._inflight = {}
+        self.coalesced = 0
+
+    @property
+    def name_server(self) -> str:
+        return ", ".join(upstream.address for upstream in self.upstreams)
+
+    @property
+    def inflight(self) -> int:
+        """Number of distinct questions waiting for the upstreams."""
+        return len(self._inflight)
+
+    def select(self, exclude: Iterable[Upstream] = ()) -> List[Upstream]:
+        """Order the upstreams, fastest healthy first. Untried upstreams come
+        first so that each one gets measured, and already tried ones last.
+        :param exclude: (optional) upstreams already tried for this query.
+        :return: the upstreams by order of preference.
+        """
+        return sorted(
+            self.upstreams,
+            key=lambda u: (u in exclude, not u.healthy, u.srtt or 0.0, u.failure_rate),
+        )
+
+    def _attempt_timeout(
+        self, upstream: Upstream, remaining: Optional[float], attempt: int = 0
+    ) -> float:
+        if self.adaptive:
+            timeout = upstream.attempt_timeout(self.timeout, attempt)
+        else:
+            timeout = self.timeout
+        if remaining is not None:
+            timeout = min(timeout, remaining)
+        return timeout
 
     def resolve(self, message: Message) -> Message:
         logger = logging.getLogger("doh-server")
-        maximum = 4
-        timeout = 0.4
         response_message = 0
-        if self.name_server == "internal":
-            self.name_server = resolver.get_default_resolver().nameservers[0]
         done = False
         tests = 0
-        logger.debug("Resolver used: " + str(self.name_server))
-        while not done and tests < maximum:
+        tried = []
+        end = time.monotonic() + self.deadline if self.deadline else None
+        logger.debug("Resolver used: %s", self.name_server)
+        while not done and tests < self.maximum:
+            remaining = end - time.monotonic() if end is not None else None
+            if remaining is not None and remaining <= 0:
+                break
+            upstream = self.select(tried)[0]
+            tried.append(upstream)
+            timeout = self._attempt_timeout(upstream, remaining, tests)
+            start = time.monotonic()
             try:
-                response_message = query.udp(message, self.name_server, timeout=timeout)
+                if upstream.transport == "tls":
+                    response_message = query.tls(
+                        message, upstream.address, timeout=timeout, port=upstream.port
+                    )
+                elif upstream.transport == "udp":
+                    response_message = query.udp(
+                        message, upstream.address, timeout=timeout, port=upstream.port
+                    )
+                if upstream.transport == "tcp" or response_message.flags & dns.flags.TC:
+                    response_message = query.tcp(
+                        message, upstream.address, timeout=timeout, port=upstream.port
+                    )
+                upstream.record_success(time.monotonic() - start)
                 done = True
-            except exception.Timeout:
+            except (exception.Timeout, OSError):
+                upstream.record_failure(timeout)
                 tests += 1
         return response_message
+
+    async def resolve_async(self, message: Message) -> Optional[Message]:
+        """Resolve on the event loop, without blocking a thread.
+        :param message: the DNS query.
+        :return: the DNS response, or None if every attempt timed out.
+        """
+        response = await self.resolve_wire(message.to_wire())
+        if response is None:
+            return None
+        return dns.message.from_wire(response)
+
+    async def resolve_wire(self, data: bytes, info: Optional[dict] = None) -> Optional[bytes]:
+        """Identical questions in flight, from the same client subnet if any,
+        share a single upstream query. A query without EDNS never shares the
+        query of one with EDNS, whose response has an OPT record (RFC 6891).
+        :param data: the DNS query in wire format.
+        :param info: (optional) receives the address of the upstream that answered
+            as "upstream".
+        :return: the DNS response in wire format, with the ID and question of the
+            query, or None if every attempt timed out.
+        """
+        key = self._inflight_key(data)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._resolve_wire(data, key[:3]))
+            self._inflight[key] = task
+            task.add_done_callback(functools.partial(self._forget, key))
+        else:
+            self.coalesced += 1
+        result = await asyncio.shield(task)
+        if result is None:
+            return None
+        response, upstream = result
+        if info is not None:
+            info["upstream"] = upstream
+        # shared with queries of the same question in another case
+        return wire.copy_question(response, data)
+
+    @staticmethod
+    def _inflight_key(data: bytes) -> tuple:
+        return wire.query_key(data) + (wire.get_ecs(data),)
+
+    def is_inflight(self, data: bytes) -> bool:
+        """
+        :param data: the DNS query in wire format.
+        :return: True if an identical question is waiting for the upstreams, so
+            that the query would share its upstream query.
+        """
+        return self._inflight_key(data) in self._inflight
+
+    def _forget(self, key: Optional[tuple], task: asyncio.Future) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+    async def _resolve_wire(self, data: bytes, question: tuple) -> Optional[Tuple[bytes, str]]:
+        """
+        :return: the DNS response in wire format and the address of the upstream
+            that answered, None if every attempt timed out.
+        """
+        logger = logging.getLogger("doh-server")
+        loop = asyncio.get_running_loop()
+        end = loop.time() + self.deadline if self.deadline else None
+        tried = []
+        for attempt in range(self.maximum):
+            remaining = end - loop.time() if end is not None else None
+            if remaining is not None and remaining <= 0:
+                break
+            upstreams = self.select(tried)
+            if self.race and attempt == 0 and len(upstreams) > 1:
+                upstreams = upstreams[:2]
+            else:
+                upstreams = upstreams[:1]
+            tried.extend(upstreams)
+            logger.debug("Resolver used: %s", upstreams)
+            result = await self._query_first(data, question, upstreams, remaining, attempt)
+            if result is not None:
+                return result
+        return None
+
+    async def _query_first(
+        self,
+        data: bytes,
+        question: tuple,
+        upstreams: List[Upstream],
+        remaining: Optional[float],
+        attempt: int = 0,
+    ) -> Optional[Tuple[bytes, str]]:
+        """
+        :return: the first reply of the upstreams queried in parallel and the address
+            of its upstream, None if all failed.
+        """
+        pending = {
+            asyncio.ensure_future(
+                u.query(data, question, self._attempt_timeout(u, remaining, attempt))
+            ): u
+            for u in upstreams
+        }
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    upstream = pending.pop(task)
+                    if not task.exception():
+                        return task.result(), upstream.address
+        finally:
+            for task in pending:
+                task.cancel()
+        return None
+
+    def close(self) -> None:
+        for upstream in self.upstreams:
+            upstream.close()
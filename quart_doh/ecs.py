@@ -0,0 +1,66 @@
+"""EDNS Client Subnet (RFC 7871): the network of the client sent to the
+resolvers, and the cache keys of the responses valid for part of the networks.
+"""
+import functools
+import ipaddress
+from typing import Optional, Tuple
+
+from quart_doh import wire
+
+FAMILY_IPV4 = 1
+FAMILY_IPV6 = 2
+
+
+def truncate(address: bytes, prefix: int) -> bytes:
+    """
+    :param address: a packed IP address, complete or not.
+    :param prefix: prefix length.
+    :return: the first prefix bits of the address, as few bytes as needed.
+    """
+    length = (prefix + 7) // 8
+    address = address[:length].ljust(length, b"\x00")
+    if prefix % 8:
+        mask = (0xFF << (8 - prefix % 8)) & 0xFF
+        address = address[:-1] + bytes((address[-1] & mask,))
+    return address
+
+
+@functools.lru_cache(maxsize=4096)
+def client_subnet(address: Optional[str], ipv4_prefix: int = 24, ipv6_prefix: int = 56) -> Optional[bytes]:
+    """
+    :param address: the IP address of the client.
+    :return: the data of the EDNS Client Subnet option of its network, None
+        if not a public IP address.
+    """
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return None
+    if not ip.is_global:
+        return None
+    if ip.version == 4:
+        family, prefix = FAMILY_IPV4, ipv4_prefix
+    else:
+        family, prefix = FAMILY_IPV6, ipv6_prefix
+    return wire.ECS.pack(family, prefix, 0) + truncate(ip.packed, prefix)
+
+
+def parse(subnet: bytes) -> Tuple[int, int, int, bytes]:
+    """
+    :param subnet: the data of an EDNS Client Subnet option.
+    :return: the family, source prefix length, scope prefix length and address.
+    """
+    if len(subnet) < wire.ECS.size:
+        raise ValueError("Truncated EDNS Client Subnet option")
+    return wire.ECS.unpack_from(subnet) + (subnet[wire.ECS.size:],)
+
+
+def scoped_key(key: tuple, family: int, scope: int, address: bytes) -> tuple:
+    """
+    :param key: the cache key of a DNS query.
+    :return: the cache key of its response for the networks of this scope, the
+        key itself for a scope of 0, valid for every client.
+    """
+    if not scope:
+        return key
+    return key + (family, scope, truncate(address, scope))
@@ -0,0 +1,179 @@
+import abc
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable, List, Optional
+
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5
+)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _labels(names: Iterable[str], values: Iterable) -> str:
+    pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: "Metric") -> None:
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        """
+        :return: the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric(abc.ABC):
+    """Metrics are only updated from the event loop thread, so plain integer
+    and float updates are enough, without locks.
+    """
+
+    type = "untyped"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        registry: Optional[Registry] = REGISTRY,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        if registry is not None:
+            registry.register(self)
+
+    @abc.abstractmethod
+    def samples(self) -> List[str]:
+        """
+        :return: the exposition lines of the metric, without HELP and TYPE.
+        """
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labelvalues, amount: float = 1) -> None:
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [
+            "{}{} {}".format(self.name, _labels(self.labelnames, labels), _number(value))
+            for labels, value in self.values.items()
+        ]
+
+
+class Histogram(Metric):
+    """Observations are counted in pre-computed buckets, rendered cumulative."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = LATENCY_BUCKETS,
+        registry: Optional[Registry] = REGISTRY,
+    ):
+        super().__init__(name, help, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labelvalues) -> None:
+        series = self.values.get(labelvalues)
+        if series is None:
+            series = self.values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def time(self, start: float, *labelvalues) -> None:
+        """
+        :param start: a time.perf_counter() value, observe the time elapsed since.
+        """
+        self.observe(time.perf_counter() - start, *labelvalues)
+
+    def samples(self) -> List[str]:
+        lines = []
+        bounds = self.buckets + (float("inf"),)
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        self.name,
+                        _labels(self.labelnames + ("le",), labels + (_number(bound),)),
+                        cumulative,
+                    )
+                )
+            lines.append("{}_sum{} {}".format(self.name, _labels(self.labelnames, labels), repr(total)))
+            lines.append("{}_count{} {}".format(self.name, _labels(self.labelnames, labels), cumulative))
+        return lines
+
+
+class Sampled(Metric):
+    """Value read from a function when rendered, no cost on the hot path."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        function: Callable[[], Optional[float]],
+        type: str = "gauge",
+        registry: Optional[Registry] = REGISTRY,
+    ):
+        super().__init__(name, help, (), registry)
+        self.function = function
+        self.type = type
+
+    def samples(self) -> List[str]:
+        value = self.function()
+        if value is None:
+            return []
+        return ["{} {}".format(self.name, _number(value))]
+
+
+REQUESTS = Counter(
+    "doh_requests_total", "DNS-over-HTTPS requests.", ["method", "format"]
+)
+QUERIES = Counter("doh_queries_total", "DNS queries by type.", ["qtype"])
+RESPONSES = Counter("doh_responses_total", "DNS responses by rcode.", ["rcode"])
+SHED = Counter(
+    "doh_shed_total", "Queries shed by the rate limit or the upstream queries cap.", ["reason"]
+)
+POLICY_ANSWERS = Counter(
+    "doh_policy_answers_total", "Queries answered by the local zones, hosts files and blocklists."
+)
+PARSE_TIME = Histogram(
+    "doh_request_parse_seconds", "Time spent extracting the DNS query from the request."
+)
+RESOLVE_TIME = Histogram(
+    "doh_upstream_seconds", "Round-trip time of the upstream queries.", ["upstream", "result"]
+)
+RENDER_TIME = Histogram(
+    "doh_response_render_seconds", "Time spent rendering the HTTP response.", ["format"]
+)
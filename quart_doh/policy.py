@@ -0,0 +1,337 @@
+"""Answer queries locally, before resolution: local zones, hosts files and
+blocklists. Blocklists are indexed by hashes of the names, in an open
+addressing table that is saved as is and loaded with mmap.
+"""
+import argparse
+import hashlib
+import ipaddress
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+
+from quart_doh.constants import POLICY_TTL
+from quart_doh.wire import encode_name
+
+BLOCK_ACTIONS = ("nxdomain", "null", "refused")
+NULL_ADDRESSES = {dns.rdatatype.A: ["0.0.0.0"], dns.rdatatype.AAAA: ["::"]}
+
+
+def suffixes(name: bytes) -> Iterator[bytes]:
+    """
+    :param name: a name in wire format, without compression.
+    :return: an iterator of the name and its parents, the root excluded.
+    """
+    offset = 0
+    while name[offset]:
+        yield name[offset:]
+        offset += name[offset] + 1
+
+
+class SuffixIndex:
+    """Set of names, matching the names and all their subdomains.
+
+    The 64-bit BLAKE2 hashes of the names in wire format are stored in an open
+    addressing table, twice as large as the number of names, 0 marking an empty
+    slot. A lookup hashes the name and each of its parents, and probes the
+    table for each: O(label count). The file format is a header followed by
+    the table, in little-endian order.
+    """
+
+    MAGIC = b"DOHIDX1\x00"
+    HEADER = struct.Struct("<8sQQ")
+
+    def __init__(self, table, count: int):
+        """
+        :param table: a sequence of 64-bit integers, its length a power of 2.
+        :param count: number of names.
+        """
+        self.table = table
+        self.count = count
+        self._mask = len(table) - 1
+        self._map = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    @staticmethod
+    def hash(name: bytes) -> int:
+        return int.from_bytes(hashlib.blake2b(name, digest_size=8).digest(), "little") or 1
+
+    @classmethod
+    def build(cls, names: Iterable[bytes]) -> "SuffixIndex":
+        """
+        :param names: names in wire format.
+        """
+        hashes = set(cls.hash(name) for name in names)
+        capacity = 1
+        while capacity < 2 * len(hashes):
+            capacity <<= 1
+        table = array("Q", bytes(8 * capacity))
+        mask = capacity - 1
+        for value in hashes:
+            slot = value & mask
+            while table[slot]:
+                slot = (slot + 1) & mask
+            table[slot] = value
+        return cls(table, len(hashes))
+
+    def __contains__(self, name: bytes) -> bool:
+        value = self.hash(name)
+        table = self.table
+        slot = value & self._mask
+        while True:
+            stored = table[slot]
+            if stored == value:
+                return True
+            if not stored:
+                return False
+            slot = (slot + 1) & self._mask
+
+    def match(self, name: bytes) -> bool:
+        """
+        :param name: a lowercase name in wire format.
+        :return: True if the name or one of its parents is in the index.
+        """
+        return any(suffix in self for suffix in suffixes(name))
+
+    def save(self, path: str) -> None:
+        table = array("Q", self.table)
+        if sys.byteorder == "big":  # pragma: no cover
+            table.byteswap()
+        with open(path, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.count, len(table)))
+            table.tofile(f)
+
+    @classmethod
+    def is_index(cls, path: str) -> bool:
+        with open(path, "rb") as f:
+            return f.read(len(cls.MAGIC)) == cls.MAGIC
+
+    @classmethod
+    def load(cls, path: str) -> "SuffixIndex":
+        """Map a file written by save, without reading or copying the table."""
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, capacity = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or len(data) != cls.HEADER.size + 8 * capacity:
+            data.close()
+            raise ValueError("Invalid index file " + path)
+        if sys.byteorder == "big":  # pragma: no cover
+            table = array("Q", data[cls.HEADER.size:])
+            table.byteswap()
+        else:
+            table = memoryview(data)[cls.HEADER.size:].cast("Q")
+        index = cls(table, count)
+        index._map = data
+        return index
+
+
+def read_blocklist(path: str) -> Iterator[bytes]:
+    """
+    :param path: a file of domain names, one per line, or in the hosts format.
+    :return: an iterator of the names in wire format.
+    """
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            # hosts format: 0.0.0.0 example.com
+            name = encode_name(fields[1] if len(fields) > 1 else fields[0])
+            if name is not None:
+                yield name
+
+
+def load_blocklist(path: str) -> SuffixIndex:
+    if SuffixIndex.is_index(path):
+        return SuffixIndex.load(path)
+    return SuffixIndex.build(read_blocklist(path))
+
+
+def read_hosts(path: str) -> Dict[bytes, Dict[int, List[str]]]:
+    """
+    :param path: a file in the hosts format, an address followed by names.
+    :return: the addresses of each name in wire format, by record type.
+    """
+    hosts = {}
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            fields = line.split("#", 1)[0].split()
+            if len(fields) < 2:
+                continue
+            try:
+                address = ipaddress.ip_address(fields[0])
+            except ValueError:
+                continue
+            rdtype = dns.rdatatype.A if address.version == 4 else dns.rdatatype.AAAA
+            for text in fields[1:]:
+                name = encode_name(text)
+                if name is not None:
+                    hosts.setdefault(name, {}).setdefault(rdtype, []).append(str(address))
+    return hosts
+
+
+def read_zone(path: str) -> "dns.zone.Zone":
+    """
+    :param path: a zone file, with a $ORIGIN directive.
+    """
+    # imported on first use, with the zone file parser and all the record types
+    import dns.zone
+
+    return dns.zone.from_file(path, relativize=False, check_origin=False)
+
+
+class Policy:
+    """Local answers, from the first source that matches: local zones, hosts
+    files, then blocklists. Blocked names are answered NXDOMAIN, REFUSED,
+    0.0.0.0 and :: (null) or a given address.
+    """
+
+    def __init__(
+        self,
+        zones: Iterable[str] = (),
+        hosts: Iterable[str] = (),
+        blocklists: Iterable[str] = (),
+        block_action: str = "nxdomain",
+        ttl: int = POLICY_TTL,
+    ):
+        """
+        :param zones: (optional) paths of zone files.
+        :param hosts: (optional) paths of hosts files.
+        :param blocklists: (optional) paths of blocklists, text or compiled indexes.
+        :param block_action: (optional) nxdomain, refused, null or an IP address.
+        :param ttl: (optional) TTL of the answers from the hosts files and blocklists.
+        """
+        self.paths = (tuple(zones), tuple(hosts), tuple(blocklists))
+        self.block_action = block_action
+        self.ttl = ttl
+        if block_action not in BLOCK_ACTIONS:
+            address = ipaddress.ip_address(block_action)
+            rdtype = dns.rdatatype.A if address.version == 4 else dns.rdatatype.AAAA
+            self._block_addresses = {rdtype: [str(address)]}
+        elif block_action == "null":
+            self._block_addresses = NULL_ADDRESSES
+        else:
+            self._block_addresses = None
+        self.mtimes = self.get_mtimes()
+        self.zones = {}
+        for path in self.paths[0]:
+            zone = read_zone(path)
+            self.zones[zone.origin.canonicalize().to_wire()] = zone
+        self.hosts = {}
+        for path in self.paths[1]:
+            for name, addresses in read_hosts(path).items():
+                for rdtype, values in addresses.items():
+                    self.hosts.setdefault(name, {}).setdefault(rdtype, []).extend(values)
+        self.blocklists = [load_blocklist(path) for path in self.paths[2]]
+
+    def __bool__(self) -> bool:
+        return bool(self.zones or self.hosts or self.blocklists)
+
+    def get_mtimes(self) -> tuple:
+        mtimes = []
+        for paths in self.paths:
+            for path in paths:
+                try:
+                    mtimes.append(os.stat(path).st_mtime_ns)
+                except OSError:
+                    mtimes.append(None)
+        return tuple(mtimes)
+
+    def reload(self) -> "Policy":
+        """Blocking, to be run in a thread.
+        :return: a new policy, with the files as they are now.
+        """
+        zones, hosts, blocklists = self.paths
+        return Policy(zones, hosts, blocklists, self.block_action, self.ttl)
+
+    def answer(self, data: bytes, key: tuple) -> Optional[bytes]:
+        """
+        :param data: the DNS query in wire format.
+        :param key: its cache key, from wire.query_key.
+        :return: the local DNS response in wire format, None if the query is to be resolved.
+        """
+        name, rdtype, rdclass = key[:3]
+        if rdclass != dns.rdataclass.IN:
+            return None
+        if self.zones:
+            for suffix in suffixes(name):
+                zone = self.zones.get(suffix)
+                if zone is not None:
+                    return self._zone_answer(data, zone, name, rdtype)
+        addresses = self.hosts.get(name)
+        if addresses is not None:
+            return self._addresses_answer(data, addresses, rdtype)
+        for blocklist in self.blocklists:
+            if blocklist.match(name):
+                logging.getLogger("doh-server").debug("[POLICY] blocked %s", key)
+                if self._block_addresses is not None:
+                    return self._addresses_answer(data, self._block_addresses, rdtype)
+                rcode = dns.rcode.REFUSED if self.block_action == "refused" else dns.rcode.NXDOMAIN
+                return self._response(data, rcode).to_wire()
+        return None
+
+    @staticmethod
+    def _response(data: bytes, rcode: int = dns.rcode.NOERROR) -> dns.message.Message:
+        response = dns.message.make_response(dns.message.from_wire(data))
+        response.set_rcode(rcode)
+        if rcode != dns.rcode.REFUSED:
+            response.flags |= dns.flags.AA
+        return response
+
+    def _addresses_answer(self, data: bytes, addresses: dict, rdtype: int) -> bytes:
+        response = self._response(data)
+        if rdtype in addresses:
+            response.answer.append(
+                dns.rrset.from_text_list(
+                    response.question[0].name, self.ttl, "IN", rdtype, addresses[rdtype]
+                )
+            )
+        return response.to_wire()
+
+    def _zone_answer(self, data: bytes, zone: "dns.zone.Zone", name: bytes, rdtype: int) -> bytes:
+        response = self._response(data)
+        qname = response.question[0].name
+        node = zone.get_node(qname)
+        rdataset = None
+        if node is not None:
+            rdataset = node.get_rdataset(dns.rdataclass.IN, rdtype)
+            if rdataset is None:
+                rdataset = node.get_rdataset(dns.rdataclass.IN, dns.rdatatype.CNAME)
+        if rdataset is not None:
+            response.answer.append(dns.rrset.from_rdata_list(qname, rdataset.ttl, rdataset))
+        else:
+            if node is None:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+            soa = zone.get_rdataset(zone.origin, dns.rdatatype.SOA)
+            if soa is not None:
+                response.authority.append(dns.rrset.from_rdata_list(zone.origin, soa.ttl, soa))
+        return response.to_wire()
+
+
+def main(args: Optional[argparse.Namespace] = None):
+    """Compile a blocklist into an index file, loaded without parsing."""
+    if args is None:  # pragma: no cover
+        parser = argparse.ArgumentParser(description=main.__doc__)
+        parser.add_argument("blocklist", nargs="+", help="Blocklists, domains or hosts format.")
+        parser.add_argument("--output", "-o", required=True, help="Path of the index file.")
+        args = parser.parse_args()
+    names = (name for path in args.blocklist for name in read_blocklist(path))
+    index = SuffixIndex.build(names)
+    index.save(args.output)
+    print("{} names written to {}".format(len(index), args.output))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
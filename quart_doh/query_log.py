@@ -0,0 +1,126 @@
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import IO, Optional
+
+import dns.exception
+import dns.name
+import dns.rcode
+import dns.rdatatype
+
+from quart_doh import wire
+from quart_doh.codec import json_dumps
+
+
+class QueryLog:
+    """Structured log of the queries, one JSON object per line.
+
+    The request handler only puts a tuple in a bounded queue, entries are
+    dropped when it is full. A background thread parses the messages, formats
+    the lines and writes them in batches.
+    """
+
+    def __init__(
+        self,
+        stream: IO[bytes],
+        sample_rate: float = 1.0,
+        batch_size: int = 256,
+        max_queue: int = 100000,
+    ):
+        """
+        :param stream: a binary stream, opened in append mode if shared by several workers.
+        :param sample_rate: (optional) fraction of the queries logged, between 0 and 1.
+        :param batch_size: (optional) maximum number of lines per write.
+        :param max_queue: (optional) maximum number of entries waiting to be written.
+        """
+        self.stream = stream
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = queue.Queue(max_queue)
+        self._thread = threading.Thread(target=self._run, name="query-log", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def open(cls, path: str, **kwargs) -> "QueryLog":
+        """
+        :param path: the file to append to, - for the standard output.
+        """
+        if path == "-":
+            return cls(sys.stdout.buffer, **kwargs)
+        return cls(open(path, "ab"), **kwargs)
+
+    def sampled(self) -> bool:
+        """
+        :return: True if the next query is to be logged.
+        """
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def log(
+        self,
+        client: Optional[str],
+        query: bytes,
+        response: Optional[bytes],
+        latency: float,
+        cache: Optional[str] = None,
+        upstream: Optional[str] = None,
+    ) -> None:
+        """
+        :param client: address of the client.
+        :param query: the DNS query in wire format.
+        :param response: the DNS response in wire format.
+        :param latency: seconds spent answering the query.
+        :param cache: (optional) hit, miss or stale.
+        :param upstream: (optional) address of the upstream that answered.
+        """
+        try:
+            self._queue.put_nowait((time.time(), client, query, response, latency, cache, upstream))
+        except queue.Full:
+            self.dropped += 1
+
+    @staticmethod
+    def format(entry: tuple) -> dict:
+        timestamp, client, query, response, latency, cache, upstream = entry
+        record = {
+            "timestamp": datetime.fromtimestamp(timestamp, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "client": client,
+        }
+        try:
+            _, (name, qtype, _), _ = wire.parse_question(query)
+            record["qname"] = dns.name.from_wire(name, 0)[0].to_text()
+            record["qtype"] = dns.rdatatype.to_text(qtype)
+        except (ValueError, dns.exception.DNSException):
+            record["qname"] = None
+            record["qtype"] = None
+        record["rcode"] = dns.rcode.to_text(wire.get_rcode(response)) if response else None
+        record["upstream"] = upstream
+        record["latency_ms"] = round(latency * 1000, 3)
+        record["cache"] = cache
+        return record
+
+    def _run(self) -> None:
+        while True:
+            entries = [self._queue.get()]
+            while len(entries) < self.batch_size:
+                try:
+                    entries.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in entries
+            if stop:
+                entries = entries[:entries.index(None)]
+            if entries:
+                self.stream.write(b"".join(json_dumps(self.format(e)) + b"\n" for e in entries))
+                self.stream.flush()
+            if stop:
+                return
+
+    def close(self) -> None:
+        """Write the entries in the queue and stop the background thread."""
+        self._queue.put(None)
+        self._thread.join()
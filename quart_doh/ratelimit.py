@@ -0,0 +1,93 @@
+import functools
+import ipaddress
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class Overloaded(Exception):
+    """The query is shed: its client is over its rate or too many queries are
+    waiting for the resolvers."""
+
+
+@functools.lru_cache(maxsize=4096)
+def client_network(address: Optional[str], ipv4_prefix: int = 32, ipv6_prefix: int = 56) -> Optional[str]:
+    """
+    :param address: the IP address of a client.
+    :return: the network of the client, the address itself if not an IP address.
+    """
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return address
+    prefix = ipv4_prefix if ip.version == 4 else ipv6_prefix
+    if prefix >= ip.max_prefixlen:
+        return address
+    return str(ipaddress.ip_network((ip, prefix), strict=False))
+
+
+class RateLimiter:
+    """Token bucket of each client network: a query takes a token, and the
+    tokens come back at rate per second, up to burst.
+
+    The buckets are kept in least recently used order, at most max_clients of
+    them. A bucket unused for burst / rate seconds is full again, the same as
+    no bucket, so it is removed as the oldest ones are checked on each query.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: Optional[float] = None,
+        max_clients: int = 100000,
+        ipv4_prefix: int = 32,
+        ipv6_prefix: int = 56,
+    ):
+        """
+        :param rate: queries per second allowed to each client network.
+        :param burst: (optional) size of the buckets, default: twice the rate.
+        :param max_clients: (optional) maximum number of buckets.
+        :param ipv4_prefix: (optional) prefix length of the IPv4 client networks.
+        :param ipv6_prefix: (optional) prefix length of the IPv6 client networks.
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else 2 * rate
+        self.max_clients = max_clients
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self._idle = self.burst / rate
+        self._buckets = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def allow(self, address: Optional[str], cost: float = 1) -> bool:
+        """
+        :param address: the IP address of the client.
+        :param cost: (optional) number of tokens taken, the number of queries.
+        :return: True if the client has enough tokens left, which are then taken,
+            never for a cost over burst.
+        """
+        now = time.monotonic()
+        buckets = self._buckets
+        for _ in range(2):
+            if not buckets:
+                break
+            oldest = next(iter(buckets.values()))
+            if now - oldest[1] < self._idle:
+                break
+            buckets.popitem(last=False)
+        key = client_network(address, self.ipv4_prefix, self.ipv6_prefix)
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.max_clients:
+                buckets.popitem(last=False)
+            bucket = buckets[key] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            buckets.move_to_end(key)
+        if bucket[0] < cost:
+            return False
+        bucket[0] -= cost
+        return True
@@ -2,69 +2,704 @@ import argparse
 import asyncio
 import functools
 import logging
+import multiprocessing
+import multiprocessing.connection
+import signal
 import ssl
+import time
+import warnings
+from typing import AsyncIterator, List, Optional, Tuple
 
 import dns
-from dns.message import Message
-from hypercorn.asyncio import serve
+import dns.exception
+import dns.message
+import dns.rcode
+import dns.rdatatype
 from hypercorn.config import Config
 from quart import Quart
 from quart import request, Response
 
-from quart_doh.constants import DOH_JSON_CONTENT_TYPE
+from quart_doh import metrics, wire
+from quart_doh.cache import ResponseCache, SharedResponseCache
+from quart_doh.constants import (
+    BULK_CONCURRENCY,
+    BULK_MAX_QUERIES,
+    DOH_BULK_JSON_CONTENT_TYPE,
+    DOH_JSON_CONTENT_TYPE,
+    RESOLVER_ATTEMPTS,
+    RESOLVER_SOCKETS,
+    RESOLVER_TIMEOUT,
+    STALE_ANSWER_TIMEOUT,
+    WORKER_MAX_FAILURES,
+    WORKER_MIN_UPTIME,
+    WORKER_READY_TIMEOUT,
+    WORKER_RESTART_DELAY,
+)
 from quart_doh.dns_resolver import DNSResolverClient
+from quart_doh.ecs import client_subnet
+from quart_doh.query_log import QueryLog
+from quart_doh.ratelimit import Overloaded, RateLimiter
 from quart_doh.utils import (
+    LENGTH,
     configure_logger,
     create_http_wire_response,
+    get_bulk_queries,
+    get_dns_wire,
+    json_dumps,
+    message_to_json,
     get_name_and_type_from_dns_question,
     create_http_json_response,
 )
 
 resolver_dns = None
+response_cache = None
+background_tasks = set()
+stale_answer_timeout = STALE_ANSWER_TIMEOUT
+pseudo_headers = True
+query_log = None
+policy = None
+policy_reload = 0
+bulk_max_queries = BULK_MAX_QUERIES
+bulk_concurrency = BULK_CONCURRENCY
+rate_limiter = None
+max_upstream_queries = 0
+upstream_queries = 0
+refuse_overloaded = False
+ecs_prefix = None
+worker_ready = None
+listeners = []
 app = Quart(__name__)
 
+metrics.Sampled(
+    "doh_cache_hits_total",
+    "Responses served from the cache.",
+    lambda: response_cache.hits if response_cache is not None else None,
+    type="counter",
+)
+metrics.Sampled(
+    "doh_cache_misses_total",
+    "Queries not found in the cache.",
+    lambda: response_cache.misses if response_cache is not None else None,
+    type="counter",
+)
+metrics.Sampled(
+    "doh_cache_entries",
+    "Responses in the cache.",
+    lambda: len(response_cache) if response_cache is not None else None,
+)
+metrics.Sampled(
+    "doh_cache_prefetches_total",
+    "Popular responses refreshed before they expire.",
+    lambda: response_cache.prefetches if response_cache is not None else None,
+    type="counter",
+)
+metrics.Sampled(
+    "doh_cache_stale_total",
+    "Expired responses served because the resolvers did not answer in time.",
+    lambda: response_cache.stale_hits if response_cache is not None else None,
+    type="counter",
+)
+metrics.Sampled(
+    "doh_query_log_dropped_total",
+    "Queries not written to the query log because its queue was full.",
+    lambda: query_log.dropped if query_log is not None else None,
+    type="counter",
+)
+metrics.Sampled(
+    "doh_rate_limit_clients",
+    "Client networks with a token bucket.",
+    lambda: len(rate_limiter) if rate_limiter is not None else None,
+)
+metrics.Sampled(
+    "doh_upstream_queries",
+    "Queries waiting for the resolvers.",
+    lambda: upstream_queries,
+)
+metrics.Sampled(
+    "doh_upstream_inflight",
+    "Distinct questions waiting for an upstream reply, capped by --max-upstream-queries.",
+    lambda: resolver_dns.inflight if resolver_dns is not None else None,
+)
+metrics.Sampled(
+    "doh_upstream_coalesced_total",
+    "Queries that shared the upstream query of an identical question.",
+    lambda: resolver_dns.coalesced if resolver_dns is not None else None,
+    type="counter",
+)
+
+
+@functools.lru_cache(maxsize=256)
+def rdtype_name(rdtype: int) -> str:
+    """
+    :return: the name of a type known to dnspython, "other" for the others, so
+        that the clients cannot add a time series per type number.
+    """
+    name = dns.rdatatype.to_text(rdtype)
+    if name.startswith("TYPE"):
+        return "other"
+    return name
+
+
+@functools.lru_cache(maxsize=32)
+def rcode_name(rcode: int) -> str:
+    return dns.rcode.to_text(rcode)
+
+
+async def resolve_upstream(
+    data: bytes, subnet: Optional[bytes], info: Optional[dict] = None
+) -> Tuple[Optional[bytes], Optional[bytes]]:
+    """
+    :param data: the DNS query in wire format, as sent by the client.
+    :param subnet: the EDNS Client Subnet option to add to the query, if any.
+    :return: the DNS response in wire format without the option added, and
+        without OPT record if the client did not use EDNS, None if the resolver
+        did not answer, and the option of the response.
+    """
+    if subnet is None:
+        return await resolver_dns.resolve_wire(data, info), None
+    query_response = await resolver_dns.resolve_wire(wire.add_ecs(data, subnet), info)
+    if query_response is None:
+        return None, None
+    query_response, response_subnet = wire.pop_ecs(query_response)
+    if not wire.has_edns(data):
+        query_response = wire.remove_opt(query_response)
+    return query_response, response_subnet
+
+
+async def refresh(data: bytes, key: tuple, subnet: Optional[bytes] = None) -> Optional[bytes]:
+    """Refresh a cached response, kept as is if the resolver does not answer
+    or answers SERVFAIL.
+    :param data: the DNS query in wire format.
+    :param key: the cache key of the DNS query.
+    :param subnet: (optional) the EDNS Client Subnet option to add to the query.
+    :return: the DNS response in wire format, None if the resolver did not answer.
+    """
+    query_response, response_subnet = await resolve_upstream(data, subnet)
+    if query_response is not None and wire.get_rcode(query_response) != wire.SERVFAIL:
+        response_cache.set_wire(key, query_response, subnet=response_subnet)
+    return query_response
+
+
+def start_refresh(data: bytes, key: tuple, subnet: Optional[bytes] = None) -> asyncio.Task:
+    task = asyncio.ensure_future(refresh(data, key, subnet))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def resolve_stale(data: bytes, key: tuple, stale: bytes, subnet: Optional[bytes] = None) -> bytes:
+    """Wait for the resolver at most stale_answer_timeout, then answer the stale
+    response while the refresh goes on in the background (RFC 8767).
+    :param stale: the expired response in wire format.
+    """
+    task = start_refresh(data, key, subnet)
+    done, _ = await asyncio.wait({task}, timeout=stale_answer_timeout)
+    if done:
+        query_response = task.result()
+        if query_response is not None and wire.get_rcode(query_response) != wire.SERVFAIL:
+            return query_response
+    logging.getLogger("doh-server").info("[CACHE] stale %s", key)
+    return stale
+
+
+def error_response(data: bytes, rcode: int) -> bytes:
+    """
+    :param data: the DNS query in wire format.
+    :return: a DNS response in wire format, with this rcode and no answer.
+    """
+    message = dns.message.make_response(dns.message.from_wire(data))
+    message.set_rcode(rcode)
+    return message.to_wire()
+
+
+async def resolve(
+    data: bytes, info: Optional[dict] = None, client: Optional[str] = None
+) -> Tuple[bytes, int]:
+    """
+    :param data: the DNS query in wire format.
+    :param info: (optional) receives the cache status, hit, miss or stale, as
+        "cache" and the address of the upstream that answered, or policy, as "upstream".
+    :param client: (optional) IP address of the client, sent to the resolvers
+        as an EDNS Client Subnet option if ecs_prefix is set.
+    :return: the DNS response in wire format, a stale response or SERVFAIL if
+        the resolver did not answer, and its age in seconds if from the cache.
+    :raise Overloaded: max_upstream_queries distinct questions are already waiting
+        for the resolvers, none identical to this one.
+    """
+    global upstream_queries
+    logger = logging.getLogger("doh-server")
+    key = wire.query_key(data)
+    metrics.QUERIES.inc(rdtype_name(key[1]))
+    if policy is not None:
+        local_response = policy.answer(data, key)
+        if local_response is not None:
+            if info is not None:
+                info["upstream"] = "policy"
+            metrics.POLICY_ANSWERS.inc()
+            metrics.RESPONSES.inc(rcode_name(wire.get_rcode(local_response)))
+            return local_response, 0
+    cache = response_cache
+    subnet = None
+    if ecs_prefix is not None or cache is not None:
+        if wire.get_ecs(data) is not None:
+            # the client sent its own subnet, the response is not shared
+            cache = None
+        elif ecs_prefix is not None:
+            subnet = client_subnet(client, *ecs_prefix)
+    if cache is not None:
+        query_id = wire.get_id(data)
+        cached = cache.lookup(
+            key, query_id, functools.partial(start_refresh, data, key, subnet), subnet
+        )
+        if info is not None:
+            info["cache"] = "miss" if cached is None else "hit"
+        if cached is not None:
+            logger.debug("[CACHE] hit %s", key)
+            metrics.RESPONSES.inc(rcode_name(wire.get_rcode(cached[0])))
+            return wire.copy_question(cached[0], data), cached[1]
+        if cache.stale:
+            stale = cache.get_stale(key, query_id, subnet)
+            if stale is not None:
+                stale = wire.copy_question(stale, data)
+                query_response = await resolve_stale(data, key, stale, subnet)
+                if info is not None and query_response is stale:
+                    info["cache"] = "stale"
+                metrics.RESPONSES.inc(rcode_name(wire.get_rcode(query_response)))
+                return query_response, 0
+    if max_upstream_queries and resolver_dns.inflight >= max_upstream_queries:
+        # an identical question in flight costs no upstream query
+        query = data if subnet is None else wire.add_ecs(data, subnet)
+        if not resolver_dns.is_inflight(query):
+            metrics.SHED.inc("upstream")
+            raise Overloaded(
+                "{} questions waiting for the resolvers".format(resolver_dns.inflight)
+            )
+    upstream_queries += 1
+    try:
+        query_response, response_subnet = await resolve_upstream(data, subnet, info)
+    finally:
+        upstream_queries -= 1
+    if query_response is None:
+        logger.warning("[DNS] Timeout on %s", resolver_dns.name_server)
+        query_response = error_response(data, dns.rcode.SERVFAIL)
+    if cache is not None:
+        cache.set_wire(key, query_response, subnet=response_subnet)
+    metrics.RESPONSES.inc(rcode_name(wire.get_rcode(query_response)))
+    return query_response, 0
+
+
+async def watch_policy(interval: float) -> None:
+    """Reload the policy when its files change, parsed in a thread so that the
+    queries are answered with the previous policy meanwhile.
+    :param interval: seconds between the checks of the modification times.
+    """
+    global policy
+    logger = logging.getLogger("doh-server")
+    loop = asyncio.get_running_loop()
+    failed = None
+    while True:
+        await asyncio.sleep(interval)
+        current = policy
+        mtimes = current.get_mtimes()
+        if mtimes == current.mtimes or mtimes == failed:
+            continue
+        try:
+            policy = await loop.run_in_executor(None, current.reload)
+        except (OSError, ValueError, dns.exception.DNSException) as ex:
+            logger.error("[POLICY] reload failed, previous policy kept: %s", ex)
+            # not retried until the files change again
+            failed = mtimes
+        else:
+            logger.info("[POLICY] reloaded")
+
+
+@app.before_serving
+async def start_policy_watch() -> None:
+    if policy is not None and policy_reload > 0:
+        task = asyncio.ensure_future(watch_policy(policy_reload))
+        background_tasks.add(task)
+
+
+@app.before_serving
+async def signal_ready() -> None:
+    # the sockets are already listening, see listen
+    if worker_ready is not None:
+        worker_ready.set()
+
 
 @app.route("/dns-query", methods=["GET", "POST"])
 async def route_dns_query() -> Response:
     logger = logging.getLogger("doh-server")
     accept_header = request.headers.get("Accept")
-    message = await get_name_and_type_from_dns_question(request)
-    if not message:
+    json_format = request.method == "GET" and accept_header == DOH_JSON_CONTENT_TYPE
+    start = received = time.perf_counter()
+    info = {} if query_log is not None and query_log.sampled() else None
+    if json_format:
+        message = await get_name_and_type_from_dns_question(request)
+        data = message.to_wire() if message else None
+    else:
+        data = await get_dns_wire(request)
+    metrics.PARSE_TIME.time(start)
+    metrics.REQUESTS.inc(request.method, "json" if json_format else "wire")
+    if not data:
         return Response("", status=400)
     try:
-        loop = asyncio.get_running_loop()
-        query_response = None
-        try:
-            query_response = await loop.run_in_executor(
-                None, functools.partial(resolver_dns.resolve, message)
-            )
-        except asyncio.CancelledError:
-            pass
-        if isinstance(query_response, Message):
-            if query_response.answer:
-                logger.debug("[DNS] " + str(query_response.answer[0]))
-            else:
-                logger.debug("[DNS] " + str(query_response.question[0]))
-        else:
-            logger.warning("[DNS] Timeout on " + resolver_dns.name_server)
-            query_response = dns.message.make_response(message)
-            query_response.set_rcode(dns.rcode.SERVFAIL)
+        if rate_limiter is not None and not rate_limiter.allow(request.remote_addr):
+            metrics.SHED.inc("rate")
+            raise Overloaded("{} over its rate".format(request.remote_addr))
+        query_response, age = await resolve(data, info, request.remote_addr)
+        if logger.isEnabledFor(logging.DEBUG):
+            message = dns.message.from_wire(query_response)
+            logger.debug("[DNS] %s", (message.answer or message.question)[0])
+    except Overloaded as ex:
+        logger.info("[LIMIT] %s", ex)
+        if not refuse_overloaded:
+            return Response("", status=429, headers={"retry-after": "1"})
+        query_response, age = error_response(data, dns.rcode.REFUSED), 0
+    except ValueError as ex:
+        logger.info("%s", ex)
+        return Response("", status=400)
     except Exception as ex:
-        logger.exception(str(ex))
+        logger.exception("%s", ex)
         return Response("", status=400)
-    if request.method == "GET" and accept_header == DOH_JSON_CONTENT_TYPE:
-        return await create_http_json_response(request, query_response)
+    start = time.perf_counter()
+    if json_format:
+        response = await create_http_json_response(
+            request, dns.message.from_wire(query_response), age, pseudo_headers
+        )
+        metrics.RENDER_TIME.time(start, "json")
     else:
-        return await create_http_wire_response(request, query_response)
+        response = await create_http_wire_response(
+            request, query_response, age, pseudo_headers
+        )
+        metrics.RENDER_TIME.time(start, "wire")
+    if info is not None:
+        query_log.log(
+            request.remote_addr,
+            data,
+            query_response,
+            time.perf_counter() - received,
+            info.get("cache"),
+            info.get("upstream"),
+        )
+    return response
 
 
-def parse_args():  # pragma: no cover
+async def resolve_bulk(
+    queries: List[bytes], client: Optional[str] = None
+) -> AsyncIterator[bytes]:
+    """Resolve the queries concurrently, at most bulk_concurrency at a time.
+    :param queries: the DNS queries in wire format.
+    :param client: (optional) address of the client, for the query log.
+    :return: an iterator of the DNS responses in wire format, in the order
+        they are answered.
+    """
+    logger = logging.getLogger("doh-server")
+    semaphore = asyncio.Semaphore(bulk_concurrency)
+
+    async def bounded(data: bytes) -> bytes:
+        async with semaphore:
+            received = time.perf_counter()
+            info = {} if query_log is not None and query_log.sampled() else None
+            # a failed query is answered alone, the others go on
+            try:
+                try:
+                    query_response, _ = await resolve(data, info, client)
+                except Overloaded:
+                    query_response = error_response(data, dns.rcode.REFUSED)
+            except (ValueError, dns.exception.DNSException) as ex:
+                logger.info("%s", ex)
+                query_response = wire.error_header(data, dns.rcode.FORMERR)
+            except Exception as ex:
+                logger.exception("%s", ex)
+                query_response = wire.error_header(data, dns.rcode.SERVFAIL)
+            if info is not None:
+                query_log.log(
+                    client,
+                    data,
+                    query_response,
+                    time.perf_counter() - received,
+                    info.get("cache"),
+                    info.get("upstream"),
+                )
+            return query_response
+
+    tasks = [asyncio.ensure_future(bounded(data)) for data in queries]
+    try:
+        for future in asyncio.as_completed(tasks):
+            yield await future
+    finally:
+        # the client went away
+        for task in tasks:
+            task.cancel()
+
+
+@app.route("/dns-query-bulk", methods=["POST"])
+async def route_dns_query_bulk() -> Response:
+    """Many queries in one request, as JSON lines of {"name": ..., "type": ...}
+    or as DNS messages preceded by their length. The responses are streamed
+    in the same format as they are answered, not in the order of the queries.
+    """
+    logger = logging.getLogger("doh-server")
+    start = time.perf_counter()
+    try:
+        queries = await get_bulk_queries(request)
+    except ValueError as ex:
+        logger.info("%s", ex)
+        return Response("", status=400)
+    if queries is None:
+        return Response("", status=415)
+    if len(queries) > bulk_max_queries:
+        return Response("", status=413)
+    if rate_limiter is not None and len(queries) > rate_limiter.burst:
+        # more tokens than a bucket ever holds, never allowed
+        logger.info("[LIMIT] %d queries over the rate burst", len(queries))
+        return Response("", status=413)
+    if rate_limiter is not None and not rate_limiter.allow(request.remote_addr, len(queries)):
+        metrics.SHED.inc("rate")
+        logger.info("[LIMIT] %s over its rate", request.remote_addr)
+        return Response("", status=429, headers={"retry-after": "1"})
+    json_format = request.content_type == DOH_BULK_JSON_CONTENT_TYPE
+    metrics.PARSE_TIME.time(start)
+    metrics.REQUESTS.inc(request.method, "bulk-json" if json_format else "bulk-wire")
+    responses = resolve_bulk(queries, request.remote_addr)
+
+    async def body() -> AsyncIterator[bytes]:
+        try:
+            async for query_response in responses:
+                if json_format:
+                    message = dns.message.from_wire(query_response)
+                    yield json_dumps(message_to_json(message)) + b"\n"
+                else:
+                    yield LENGTH.pack(len(query_response)) + query_response
+        finally:
+            await responses.aclose()
+
+    response = Response(body(), content_type=request.content_type)
+    response.timeout = None
+    return response
+
+
+@app.route("/metrics", methods=["GET"])
+async def route_metrics() -> Response:
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def parse_args(argv: Optional[list] = None):  # pragma: no cover
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", action="store_true", help="Enable Debug mode")
     parser.add_argument(
         "--resolver",
-        default="internal",
-        help="Define the DNS resolver. Default [%(default)s]. Example 8.8.8.8",
+        nargs="+",
+        default=["internal"],
+        help="Define the DNS resolvers. Default [%(default)s]. Example 8.8.8.8 1.1.1.1",
+    )
+    parser.add_argument(
+        "--race",
+        action="store_true",
+        help="Send the first attempt to the two fastest resolvers in parallel.",
+    )
+    parser.add_argument(
+        "--resolver-port",
+        type=int,
+        default=None,
+        help="Port of the DNS resolvers. Default 53, 853 for tls",
+    )
+    parser.add_argument(
+        "--resolver-transport",
+        choices=["udp", "tcp", "tls"],
+        default="udp",
+        help="Transport to the DNS resolvers, udp falls back to tcp on truncation. "
+        "Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--resolver-sockets",
+        type=int,
+        default=RESOLVER_SOCKETS,
+        help="Number of connections opened to each DNS resolver, the UDP sockets are "
+        "replaced after 1000 queries or 60 seconds. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--resolver-timeout",
+        type=float,
+        default=RESOLVER_TIMEOUT,
+        help="Timeout in seconds of each attempt, the upper bound if adaptive. "
+        "Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--resolver-attempts",
+        type=int,
+        default=RESOLVER_ATTEMPTS,
+        help="Maximum number of attempts per query. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--adaptive-timeout",
+        action="store_true",
+        help="Derive the timeout of each attempt from the observed round-trip times.",
+    )
+    parser.add_argument(
+        "--resolver-deadline",
+        type=float,
+        default=None,
+        help="Maximum total time in seconds spent resolving a query.",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=10000,
+        help="Maximum number of cached responses, 0 to disable. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=0,
+        metavar="HITS",
+        help="Refresh in the background the responses hit HITS times, when served in "
+        "the last 10%% of their TTL, 0 to disable. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--serve-stale",
+        type=int,
+        default=0,
+        metavar="SECONDS",
+        help="Answer with responses expired for less than SECONDS when the resolvers "
+        "do not answer (RFC 8767), 0 to disable. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--stale-answer-timeout",
+        type=float,
+        default=STALE_ANSWER_TIMEOUT,
+        help="Time in seconds waited for the resolvers before answering a stale "
+        "response. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--shared-cache",
+        action="store_true",
+        help="Share the response cache between the workers through shared memory, "
+        "responses larger than 1 KB are not cached.",
+    )
+    parser.add_argument(
+        "--no-pseudo-headers",
+        dest="pseudo_headers",
+        action="store_false",
+        help="Do not add the authority, method and scheme headers to the responses.",
+    )
+    parser.add_argument(
+        "--query-log",
+        default=None,
+        metavar="PATH",
+        help="Append a JSON line per query to PATH, - for the standard output.",
+    )
+    parser.add_argument(
+        "--query-log-sample",
+        type=float,
+        default=1.0,
+        metavar="RATE",
+        help="Fraction of the queries written to the query log. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--ecs",
+        action="store_true",
+        help="Send the network of the clients to the resolvers as an EDNS Client Subnet "
+        "option (RFC 7871), the responses are cached for the networks of their scope.",
+    )
+    parser.add_argument(
+        "--ecs-prefix",
+        type=int,
+        nargs=2,
+        default=[24, 56],
+        metavar=("IPV4", "IPV6"),
+        help="Source prefix lengths of the EDNS Client Subnet options. Default %(default)s",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0,
+        metavar="QPS",
+        help="Queries per second allowed to each client network, 0 to disable. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--rate-burst",
+        type=float,
+        default=None,
+        help="Queries a client network can send at once before being limited. "
+        "Default: twice the rate limit",
+    )
+    parser.add_argument(
+        "--rate-limit-prefix",
+        type=int,
+        nargs=2,
+        default=[32, 56],
+        metavar=("IPV4", "IPV6"),
+        help="Prefix lengths of the client networks sharing a rate limit. Default %(default)s",
+    )
+    parser.add_argument(
+        "--rate-limit-clients",
+        type=int,
+        default=100000,
+        help="Maximum number of client networks tracked, the least recently seen are "
+        "forgotten first. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--max-upstream-queries",
+        type=int,
+        default=0,
+        help="Maximum number of distinct questions waiting for the resolvers, the "
+        "queries of other questions are shed, 0 for no limit. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--refuse-overloaded",
+        action="store_true",
+        help="Answer the shed queries DNS REFUSED instead of HTTP 429.",
+    )
+    parser.add_argument(
+        "--bulk-max-queries",
+        type=int,
+        default=BULK_MAX_QUERIES,
+        help="Maximum number of queries of a /dns-query-bulk request. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--bulk-concurrency",
+        type=int,
+        default=BULK_CONCURRENCY,
+        help="Maximum number of queries of a /dns-query-bulk request resolved at the same "
+        "time. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--local-zone",
+        action="append",
+        default=[],
+        metavar="PATH",
+        help="Answer the names of this zone file from it, can be repeated.",
+    )
+    parser.add_argument(
+        "--hosts",
+        action="append",
+        default=[],
+        metavar="PATH",
+        help="Answer the A and AAAA queries of the names of this hosts file, can be repeated.",
+    )
+    parser.add_argument(
+        "--blocklist",
+        action="append",
+        default=[],
+        metavar="PATH",
+        help="Block the names of this list and their subdomains, one per line or in the "
+        "hosts format, or compiled with doh-blocklist. Can be repeated.",
+    )
+    parser.add_argument(
+        "--block-action",
+        default="nxdomain",
+        help="Answer to the blocked names: nxdomain, refused, null (0.0.0.0 and ::) "
+        "or an IP address. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--policy-reload",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help="Check every SECONDS if the zone, hosts and blocklist files changed and "
+        "reload them, 0 to disable. Default [%(default)s]",
     )
     parser.add_argument(
         "--cert",
@@ -82,7 +717,52 @@ def parse_args():  # pragma: no cover
     parser.add_argument(
         "--host", default="0.0.0.0", help="Define the host. Default [%(default)s]"
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--quic-port",
+        type=int,
+        default=None,
+        help="Also serve HTTP/3 over QUIC on this UDP port, advertised with alt-svc. "
+        "Requires aioquic.",
+    )
+    parser.add_argument(
+        "--h2-max-concurrent-streams",
+        type=int,
+        default=100,
+        help="Maximum number of concurrent streams of an HTTP/2 connection. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--h2-max-inbound-frame-size",
+        type=int,
+        default=2 ** 14,
+        help="Maximum size of the HTTP/2 frames received. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--keep-alive-timeout",
+        type=float,
+        default=5.0,
+        help="Seconds an idle connection is kept open. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--backlog",
+        type=int,
+        default=100,
+        help="Maximum number of pending connections. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--tls-tickets",
+        type=int,
+        default=2,
+        help="Number of TLS 1.3 session tickets sent for session resumption, 0 to disable "
+        "the tickets. Default [%(default)s]",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes sharing the port with SO_REUSEPORT, "
+        "SIGHUP reloads them. Default [%(default)s]",
+    )
+    return parser.parse_args(argv)
 
 
 def _exception_handler(loop: asyncio.AbstractEventLoop, context: dict) -> None:
@@ -93,30 +773,279 @@ def _exception_handler(loop: asyncio.AbstractEventLoop, context: dict) -> None:
         loop.default_exception_handler(context)
 
 
-def main(args):  # pragma: no cover
+class DOHConfig(Config):
+    """Hypercorn configuration with the number of TLS 1.3 session tickets sent
+    to the clients, for session resumption.
+    """
+
+    tls_tickets = 2
+
+    def create_ssl_context(self) -> Optional[ssl.SSLContext]:
+        context = super().create_ssl_context()
+        if context is not None:
+            context.num_tickets = self.tls_tickets
+            if not self.tls_tickets:
+                context.options |= ssl.OP_NO_TICKET
+        return context
+
+
+def create_config(args) -> Config:
+    config = DOHConfig()
+    config.bind = [args.host + ":" + str(args.port)]
+    if args.quic_port:
+        config.quic_bind = [args.host + ":" + str(args.quic_port)]
+    config.ca_certs = args.cert
+    config.certfile = args.cert
+    config.keyfile = args.key
+    config.debug = args.debug
+    config.backlog = args.backlog
+    config.keep_alive_timeout = args.keep_alive_timeout
+    config.h2_max_concurrent_streams = args.h2_max_concurrent_streams
+    config.h2_max_inbound_frame_size = args.h2_max_inbound_frame_size
+    config.tls_tickets = args.tls_tickets
+    # with several workers, each one binds its own socket with SO_REUSEPORT
+    config.workers = args.workers
+    return config
+
+
+def listen(config: Config) -> None:  # pragma: no cover
+    """Bind and listen before the app starts, hypercorn then serves these sockets,
+    so that a worker accepts connections as soon as it is ready. An invalid
+    certificate or a port in use fails here.
+    """
+    sockets = config.create_sockets()
+    for sock in sockets.secure_sockets + sockets.insecure_sockets:
+        sock.listen(config.backlog)
+    # kept open, hypercorn gets their file descriptors
+    listeners.extend(sockets.secure_sockets + sockets.insecure_sockets + sockets.quic_sockets)
+
+    def fds(socks: list) -> List[str]:
+        return ["fd://{}".format(sock.fileno()) for sock in socks]
+
+    if config.ssl_enabled:
+        config.create_ssl_context()
+        config.bind = fds(sockets.secure_sockets)
+        config.insecure_bind = fds(sockets.insecure_sockets)
+        config.quic_bind = fds(sockets.quic_sockets)
+    else:
+        config.bind = fds(sockets.insecure_sockets)
+
+
+def run_worker(
+    args, config: Config, cache: Optional[ResponseCache] = None, ready=None
+) -> None:  # pragma: no cover
+    """Serve in the current process, with its own resolver sockets.
+    :param cache: (optional) the cache shared with the other workers, else each
+        worker has its own.
+    :param ready: (optional) multiprocessing.Event set once the worker listens
+        and the app is started.
+    """
     if args.debug:
         level = "DEBUG"
     else:
         level = "WARNING"
-    global resolver_dns
-    resolver_dns = DNSResolverClient(args.resolver)
+    global resolver_dns, response_cache, stale_answer_timeout, pseudo_headers, query_log
+    global policy, policy_reload, bulk_max_queries, bulk_concurrency
+    global rate_limiter, max_upstream_queries, refuse_overloaded, ecs_prefix, worker_ready
+    stale_answer_timeout = args.stale_answer_timeout
+    bulk_max_queries = args.bulk_max_queries
+    bulk_concurrency = args.bulk_concurrency
+    max_upstream_queries = args.max_upstream_queries
+    refuse_overloaded = args.refuse_overloaded
+    if args.ecs:
+        ecs_prefix = tuple(args.ecs_prefix)
+    if args.rate_limit > 0:
+        rate_limiter = RateLimiter(
+            args.rate_limit,
+            args.rate_burst,
+            max_clients=args.rate_limit_clients,
+            ipv4_prefix=args.rate_limit_prefix[0],
+            ipv6_prefix=args.rate_limit_prefix[1],
+        )
+    pseudo_headers = args.pseudo_headers
+    if args.query_log:
+        query_log = QueryLog.open(args.query_log, sample_rate=args.query_log_sample)
+    if args.local_zone or args.hosts or args.blocklist:
+        from quart_doh.policy import Policy
+
+        policy = Policy(args.local_zone, args.hosts, args.blocklist, args.block_action)
+        policy_reload = args.policy_reload
+    resolver_dns = DNSResolverClient(
+        args.resolver,
+        port=args.resolver_port,
+        sockets=args.resolver_sockets,
+        race=args.race,
+        transport=args.resolver_transport,
+        timeout=args.resolver_timeout,
+        maximum=args.resolver_attempts,
+        adaptive=args.adaptive_timeout,
+        deadline=args.resolver_deadline,
+    )
+    if cache is not None:
+        response_cache = cache
+    elif args.cache_size > 0:
+        response_cache = ResponseCache(
+            args.cache_size, prefetch_hits=args.prefetch, stale=args.serve_stale
+        )
     logger = configure_logger("doh-server", level=level)
     configure_logger("quart.app", level=level)
     configure_logger("quart.serving", level=level)
     logger.info("Logger in {} mode".format(logging.getLevelName(logger.level)))
 
-    config = Config()
-    config.bind = [args.host + ":" + str(args.port)]
-    config.ca_certs = args.cert
-    config.certfile = args.cert
-    config.keyfile = args.key
-    config.debug = args.debug
-
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     loop.set_debug(args.debug)
     loop.set_exception_handler(_exception_handler)
+    # the processes are managed by supervise, hypercorn only binds with SO_REUSEPORT
+    warnings.filterwarnings("ignore", "The config `workers` has no affect")
+    from hypercorn.asyncio import serve
+
+    if ready is not None:
+        listen(config)
+        worker_ready = ready
     loop.run_until_complete(serve(app, config))
+    if query_log is not None:
+        query_log.close()
+
+
+class _SupervisorSignals:
+    def __init__(self):
+        self.reload = False
+        self.stop = False
+
+    def handle(self, signum: int, frame) -> None:
+        if signum == signal.SIGHUP:
+            self.reload = True
+        else:
+            self.stop = True
+
+
+_supervisor_signals = _SupervisorSignals()
+
+
+def _start_worker(args, config: Config, cache) -> multiprocessing.Process:  # pragma: no cover
+    # reloading is done by the supervisor
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(
+        target=run_worker, args=(args, config, cache, ready), daemon=True
+    )
+    process.start()
+    process.ready = ready
+    signal.signal(signal.SIGHUP, _supervisor_signals.handle)
+    return process
+
+
+def _wait_ready(workers: List[multiprocessing.Process]) -> bool:  # pragma: no cover
+    """
+    :return: True once every worker is ready, False if one exits before,
+        after WORKER_READY_TIMEOUT seconds or on a stop signal.
+    """
+    end = time.monotonic() + WORKER_READY_TIMEOUT
+    while not all(worker.ready.is_set() for worker in workers):
+        if _supervisor_signals.stop or time.monotonic() >= end:
+            return False
+        if not all(worker.is_alive() for worker in workers):
+            return False
+        multiprocessing.connection.wait([w.sentinel for w in workers], timeout=0.1)
+    return True
+
+
+def supervise(args, config: Config, cache: Optional[ResponseCache] = None) -> None:  # pragma: no cover
+    """Run the workers, restart the ones that exit, and replace all of them on SIGHUP.
+    The old workers shut down gracefully once the new ones are ready, and are
+    kept if the new ones fail to start.
+    A worker exiting within WORKER_MIN_UPTIME seconds is restarted after a delay
+    doubling at each failure, and the supervisor exits after WORKER_MAX_FAILURES
+    failures in a row, such as a port in use or an invalid certificate.
+    """
+    logger = logging.getLogger("doh-server")
+    for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, _supervisor_signals.handle)
+    workers = [_start_worker(args, config, cache) for _ in range(args.workers)]
+    started = [time.monotonic()] * args.workers
+    failures = [0] * args.workers
+    # time of the restart of the exited workers, None while running
+    restarts = [None] * args.workers
+    failed = False
+    while not _supervisor_signals.stop:
+        now = time.monotonic()
+        timeout = min([1.0] + [max(r - now, 0.0) for r in restarts if r is not None])
+        multiprocessing.connection.wait(
+            [w.sentinel for w, r in zip(workers, restarts) if r is None], timeout=timeout
+        )
+        if _supervisor_signals.stop:
+            break
+        if _supervisor_signals.reload:
+            _supervisor_signals.reload = False
+            logger.warning("Reloading %d workers", len(workers))
+            new_workers = [_start_worker(args, config, cache) for _ in range(args.workers)]
+            if not _wait_ready(new_workers):
+                logger.error("New workers failed to start, previous workers kept")
+                for worker in new_workers:
+                    worker.terminate()
+                for worker in new_workers:
+                    worker.join(config.graceful_timeout)
+                continue
+            old_workers = workers
+            workers = new_workers
+            started = [time.monotonic()] * args.workers
+            restarts = [None] * args.workers
+            for worker in old_workers:
+                worker.terminate()
+            for worker in old_workers:
+                worker.join(config.graceful_timeout)
+            continue
+        now = time.monotonic()
+        for i, worker in enumerate(workers):
+            if restarts[i] is not None:
+                if now >= restarts[i]:
+                    workers[i] = _start_worker(args, config, cache)
+                    started[i] = now
+                    restarts[i] = None
+            elif not worker.is_alive():
+                failures[i] = failures[i] + 1 if now - started[i] < WORKER_MIN_UPTIME else 0
+                if failures[i] >= WORKER_MAX_FAILURES:
+                    logger.error(
+                        "Worker %d exited with %s, %d failures at startup, stopping",
+                        worker.pid,
+                        worker.exitcode,
+                        failures[i],
+                    )
+                    failed = True
+                    break
+                delay = WORKER_RESTART_DELAY * 2 ** failures[i] if failures[i] else 0.0
+                logger.warning(
+                    "Worker %d exited with %s, restarting in %.1fs", worker.pid, worker.exitcode, delay
+                )
+                restarts[i] = now + delay
+        if failed:
+            break
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.join(config.graceful_timeout)
+    if failed:
+        raise SystemExit(1)
+
+
+def main(args=None):  # pragma: no cover
+    if args is None:
+        args = parse_args()
+    config = create_config(args)
+    if args.workers > 1:
+        cache = None
+        if args.shared_cache and args.cache_size > 0:
+            cache = SharedResponseCache.create(
+                args.cache_size, prefetch_hits=args.prefetch, stale=args.serve_stale
+            )
+        try:
+            supervise(args, config, cache)
+        finally:
+            if cache is not None:
+                cache.close()
+    else:
+        run_worker(args, config)
 
 
 if __name__ == "__main__":  # pragma: no cover
@@ -0,0 +1,149 @@
+import errno
+import socket
+import struct
+import threading
+
+import dns.edns
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rrset
+import pytest
+
+from quart_doh.dns_resolver import DNSResolverClient
+
+
+class StubUpstream:
+    """Plain DNS server on 127.0.0.1 answering every question with an A record.
+    Over TCP, queries received together are answered in reverse order.
+    """
+
+    def __init__(self):
+        self.sock, self.tcp_sock = self._bind()
+        self.port = self.sock.getsockname()[1]
+        self.tcp_sock.listen()
+        self.silent = False
+        self.truncate = False
+        self.rcode = dns.rcode.NOERROR
+        self.ttl = 300
+        self.ecs_scope = None
+        self.last_ecs = None
+        self.queries = 0
+        self.tcp_queries = 0
+        self.tcp_connections = 0
+        threading.Thread(target=self._serve, daemon=True).start()
+        threading.Thread(target=self._serve_tcp, daemon=True).start()
+
+    @staticmethod
+    def _bind():
+        """
+        :return: a UDP and a TCP socket bound to the same free port, retried
+            while the TCP port of a free UDP port is in use.
+        """
+        for _ in range(100):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("127.0.0.1", 0))
+            tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                tcp_sock.bind(("127.0.0.1", sock.getsockname()[1]))
+            except OSError as ex:
+                sock.close()
+                tcp_sock.close()
+                if ex.errno != errno.EADDRINUSE:
+                    raise
+                continue
+            return sock, tcp_sock
+        raise OSError(errno.EADDRINUSE, "No free UDP and TCP port")
+
+    def make_response(self, q):
+        r = dns.message.make_response(q)
+        r.set_rcode(self.rcode)
+        self.last_ecs = next((o for o in q.options if o.otype == dns.edns.ECS), None)
+        if self.last_ecs is not None and self.ecs_scope is not None:
+            ecs = dns.edns.ECSOption(
+                self.last_ecs.address, self.last_ecs.srclen, min(self.ecs_scope, self.last_ecs.srclen)
+            )
+            r.use_edns(0, options=[ecs])
+        if self.rcode == dns.rcode.NOERROR:
+            r.answer.append(
+                dns.rrset.from_text(
+                    q.question[0].name, self.ttl, "IN", "A", "127.0.0.1"
+                )
+            )
+        return r
+
+    def _serve(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+            except OSError:
+                return
+            self.queries += 1
+            if self.silent:
+                continue
+            q = dns.message.from_wire(data)
+            if self.truncate:
+                r = dns.message.make_response(q)
+                r.flags |= dns.flags.TC
+            else:
+                r = self.make_response(q)
+            self.sock.sendto(r.to_wire(), addr)
+
+    def _serve_tcp(self):
+        while True:
+            try:
+                conn, _ = self.tcp_sock.accept()
+            except OSError:
+                return
+            self.tcp_connections += 1
+            threading.Thread(target=self._handle_tcp, args=(conn,), daemon=True).start()
+
+    def _handle_tcp(self, conn):
+        buffer = b""
+        with conn:
+            while True:
+                try:
+                    data = conn.recv(65535)
+                except OSError:
+                    return
+                if not data:
+                    return
+                buffer += data
+                replies = []
+                while len(buffer) >= 2 and len(buffer) >= struct.unpack("!H", buffer[:2])[0] + 2:
+                    length = struct.unpack("!H", buffer[:2])[0]
+                    q = dns.message.from_wire(buffer[2:length + 2])
+                    buffer = buffer[length + 2:]
+                    self.tcp_queries += 1
+                    wire = self.make_response(q).to_wire()
+                    replies.append(struct.pack("!H", len(wire)) + wire)
+                conn.sendall(b"".join(reversed(replies)))
+
+    def close(self):
+        self.sock.close()
+        self.tcp_sock.close()
+
+
+@pytest.fixture
+def stub_upstream():
+    stub = StubUpstream()
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def silent_upstream():
+    stub = StubUpstream()
+    stub.silent = True
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def resolver_stub(stub_upstream, monkeypatch):
+    from quart_doh import server
+
+    resolver = DNSResolverClient("127.0.0.1", port=stub_upstream.port)
+    resolver.timeout = 0.05
+    monkeypatch.setattr(server, "resolver_dns", resolver)
+    return resolver
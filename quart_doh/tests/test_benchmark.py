@@ -0,0 +1,71 @@
+import json
+import os
+
+import pytest
+
+from quart_doh import benchmark, server
+from quart_doh.benchmark import (
+    LIGHT_MODULES,
+    load_queries,
+    main,
+    measure_import,
+    parse_args,
+    percentile,
+    run_benchmark,
+)
+from quart_doh.dns_resolver import DNSResolverClient
+from quart_doh.wire import parse_question
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+urls = os.path.join(dir_path, "..", "..", "benchmark_get_url.txt")
+
+
+class TestBenchmark:
+    def test_load_queries(self):
+        queries = load_queries(urls)
+        assert len(queries) == 60
+        assert parse_question(queries[0])[1] == (b"\x03api\x06github\x03com\x00", 28, 1)
+
+    def test_percentile(self):
+        values = [float(v) for v in range(1, 101)]
+        assert percentile(values, 50) == 51.0
+        assert percentile(values, 99) == 100.0
+        assert percentile(values, 100) == 100.0
+        assert percentile([], 50) == 0.0
+
+    @pytest.mark.asyncio
+    async def test_run_benchmark(self, stub_upstream, monkeypatch):
+        monkeypatch.setattr(server, "resolver_dns", DNSResolverClient("127.0.0.1", port=stub_upstream.port))
+        monkeypatch.setattr(server, "response_cache", None)
+        result = await run_benchmark(load_queries(urls), "both", concurrency=4, requests=40)
+        assert result["requests"] == 40
+        assert result["error_rate"] == 0.0
+        assert result["qps"] > 0
+        assert result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"]
+
+    def test_main(self, monkeypatch, capsys):
+        monkeypatch.setattr(server, "resolver_dns", None)
+        monkeypatch.setattr(server, "response_cache", None)
+        args = parse_args(["--urls", urls, "--requests", "20", "--concurrency", "2", "--json"])
+        result = main(args)
+        assert json.loads(capsys.readouterr().out) == result
+        assert result["requests"] == 20
+        assert result["error_rate"] == 0.0
+
+    def test_main_installed(self, monkeypatch):
+        # benchmark_get_url.txt is only in a source checkout
+        monkeypatch.setattr(benchmark, "URLS", os.path.join(dir_path, "missing.txt"))
+        args = parse_args(["--requests", "1"])
+        assert args.urls is None
+        with pytest.raises(SystemExit):
+            main(args)
+
+    @pytest.mark.parametrize("module", LIGHT_MODULES)
+    def test_light_imports(self, module):
+        duration, heavy = measure_import(module, runs=1)
+        assert duration > 0
+        assert heavy == []
+
+    def test_server_imports(self):
+        _, heavy = measure_import("quart_doh.server", runs=1)
+        assert "quart" in heavy
@@ -0,0 +1,310 @@
+import multiprocessing
+import pickle
+import zlib
+from unittest.mock import patch
+
+import dns.message
+import dns.rcode
+import dns.rrset
+import pytest
+
+from quart_doh.cache import ResponseCache, SharedResponseCache, cache_key, get_ttl
+from quart_doh.ecs import client_subnet
+
+
+@pytest.fixture
+def query():
+    q = dns.message.make_query(qname="example.com", rdtype="A", want_dnssec=False)
+    q.id = 0
+    return q
+
+
+@pytest.fixture
+def response(query):
+    r = dns.message.make_response(query)
+    r.answer.append(dns.rrset.from_text("example.com.", 300, "IN", "A", "127.0.0.1"))
+    r.answer.append(dns.rrset.from_text("example.com.", 60, "IN", "AAAA", "::1"))
+    return r
+
+
+@pytest.fixture
+def negative_response(query):
+    r = dns.message.make_response(query)
+    r.set_rcode(dns.rcode.NXDOMAIN)
+    r.authority.append(
+        dns.rrset.from_text(
+            "com.", 900, "IN", "SOA", "a.gtld-servers.net. nstld.verisign-grs.com. 1 1800 900 604800 30"
+        )
+    )
+    return r
+
+
+@pytest.fixture
+def shared_cache():
+    cache = SharedResponseCache.create(max_size=16)
+    yield cache
+    cache.close()
+
+
+def _lookup(path: str, data: bytes, results: multiprocessing.Queue) -> None:
+    cache = SharedResponseCache(path, max_size=16)
+    results.put(cache.get_wire(cache_key(dns.message.from_wire(data))))
+
+
+def _key_hash(query) -> int:
+    key = cache_key(query)
+    return zlib.crc32(key[0] + SharedResponseCache.KEY.pack(*key[1:]))
+
+
+class TestCache:
+    def test_get_ttl(self, query, response, negative_response):
+        assert get_ttl(response) == 60
+        assert get_ttl(query) is None
+        assert get_ttl(negative_response) == 30
+        negative_response.set_rcode(dns.rcode.NOERROR)
+        assert get_ttl(negative_response) == 30
+        negative_response.authority[0].ttl = 10
+        assert get_ttl(negative_response) == 10
+        negative_response.authority = []
+        assert get_ttl(negative_response) is None
+        negative_response.set_rcode(dns.rcode.SERVFAIL)
+        assert get_ttl(negative_response) == 5
+        assert get_ttl(negative_response, servfail_ttl=1) == 1
+        negative_response.set_rcode(dns.rcode.REFUSED)
+        assert get_ttl(negative_response) is None
+
+    def test_cache_key(self, query):
+        assert cache_key(query) == (b"\x07example\x03com\x00", 1, 1, False, False, False)
+        q = dns.message.make_query(qname="EXAMPLE.com", rdtype="A", want_dnssec=True)
+        assert cache_key(q) == (b"\x07example\x03com\x00", 1, 1, True, True, False)
+        q.flags |= dns.flags.CD
+        assert cache_key(q) == (b"\x07example\x03com\x00", 1, 1, True, True, True)
+        q.question = []
+        assert cache_key(q) is None
+
+    def test_get_set(self, query, response):
+        cache = ResponseCache()
+        assert cache.get(query) is None
+        cache.set(query, response)
+        q = dns.message.make_query(qname="Example.COM", rdtype="A", want_dnssec=False)
+        q.id = 1234
+        result = cache.get(q)
+        assert result.id == 1234
+        assert str(result.answer[0]) == "example.com. 300 IN A 127.0.0.1"
+        assert cache.hits == 1
+        assert cache.misses == 1
+
+        q = dns.message.make_query(qname="example.com", rdtype="A", want_dnssec=True)
+        assert cache.get(q) is None
+
+    def test_ttl_decremented(self, query, response):
+        cache = ResponseCache()
+        with patch("quart_doh.cache.time.monotonic", return_value=100.0):
+            cache.set(query, response)
+        with patch("quart_doh.cache.time.monotonic", return_value=110.5):
+            result = cache.get(query)
+        assert result.answer[0].ttl == 290
+        assert result.answer[1].ttl == 50
+        with patch("quart_doh.cache.time.monotonic", return_value=160.0):
+            assert cache.get(query) is None
+        assert len(cache) == 0
+
+    def test_negative_cached(self, query, negative_response):
+        cache = ResponseCache()
+        with patch("quart_doh.cache.time.monotonic", return_value=100.0):
+            cache.set(query, negative_response)
+        with patch("quart_doh.cache.time.monotonic", return_value=110.0):
+            result = cache.get(query)
+        assert result.rcode() == dns.rcode.NXDOMAIN
+        # capped to the SOA minimum (RFC 2308)
+        assert result.authority[0].ttl == 20
+        with patch("quart_doh.cache.time.monotonic", return_value=130.0):
+            assert cache.get(query) is None
+
+    def test_servfail_cached(self, query):
+        cache = ResponseCache(servfail_ttl=2)
+        r = dns.message.make_response(query)
+        r.set_rcode(dns.rcode.SERVFAIL)
+        with patch("quart_doh.cache.time.monotonic", return_value=100.0):
+            cache.set(query, r)
+        with patch("quart_doh.cache.time.monotonic", return_value=101.0):
+            assert cache.get(query).rcode() == dns.rcode.SERVFAIL
+        with patch("quart_doh.cache.time.monotonic", return_value=102.0):
+            assert cache.get(query) is None
+
+    def test_not_cached(self, query):
+        cache = ResponseCache()
+        cache.set(query, dns.message.make_response(query))
+        assert len(cache) == 0
+
+    def test_lru_eviction(self, response):
+        cache = ResponseCache(max_size=2)
+        queries = [dns.message.make_query("host%d.example.com" % i, "A") for i in range(3)]
+        cache.set(queries[0], response)
+        cache.set(queries[1], response)
+        assert cache.get(queries[0]) is not None
+        cache.set(queries[2], response)
+        assert len(cache) == 2
+        assert cache.get(queries[1]) is None
+        assert cache.get(queries[0]) is not None
+        assert cache.get(queries[2]) is not None
+
+    def test_prefetch(self, query, response):
+        cache = ResponseCache(prefetch_hits=2)
+        key = cache_key(query)
+        refreshes = []
+        with patch("quart_doh.cache.time.monotonic", return_value=100.0):
+            cache.set(query, response)
+            # not in the last 10% of the TTL
+            cache.get_wire(key, refresh=lambda: refreshes.append(1))
+        with patch("quart_doh.cache.time.monotonic", return_value=155.0):
+            cache.get_wire(key, refresh=lambda: refreshes.append(1))
+            assert cache.get_wire(key, refresh=lambda: refreshes.append(1)) is not None
+            cache.get_wire(key, refresh=lambda: refreshes.append(1))
+        assert refreshes == [1]
+        assert cache.prefetches == 1
+        with patch("quart_doh.cache.time.monotonic", return_value=155.0):
+            cache.set(query, response)
+        with patch("quart_doh.cache.time.monotonic", return_value=210.0):
+            cache.get_wire(key, refresh=lambda: refreshes.append(1))
+            assert refreshes == [1]
+            cache.get_wire(key, refresh=lambda: refreshes.append(1))
+        assert refreshes == [1, 1]
+
+    def test_prefetch_disabled(self, query, response):
+        cache = ResponseCache()
+        refreshes = []
+        with patch("quart_doh.cache.time.monotonic", return_value=100.0):
+            cache.set(query, response)
+        with patch("quart_doh.cache.time.monotonic", return_value=159.0):
+            for _ in range(3):
+                cache.get_wire(cache_key(query), refresh=lambda: refreshes.append(1))
+        assert refreshes == []
+
+    def test_stale(self, query, response):
+        cache = ResponseCache(stale=100)
+        key = cache_key(query)
+        with patch("quart_doh.cache.time.monotonic", return_value=100.0):
+            cache.set(query, response)
+            assert cache.get_stale(key, 1234) is not None
+        with patch("quart_doh.cache.time.monotonic", return_value=200.0):
+            assert cache.get(query) is None
+            assert len(cache) == 1
+            result = dns.message.from_wire(cache.get_stale(key, 1234))
+            assert result.id == 1234
+            assert [r.ttl for r in result.answer] == [30, 30]
+        with patch("quart_doh.cache.time.monotonic", return_value=260.0):
+            assert cache.get_stale(key) is None
+            assert cache.get(query) is None
+            assert len(cache) == 0
+        assert cache.stale_hits == 2
+
+    def test_stale_disabled(self, query, response):
+        cache = ResponseCache()
+        with patch("quart_doh.cache.time.monotonic", return_value=100.0):
+            cache.set(query, response)
+        with patch("quart_doh.cache.time.monotonic", return_value=200.0):
+            assert cache.get_stale(cache_key(query)) is None
+
+    def test_subnet_scope(self, query, response):
+        cache = ResponseCache()
+        key = cache_key(query)
+        data = response.to_wire()
+        scoped = client_subnet("1.2.3.4")[:3] + bytes((16,)) + client_subnet("1.2.3.4")[4:]
+        cache.set_wire(key, data, subnet=scoped)
+        assert cache.get_wire(key, subnet=client_subnet("1.2.200.1")) == data
+        assert cache.get_wire(key, subnet=client_subnet("1.3.3.4")) is None
+        assert cache.get_wire(key, subnet=client_subnet("2001:4860::1")) is None
+        assert cache.get_wire(key) is None
+        # global response, for the clients of the other networks
+        cache.set_wire(key, data, subnet=client_subnet("5.6.7.8"))
+        assert cache.get_wire(key, subnet=client_subnet("1.3.3.4")) == data
+        assert cache.get_wire(key) == data
+        assert len(cache) == 2
+
+    def test_subnet_scope_capped(self, query, response):
+        cache = ResponseCache()
+        key = cache_key(query)
+        # scope longer than the source prefix
+        subnet = client_subnet("1.2.3.4")[:3] + bytes((32,)) + client_subnet("1.2.3.4")[4:]
+        cache.set_wire(key, response.to_wire(), subnet=subnet)
+        assert cache.get_wire(key, subnet=client_subnet("1.2.3.200")) is not None
+        assert cache.get_stale(key, subnet=client_subnet("1.2.3.200")) is not None
+
+
+class TestSharedResponseCache:
+    def test_get_set(self, shared_cache, query, response):
+        assert shared_cache.get(query) is None
+        shared_cache.set(query, response)
+        q = dns.message.make_query(qname="Example.COM", rdtype="A", want_dnssec=False)
+        q.id = 1234
+        result = shared_cache.get(q)
+        assert result.id == 1234
+        assert str(result.answer[0]) == "example.com. 300 IN A 127.0.0.1"
+        assert len(shared_cache) == 1
+        q = dns.message.make_query(qname="example.com", rdtype="A", want_dnssec=True)
+        assert shared_cache.get(q) is None
+
+    def test_shared_between_processes(self, shared_cache, query, response):
+        shared_cache.set(query, response)
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_lookup, args=(shared_cache.path, query.to_wire(), results)
+        )
+        process.start()
+        process.join(10)
+        assert results.get(timeout=1) == response.to_wire()
+
+    def test_pickle(self, shared_cache, query, response):
+        other = pickle.loads(pickle.dumps(shared_cache))
+        shared_cache.set(query, response)
+        assert other.get(query) is not None
+        assert not other.owner
+        other.close()
+
+    def test_expiry(self, shared_cache, query, response):
+        with patch("quart_doh.cache.time.monotonic", return_value=100.0):
+            shared_cache.set(query, response)
+        with patch("quart_doh.cache.time.monotonic", return_value=110.5):
+            assert shared_cache.get(query).answer[0].ttl == 290
+        with patch("quart_doh.cache.time.monotonic", return_value=160.0):
+            assert shared_cache.get(query) is None
+            assert len(shared_cache) == 0
+
+    def test_stale(self, query, response):
+        cache = SharedResponseCache.create(max_size=1, stale=100)
+        with patch("quart_doh.cache.time.monotonic", return_value=100.0):
+            cache.set(query, response)
+        with patch("quart_doh.cache.time.monotonic", return_value=200.0):
+            cache.set(dns.message.make_query("other.example.com", "A"), response)
+            assert cache.get(query) is None
+            assert cache.get_stale(cache_key(query)) is None
+        cache.close()
+
+    def test_torn_slot(self, shared_cache, query, response):
+        shared_cache.set(query, response)
+        offset = (_key_hash(query) % shared_cache.max_size) * shared_cache.slot_size
+        shared_cache._map[offset + shared_cache.SLOT.size] ^= 0xFF
+        assert shared_cache.get(query) is None
+
+    def test_subnet_scope(self, shared_cache, query, response):
+        key = cache_key(query)
+        subnet = client_subnet("1.2.3.4")[:3] + bytes((24,)) + client_subnet("1.2.3.4")[4:]
+        shared_cache.set_wire(key, response.to_wire(), subnet=subnet)
+        assert shared_cache.get_wire(key, subnet=client_subnet("1.2.3.5")) is not None
+        assert shared_cache.get_wire(key, subnet=client_subnet("1.2.4.5")) is None
+
+    def test_too_large(self, query, response):
+        cache = SharedResponseCache.create(max_size=4, slot_size=64)
+        cache.set(query, response)
+        assert cache.get(query) is None
+        cache.close()
+
+    def test_replace_oldest(self, response):
+        cache = SharedResponseCache.create(max_size=1)
+        queries = [dns.message.make_query("host%d.example.com" % i, "A") for i in range(2)]
+        cache.set(queries[0], response)
+        cache.set(queries[1], response)
+        assert cache.get(queries[0]) is None
+        assert cache.get(queries[1]) is not None
+        cache.close()
@@ -1,7 +1,15 @@
+from unittest.mock import patch
+
+import dns.asyncquery
+import dns.flags
 import dns.message
+import dns.rcode
+import dns.rrset
 import pytest
+import pytest_asyncio
 
-from quart_doh.client import ClientDOH
+from quart_doh.client import AsyncClientDOH, ClientDOH, get_max_age, serve_stub, truncate
+from quart_doh.server import app
 
 """
 List of servers taken from
@@ -55,3 +63,129 @@ class TestMain:
             main(args)
         assert ret.type == SystemExit
         assert ret.value.code == 0
+
+
+class TestClientDOH:
+    def test_session(self):
+        with ClientDOH("https://127.0.0.1/dns-query") as client_doh:
+            with patch.object(client_doh.session, "post") as post:
+                post.return_value.content = b"response"
+                assert client_doh.make_request(qname="www.example.com", rdtype="A") == b"response"
+                client_doh.make_request(qname="www.example.org", rdtype="A")
+            assert post.call_count == 2
+            assert client_doh.session.headers["content-type"] == "application/dns-message"
+
+    def test_cache(self):
+        response = dns.message.make_response(dns.message.make_query("www.example.com", "A"))
+        response.id = 0
+        response.answer.append(dns.rrset.from_text("www.example.com.", 300, "IN", "A", "127.0.0.1"))
+        client_doh = ClientDOH("https://127.0.0.1/dns-query", cache_size=10)
+        with patch.object(client_doh.session, "post") as post:
+            post.return_value.status_code = 200
+            post.return_value.content = response.to_wire()
+            post.return_value.headers = {"cache-control": "max-age=60"}
+            for _ in range(2):
+                assert client_doh.make_request(qname="www.example.com", rdtype="A") == response.to_wire()
+        assert post.call_count == 1
+        assert client_doh.cache._entries[(b"\x03www\x07example\x03com\x00", 1, 1, False, False, False)][2] == 60
+
+    def test_get_max_age(self):
+        assert get_max_age({"cache-control": "max-age=300"}) == 300
+        assert get_max_age({"cache-control": "public, Max-Age=10"}) == 10
+        assert get_max_age({"cache-control": "no-cache"}) is None
+        assert get_max_age({}) is None
+        assert get_max_age({"cache-control": "max-age=300", "age": "100"}) == 200
+
+
+@pytest.fixture
+def asgi_transport():
+    # the async extra, HTTP/2 on by default
+    httpx = pytest.importorskip("httpx")
+    pytest.importorskip("h2")
+    return httpx.ASGITransport(app=app)
+
+
+@pytest.fixture
+def async_client(asgi_transport):
+    return AsyncClientDOH("http://doh/dns-query", transport=asgi_transport)
+
+
+class TestAsyncClientDOH:
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize("get", [False, True])
+    async def test_resolve(self, resolver_stub, async_client, get):
+        async with async_client:
+            msg = await async_client.resolve("www.example.com", get=get)
+        assert msg.id == 0
+        assert "www.example.com. 300 IN A 127.0.0.1" == str(msg.answer[0])
+
+    @pytest.mark.asyncio
+    async def test_resolve_many(self, resolver_stub, async_client):
+        resolver_stub.timeout = 1
+        names = ["host%d.example.com" % i for i in range(200)]
+        async with async_client:
+            results = await async_client.resolve_many(names, concurrency=50)
+        assert [str(r.question[0].name) for r in results] == [n + "." for n in names]
+        assert all(r.rcode() == dns.rcode.NOERROR for r in results)
+
+    @pytest.mark.asyncio
+    async def test_resolve_many_errors(self, resolver_stub, async_client):
+        async with async_client:
+            results = await async_client.resolve_many(["www.example.com", "a" * 64 + ".com"])
+        assert isinstance(results[0], dns.message.Message)
+        assert isinstance(results[1], Exception)
+
+    @pytest.mark.asyncio
+    async def test_cache(self, resolver_stub, stub_upstream, asgi_transport):
+        client = AsyncClientDOH("http://doh/dns-query", transport=asgi_transport, cache_size=10)
+        async with client:
+            for _ in range(3):
+                msg = await client.resolve("www.example.com")
+                assert msg.answer[0].ttl == 300
+        assert stub_upstream.queries == 1
+        assert client.cache.hits == 2
+
+
+@pytest_asyncio.fixture
+async def stub_listener(resolver_stub, async_client):
+    transport, server = await serve_stub(async_client, port=0)
+    yield transport.get_extra_info("sockname")[1]
+    transport.close()
+    server.close()
+    await async_client.close()
+
+
+class TestStubListener:
+    @pytest.mark.asyncio
+    async def test_udp(self, stub_listener):
+        q = dns.message.make_query("www.example.com", "A")
+        r = await dns.asyncquery.udp(q, "127.0.0.1", port=stub_listener, timeout=2)
+        assert r.id == q.id
+        assert "www.example.com. 300 IN A 127.0.0.1" == str(r.answer[0])
+
+    @pytest.mark.asyncio
+    async def test_tcp(self, stub_listener):
+        q = dns.message.make_query("www.example.com", "A")
+        r = await dns.asyncquery.tcp(q, "127.0.0.1", port=stub_listener, timeout=2)
+        assert r.id == q.id
+        assert "www.example.com. 300 IN A 127.0.0.1" == str(r.answer[0])
+
+    @pytest.mark.asyncio
+    async def test_servfail(self, stub_listener, async_client):
+        async_client.server = "http://doh/missing"
+        q = dns.message.make_query("www.example.com", "A")
+        r = await dns.asyncquery.udp(q, "127.0.0.1", port=stub_listener, timeout=2)
+        assert r.rcode() == dns.rcode.SERVFAIL
+
+    def test_truncate(self):
+        q = dns.message.make_query("www.example.com", "TXT", use_edns=False)
+        r = dns.message.make_response(q)
+        r.answer.append(
+            dns.rrset.from_text("www.example.com.", 300, "IN", "TXT", *['"%s"' % (c * 200) for c in "abcd"])
+        )
+        result = dns.message.from_wire(truncate(q.to_wire(), r.to_wire()))
+        assert result.flags & dns.flags.TC
+        assert result.answer == []
+        q.use_edns(payload=1232)
+        response = r.to_wire()
+        assert truncate(q.to_wire(), response) == response
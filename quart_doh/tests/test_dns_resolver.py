@@ -1,8 +1,13 @@
+import asyncio
+import time
+
 import dns
+import dns.flags
+import dns.message
 import pytest
 from dns.message import Message
 
-from quart_doh.dns_resolver import DNSResolverClient
+from quart_doh.dns_resolver import DNSResolverClient, PendingQueries, Upstream
 
 
 @pytest.fixture
@@ -66,3 +71,287 @@ class TestDNSResolver:
     def test_dns_resolver_not_exist(self, resolver_not_exist, query_not_ok):
         result_msg = resolver_not_exist.resolve(query_not_ok)
         assert result_msg == 0
+
+
+class TestDNSResolverAsync:
+    @pytest.mark.asyncio
+    async def test_resolve_async_answer(self, stub_upstream, query_ok):
+        resolver = DNSResolverClient("127.0.0.1", port=stub_upstream.port)
+        result_msg = await resolver.resolve_async(query_ok)
+        assert isinstance(result_msg, Message)
+        assert result_msg.id == 0
+        assert result_msg.rcode() == 0
+        assert "example.com. 300 IN A 127.0.0.1" == str(result_msg.answer[0])
+        resolver.close()
+
+    @pytest.mark.asyncio
+    async def test_resolve_async_concurrent(self, stub_upstream):
+        resolver = DNSResolverClient("127.0.0.1", port=stub_upstream.port, sockets=2)
+        queries = []
+        for i in range(50):
+            q = dns.message.make_query(qname="host%d.example.com" % i, rdtype="A")
+            q.id = i
+            queries.append(q)
+        results = await asyncio.gather(*(resolver.resolve_async(q) for q in queries))
+        for i, result_msg in enumerate(results):
+            assert result_msg.id == i
+            assert str(result_msg.answer[0].name) == "host%d.example.com." % i
+        assert stub_upstream.queries == 50
+        assert len(resolver.upstreams[0]._datagrams) == 1
+        await asyncio.gather(*(resolver.resolve_async(q) for q in queries))
+        assert len(resolver.upstreams[0]._datagrams) == 2
+        resolver.close()
+
+    @pytest.mark.asyncio
+    async def test_resolve_async_rotate(self, stub_upstream, query_ok):
+        resolver = DNSResolverClient("127.0.0.1", port=stub_upstream.port, sockets=1)
+        upstream = resolver.upstreams[0]
+        upstream.socket_queries = 2
+        ports = set()
+        for _ in range(6):
+            assert await resolver.resolve_async(query_ok) is not None
+            ports.add(upstream._datagrams[0].transport.get_extra_info("sockname")[1])
+        assert len(ports) == 3
+        first = upstream._datagrams[0]
+        upstream.socket_queries = 1000
+        upstream.socket_lifetime = 0.0
+        await resolver.resolve_async(query_ok)
+        assert upstream._datagrams[0] is not first
+        assert first.transport is None
+        resolver.close()
+
+    @pytest.mark.asyncio
+    async def test_resolve_async_timeout(self, stub_upstream, query_ok):
+        stub_upstream.silent = True
+        resolver = DNSResolverClient("127.0.0.1", port=stub_upstream.port)
+        resolver.timeout = 0.01
+        result_msg = await resolver.resolve_async(query_ok)
+        assert result_msg is None
+        assert resolver.upstreams[0]._datagrams[0].pending == {}
+        resolver.close()
+
+    @pytest.mark.asyncio
+    async def test_resolve_async_coalesced(self, stub_upstream):
+        resolver = DNSResolverClient("127.0.0.1", port=stub_upstream.port)
+        queries = []
+        for i in range(10):
+            q = dns.message.make_query(qname="example.com", rdtype="A")
+            q.id = i
+            queries.append(q)
+        results = await asyncio.gather(*(resolver.resolve_async(q) for q in queries))
+        for i, result_msg in enumerate(results):
+            assert result_msg.id == i
+            assert "example.com. 300 IN A 127.0.0.1" == str(result_msg.answer[0])
+        assert len({id(r) for r in results}) == 10
+        assert stub_upstream.queries == 1
+        assert resolver.coalesced == 9
+        assert resolver.inflight == 0
+
+        mixed = dns.message.make_query("EXAMPLE.com", "A")
+        results = await asyncio.gather(*(resolver.resolve_async(q) for q in (queries[0], mixed)))
+        assert [str(r.question[0].name) for r in results] == ["example.com.", "EXAMPLE.com."]
+        assert stub_upstream.queries == 2
+        assert resolver.coalesced == 10
+
+        result_msg = await resolver.resolve_async(queries[0])
+        assert result_msg.id == 0
+        assert stub_upstream.queries == 3
+        resolver.close()
+
+    @pytest.mark.asyncio
+    async def test_resolve_async_coalesced_edns(self, stub_upstream):
+        resolver = DNSResolverClient("127.0.0.1", port=stub_upstream.port)
+        edns = dns.message.make_query("x.example.com", "A", use_edns=0)
+        plain = dns.message.make_query("x.example.com", "A")
+        results = await asyncio.gather(resolver.resolve_async(edns), resolver.resolve_async(plain))
+        assert [r.edns for r in results] == [0, -1]
+        assert stub_upstream.queries == 2
+        assert resolver.coalesced == 0
+        resolver.close()
+
+    @pytest.mark.asyncio
+    async def test_resolve_async_coalesced_cancel(self, stub_upstream, query_ok):
+        resolver = DNSResolverClient("127.0.0.1", port=stub_upstream.port)
+        leader = asyncio.ensure_future(resolver.resolve_async(query_ok))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(resolver.resolve_async(query_ok))
+        await asyncio.sleep(0)
+        leader.cancel()
+        result_msg = await follower
+        assert "example.com. 300 IN A 127.0.0.1" == str(result_msg.answer[0])
+        resolver.close()
+
+
+class TestUpstreams:
+    def test_internal(self):
+        resolver = DNSResolverClient(["internal", "8.8.8.8"])
+        assert len(resolver.upstreams) >= 2
+        assert resolver.upstreams[-1].address == "8.8.8.8"
+        assert resolver.name_server.endswith(", 8.8.8.8")
+
+    def test_statistics(self):
+        upstream = Upstream("127.0.0.1")
+        upstream.record_success(0.1)
+        assert upstream.srtt == 0.1
+        upstream.record_success(0.9)
+        assert upstream.srtt == pytest.approx(0.2)
+        for _ in range(5):
+            upstream.record_failure(0.4)
+        assert upstream.healthy
+        upstream.record_failure(0.4)
+        assert not upstream.healthy
+        assert upstream.srtt > 0.2
+        for _ in range(6):
+            upstream.record_success(0.1)
+        assert upstream.healthy
+
+    def test_select(self):
+        resolver = DNSResolverClient(["10.0.0.1", "10.0.0.2", "10.0.0.3"])
+        slow, fast, down = resolver.upstreams
+        assert resolver.select() == [slow, fast, down]
+        slow.record_success(0.3)
+        fast.record_success(0.01)
+        down.record_success(0.001)
+        down.failure_rate = 0.9
+        assert resolver.select() == [fast, slow, down]
+        assert resolver.select([fast]) == [slow, down, fast]
+
+    @pytest.mark.asyncio
+    async def test_failover(self, stub_upstream, silent_upstream, query_ok):
+        resolver = DNSResolverClient(["127.0.0.1", "127.0.0.1"], port=stub_upstream.port)
+        resolver.timeout = 0.05
+        # the first upstream is not answering
+        resolver.upstreams[0].port = silent_upstream.port
+        result_msg = await resolver.resolve_async(query_ok)
+        assert "example.com. 300 IN A 127.0.0.1" == str(result_msg.answer[0])
+        assert resolver.upstreams[0].failure_rate > 0
+        assert resolver.upstreams[1].srtt is not None
+        assert resolver.select()[0] is resolver.upstreams[1]
+        resolver.close()
+
+    @pytest.mark.asyncio
+    async def test_race(self, stub_upstream, silent_upstream, query_ok):
+        resolver = DNSResolverClient(["127.0.0.1", "127.0.0.1"], port=stub_upstream.port, race=True)
+        resolver.upstreams[0].port = silent_upstream.port
+        start = asyncio.get_running_loop().time()
+        result_msg = await resolver.resolve_async(query_ok)
+        assert asyncio.get_running_loop().time() - start < resolver.timeout
+        assert "example.com. 300 IN A 127.0.0.1" == str(result_msg.answer[0])
+        assert resolver.upstreams[0].failure_rate == 0
+        resolver.close()
+
+
+class TestStreamTransport:
+    @pytest.mark.asyncio
+    async def test_tcp_fallback(self, stub_upstream, query_ok):
+        stub_upstream.truncate = True
+        resolver = DNSResolverClient("127.0.0.1", port=stub_upstream.port)
+        result_msg = await resolver.resolve_async(query_ok)
+        assert not result_msg.flags & dns.flags.TC
+        assert "example.com. 300 IN A 127.0.0.1" == str(result_msg.answer[0])
+        assert stub_upstream.tcp_queries == 1
+        resolver.close()
+
+    def test_tcp_fallback_sync(self, stub_upstream, query_ok):
+        stub_upstream.truncate = True
+        resolver = DNSResolverClient("127.0.0.1", port=stub_upstream.port)
+        result_msg = resolver.resolve(query_ok)
+        assert "example.com. 300 IN A 127.0.0.1" == str(result_msg.answer[0])
+        assert stub_upstream.tcp_queries == 1
+
+    @pytest.mark.asyncio
+    async def test_tcp_pipelined(self, stub_upstream):
+        resolver = DNSResolverClient("127.0.0.1", port=stub_upstream.port, sockets=1, transport="tcp")
+        queries = []
+        for i in range(50):
+            q = dns.message.make_query(qname="host%d.example.com" % i, rdtype="A")
+            q.id = i
+            queries.append(q)
+        results = await asyncio.gather(*(resolver.resolve_async(q) for q in queries))
+        for i, result_msg in enumerate(results):
+            assert result_msg.id == i
+            assert str(result_msg.answer[0].name) == "host%d.example.com." % i
+        results = await asyncio.gather(*(resolver.resolve_async(q) for q in queries))
+        assert stub_upstream.tcp_queries == 100
+        assert stub_upstream.tcp_connections == 1
+        assert stub_upstream.queries == 0
+        resolver.close()
+
+    @pytest.mark.asyncio
+    async def test_tcp_connection_refused(self, query_ok):
+        resolver = DNSResolverClient("127.0.0.1", port=1, transport="tcp")
+        resolver.maximum = 1
+        assert await resolver.resolve_async(query_ok) is None
+        assert resolver.upstreams[0].failure_rate > 0
+
+    def test_send_required(self):
+        class Protocol(PendingQueries, asyncio.Protocol):
+            pass
+
+        with pytest.raises(TypeError):
+            Protocol()
+
+    def test_invalid_transport(self):
+        with pytest.raises(ValueError):
+            DNSResolverClient("127.0.0.1", transport="quic")
+        assert DNSResolverClient("127.0.0.1", transport="tls").upstreams[0].port == 853
+
+
+class TestTimeouts:
+    def test_attempt_timeout(self):
+        upstream = Upstream("127.0.0.1")
+        for _ in range(9):
+            upstream.record_success(0.05)
+        assert upstream.attempt_timeout(0.4) == 0.4
+        upstream.record_success(0.5)
+        assert upstream.attempt_timeout(0.4) == pytest.approx(0.1)
+        assert upstream.attempt_timeout(0.01) == 0.01
+        for _ in range(100):
+            upstream.record_success(0.001)
+        assert upstream.attempt_timeout(0.4) == upstream.min_timeout
+        upstream.record_success(0.15)
+        upstream.record_success(0.15)
+        assert upstream.attempt_timeout(0.4) == pytest.approx(0.3)
+
+    def test_attempt_timeout_backoff(self):
+        upstream = Upstream("127.0.0.1")
+        for _ in range(20):
+            upstream.record_success(0.001)
+        assert upstream.attempt_timeout(0.4) == upstream.min_timeout
+        assert upstream.attempt_timeout(0.4, 1) == pytest.approx(0.1)
+        assert upstream.attempt_timeout(0.4, 3) == 0.4
+        for _ in range(6):
+            upstream.record_failure(upstream.attempt_timeout(0.4))
+        assert upstream.attempt_timeout(0.4) == 0.4
+
+    def test_configured(self):
+        resolver = DNSResolverClient("127.0.0.1", timeout=0.1, maximum=2)
+        assert resolver.timeout == 0.1
+        assert resolver.maximum == 2
+        upstream = resolver.upstreams[0]
+        for _ in range(10):
+            upstream.record_success(0.001)
+        assert resolver._attempt_timeout(upstream, None) == 0.1
+        assert resolver._attempt_timeout(upstream, 0.03) == 0.03
+        resolver.adaptive = True
+        assert resolver._attempt_timeout(upstream, None) == upstream.min_timeout
+        assert resolver._attempt_timeout(upstream, None, 1) == 0.1
+
+    @pytest.mark.asyncio
+    async def test_deadline(self, silent_upstream, query_ok):
+        resolver = DNSResolverClient(
+            "127.0.0.1", port=silent_upstream.port, timeout=0.1, maximum=10, deadline=0.15
+        )
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        assert await resolver.resolve_async(query_ok) is None
+        assert loop.time() - start < 0.3
+        resolver.close()
+
+    def test_deadline_sync(self, silent_upstream, query_ok):
+        resolver = DNSResolverClient(
+            "127.0.0.1", port=silent_upstream.port, timeout=0.1, maximum=10, deadline=0.15
+        )
+        start = time.monotonic()
+        assert resolver.resolve(query_ok) == 0
+        assert time.monotonic() - start < 0.3
@@ -0,0 +1,24 @@
+from quart_doh.ecs import client_subnet, parse, scoped_key, truncate
+
+
+class TestECS:
+    def test_truncate(self):
+        assert truncate(bytes([192, 0, 2, 255]), 24) == bytes([192, 0, 2])
+        assert truncate(bytes([192, 0, 2, 255]), 20) == bytes([192, 0, 0])
+        assert truncate(bytes([192, 0, 2, 255]), 0) == b""
+        assert truncate(bytes([10]), 16) == bytes([10, 0])
+
+    def test_client_subnet(self):
+        assert parse(client_subnet("8.8.4.4")) == (1, 24, 0, bytes([8, 8, 4]))
+        assert parse(client_subnet("2001:4860:4860::8844", 24, 48)) == (
+            2, 48, 0, bytes.fromhex("200148604860")
+        )
+        assert client_subnet("192.168.1.1") is None
+        assert client_subnet("127.0.0.1") is None
+        assert client_subnet("<local>") is None
+        assert client_subnet(None) is None
+
+    def test_scoped_key(self):
+        key = (b"\x07example\x03com\x00", 1, 1, False)
+        assert scoped_key(key, 1, 0, bytes([8, 8, 4])) is key
+        assert scoped_key(key, 1, 16, bytes([8, 8, 4])) == key + (1, 16, bytes([8, 8]))
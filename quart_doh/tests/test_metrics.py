@@ -0,0 +1,58 @@
+import pytest
+
+from quart_doh.metrics import Counter, Histogram, Metric, Registry, Sampled
+
+
+@pytest.fixture
+def registry():
+    return Registry()
+
+
+class TestMetrics:
+    def test_counter(self, registry):
+        counter = Counter("requests_total", "Requests.", ["method"], registry=registry)
+        counter.inc("GET")
+        counter.inc("GET")
+        counter.inc("POST", amount=3)
+        assert registry.render() == (
+            "# HELP requests_total Requests.\n"
+            "# TYPE requests_total counter\n"
+            'requests_total{method="GET"} 2\n'
+            'requests_total{method="POST"} 3\n'
+        )
+
+    def test_histogram(self, registry):
+        histogram = Histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0), registry=registry)
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(2.0)
+        assert registry.render() == (
+            "# HELP latency_seconds Latency.\n"
+            "# TYPE latency_seconds histogram\n"
+            'latency_seconds_bucket{le="0.1"} 2\n'
+            'latency_seconds_bucket{le="1.0"} 3\n'
+            'latency_seconds_bucket{le="+Inf"} 4\n'
+            "latency_seconds_sum 2.65\n"
+            "latency_seconds_count 4\n"
+        )
+
+    def test_histogram_labels(self, registry):
+        histogram = Histogram("upstream_seconds", "RTT.", ["upstream"], buckets=(0.1,), registry=registry)
+        histogram.observe(0.01, '1.1.1.1"')
+        assert 'upstream_seconds_bucket{upstream="1.1.1.1\\"",le="0.1"} 1' in registry.render()
+
+    def test_sampled(self, registry):
+        values = [None]
+        Sampled("cache_entries", "Entries.", lambda: values[0], registry=registry)
+        assert registry.render() == "# HELP cache_entries Entries.\n# TYPE cache_entries gauge\n"
+        values[0] = 12
+        assert registry.render().endswith("cache_entries 12\n")
+
+    def test_samples_required(self, registry):
+        class Untyped(Metric):
+            pass
+
+        with pytest.raises(TypeError):
+            Untyped("untyped", "Untyped.", registry=registry)
+        assert registry.metrics == []
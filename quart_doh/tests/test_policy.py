@@ -0,0 +1,162 @@
+import argparse
+import os
+
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import pytest
+
+from quart_doh import wire
+from quart_doh.policy import Policy, SuffixIndex, main, read_blocklist, read_hosts
+from quart_doh.wire import encode_name
+
+ZONE = """$ORIGIN home.lan.
+$TTL 300
+@       IN SOA ns.home.lan. admin.home.lan. 1 3600 600 86400 60
+nas     IN A 192.168.1.10
+www     IN CNAME nas.home.lan.
+"""
+
+
+def query(name, rdtype="A"):
+    data = dns.message.make_query(name, rdtype).to_wire()
+    return data, wire.query_key(data)
+
+
+def answer(policy, name, rdtype="A"):
+    data, key = query(name, rdtype)
+    response = policy.answer(data, key)
+    return None if response is None else dns.message.from_wire(response)
+
+
+@pytest.fixture
+def files(tmp_path):
+    zone = tmp_path / "home.lan.zone"
+    zone.write_text(ZONE)
+    hosts = tmp_path / "hosts"
+    hosts.write_text("# comment\n10.0.0.1 router router.local\n::1 router\nbad line\n")
+    blocklist = tmp_path / "blocklist.txt"
+    blocklist.write_text("ads.example.com\n0.0.0.0 tracker.example.net # hosts format\n\n")
+    return str(zone), str(hosts), str(blocklist)
+
+
+class TestSuffixIndex:
+    def test_match(self):
+        index = SuffixIndex.build([encode_name("example.com"), encode_name("ads.net")])
+        assert len(index) == 2
+        assert index.match(encode_name("example.com"))
+        assert index.match(encode_name("a.b.example.com"))
+        assert not index.match(encode_name("notexample.com"))
+        assert not index.match(encode_name("com"))
+
+    def test_save_load(self, tmp_path):
+        names = [encode_name("host{}.example".format(i)) for i in range(1000)]
+        path = str(tmp_path / "index")
+        SuffixIndex.build(names).save(path)
+        assert SuffixIndex.is_index(path)
+        index = SuffixIndex.load(path)
+        assert len(index) == 1000
+        assert all(index.match(b"\x01a" + name) for name in names)
+        assert not index.match(encode_name("host1000.example"))
+
+    def test_load_invalid(self, tmp_path):
+        path = tmp_path / "index"
+        path.write_bytes(SuffixIndex.MAGIC + bytes(20))
+        with pytest.raises(ValueError):
+            SuffixIndex.load(str(path))
+
+
+class TestReadFiles:
+    def test_read_blocklist(self, files):
+        assert list(read_blocklist(files[2])) == [
+            encode_name("ads.example.com"), encode_name("tracker.example.net")
+        ]
+
+    def test_read_hosts(self, files):
+        assert read_hosts(files[1]) == {
+            encode_name("router"): {dns.rdatatype.A: ["10.0.0.1"], dns.rdatatype.AAAA: ["::1"]},
+            encode_name("router.local"): {dns.rdatatype.A: ["10.0.0.1"]},
+        }
+
+
+class TestPolicy:
+    def test_empty(self):
+        policy = Policy()
+        assert not policy
+        assert answer(policy, "www.example.com") is None
+
+    def test_zone(self, files):
+        policy = Policy(zones=[files[0]])
+        response = answer(policy, "NAS.home.lan")
+        assert response.rcode() == dns.rcode.NOERROR
+        assert response.answer[0].to_text() == "NAS.home.lan. 300 IN A 192.168.1.10"
+        response = answer(policy, "www.home.lan")
+        assert response.answer[0][0].target.to_text() == "nas.home.lan."
+        response = answer(policy, "nas.home.lan", "AAAA")
+        assert response.rcode() == dns.rcode.NOERROR
+        assert not response.answer
+        assert response.authority[0].rdtype == dns.rdatatype.SOA
+        response = answer(policy, "printer.home.lan")
+        assert response.rcode() == dns.rcode.NXDOMAIN
+        assert response.authority[0].rdtype == dns.rdatatype.SOA
+        assert answer(policy, "home.lan.example.com") is None
+
+    def test_hosts(self, files):
+        policy = Policy(hosts=[files[1]], ttl=10)
+        response = answer(policy, "router")
+        assert response.answer[0].to_text() == "router. 10 IN A 10.0.0.1"
+        assert answer(policy, "router", "AAAA").answer[0][0].address == "::1"
+        response = answer(policy, "router.local", "MX")
+        assert response.rcode() == dns.rcode.NOERROR
+        assert not response.answer
+        assert answer(policy, "www.router") is None
+
+    @pytest.mark.parametrize(
+        "action,rcode,address",
+        [
+            ("nxdomain", dns.rcode.NXDOMAIN, None),
+            ("refused", dns.rcode.REFUSED, None),
+            ("null", dns.rcode.NOERROR, "0.0.0.0"),
+            ("192.0.2.1", dns.rcode.NOERROR, "192.0.2.1"),
+        ],
+    )
+    def test_blocklist(self, files, action, rcode, address):
+        policy = Policy(blocklists=[files[2]], block_action=action)
+        response = answer(policy, "x.ads.example.com")
+        assert response.rcode() == rcode
+        if address is None:
+            assert not response.answer
+        else:
+            assert response.answer[0][0].address == address
+        assert answer(policy, "example.com") is None
+
+    def test_invalid_block_action(self):
+        with pytest.raises(ValueError):
+            Policy(block_action="drop")
+
+    def test_precedence(self, files, tmp_path):
+        blocklist = tmp_path / "all.txt"
+        blocklist.write_text("router\nhome.lan\n")
+        policy = Policy([files[0]], [files[1]], [str(blocklist)])
+        assert answer(policy, "router").rcode() == dns.rcode.NOERROR
+        assert answer(policy, "nas.home.lan").rcode() == dns.rcode.NOERROR
+
+    def test_reload(self, files):
+        policy = Policy(blocklists=[files[2]])
+        assert policy.get_mtimes() == policy.mtimes
+        with open(files[2], "a") as f:
+            f.write("new.example.org\n")
+        stat = os.stat(files[2])
+        os.utime(files[2], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        assert policy.get_mtimes() != policy.mtimes
+        assert answer(policy, "new.example.org") is None
+        policy = policy.reload()
+        assert answer(policy, "new.example.org").rcode() == dns.rcode.NXDOMAIN
+
+    def test_compiled(self, files, tmp_path, capsys):
+        path = str(tmp_path / "blocklist.idx")
+        main(argparse.Namespace(blocklist=[files[2]], output=path))
+        assert "2 names" in capsys.readouterr().out
+        policy = Policy(blocklists=[path])
+        assert answer(policy, "ads.example.com").rcode() == dns.rcode.NXDOMAIN
+        assert answer(policy, "example.net") is None
@@ -0,0 +1,77 @@
+import io
+import json
+import queue
+from unittest.mock import patch
+
+import dns.message
+import dns.rcode
+import dns.rrset
+import pytest
+
+from quart_doh.query_log import QueryLog
+
+
+@pytest.fixture
+def query():
+    return dns.message.make_query("www.example.com", "AAAA").to_wire()
+
+
+@pytest.fixture
+def response(query):
+    r = dns.message.make_response(dns.message.from_wire(query))
+    r.answer.append(dns.rrset.from_text("www.example.com.", 300, "IN", "AAAA", "::1"))
+    return r.to_wire()
+
+
+class TestQueryLog:
+    def test_log(self, query, response):
+        stream = io.BytesIO()
+        query_log = QueryLog(stream)
+        query_log.log("192.0.2.1", query, response, 0.0012345, "miss", "8.8.8.8")
+        query_log.log("192.0.2.1", query, response, 0.0001, "hit")
+        query_log.close()
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert len(lines) == 2
+        assert lines[0]["timestamp"].endswith("+00:00")
+        del lines[0]["timestamp"]
+        assert lines[0] == {
+            "client": "192.0.2.1",
+            "qname": "www.example.com.",
+            "qtype": "AAAA",
+            "rcode": "NOERROR",
+            "upstream": "8.8.8.8",
+            "latency_ms": 1.234,
+            "cache": "miss",
+        }
+        assert lines[1]["cache"] == "hit"
+        assert lines[1]["upstream"] is None
+
+    def test_invalid_query(self):
+        record = QueryLog.format((0.0, None, b"\x00", None, 0.1, None, None))
+        assert record["qname"] is None
+        assert record["rcode"] is None
+
+    def test_batches(self, query, response):
+        stream = io.BytesIO()
+        query_log = QueryLog(stream, batch_size=10)
+        with patch.object(stream, "write", wraps=stream.write) as write:
+            for _ in range(100):
+                query_log.log(None, query, response, 0.001)
+            query_log.close()
+        assert len(stream.getvalue().splitlines()) == 100
+        assert write.call_count >= 10
+
+    def test_full(self, query, response):
+        query_log = QueryLog(io.BytesIO(), max_queue=1)
+        with patch.object(query_log._queue, "put_nowait", side_effect=queue.Full):
+            query_log.log(None, query, response, 0.001)
+        assert query_log.dropped == 1
+        query_log.close()
+
+    def test_sampled(self):
+        query_log = QueryLog(io.BytesIO(), sample_rate=0.25)
+        with patch("quart_doh.query_log.random.random", return_value=0.2):
+            assert query_log.sampled()
+        with patch("quart_doh.query_log.random.random", return_value=0.3):
+            assert not query_log.sampled()
+        query_log.close()
@@ -0,0 +1,70 @@
+from unittest.mock import Mock, patch
+
+import pytest
+
+from quart_doh.ratelimit import RateLimiter, client_network
+
+
+@pytest.fixture
+def clock():
+    with patch("quart_doh.ratelimit.time", Mock()) as time:
+        time.monotonic.return_value = 1000.0
+        yield time
+
+
+class TestClientNetwork:
+    def test_client_network(self):
+        assert client_network("192.0.2.1") == "192.0.2.1"
+        assert client_network("192.0.2.1", 24) == "192.0.2.0/24"
+        assert client_network("2001:db8:1:2:3::1") == "2001:db8:1::/56"
+        assert client_network("2001:db8::1", 32, 128) == "2001:db8::1"
+        assert client_network("<local>") == "<local>"
+        assert client_network(None) is None
+
+
+class TestRateLimiter:
+    def test_burst(self, clock):
+        limiter = RateLimiter(10, 5)
+        assert all(limiter.allow("192.0.2.1") for _ in range(5))
+        assert not limiter.allow("192.0.2.1")
+        assert limiter.allow("192.0.2.2")
+        clock.monotonic.return_value += 0.1
+        assert limiter.allow("192.0.2.1")
+        assert not limiter.allow("192.0.2.1")
+
+    def test_refill_capped(self, clock):
+        limiter = RateLimiter(10)
+        assert limiter.burst == 20
+        assert limiter.allow("192.0.2.1", 20)
+        clock.monotonic.return_value += 1.95
+        assert limiter.allow("192.0.2.1", 19)
+        assert not limiter.allow("192.0.2.1")
+        clock.monotonic.return_value += 100
+        assert not limiter.allow("192.0.2.1", 21)
+        assert limiter.allow("192.0.2.1", 20)
+
+    def test_network(self, clock):
+        limiter = RateLimiter(1, 1, ipv4_prefix=24)
+        assert limiter.allow("192.0.2.1")
+        assert not limiter.allow("192.0.2.200")
+        assert limiter.allow("198.51.100.1")
+
+    def test_max_clients(self, clock):
+        limiter = RateLimiter(1, 1, max_clients=2)
+        for address in ("192.0.2.1", "192.0.2.2", "192.0.2.3"):
+            assert limiter.allow(address)
+        assert len(limiter) == 2
+        # the least recently seen is forgotten, with its bucket
+        assert limiter.allow("192.0.2.1")
+        assert not limiter.allow("192.0.2.3")
+
+    def test_expire(self, clock):
+        limiter = RateLimiter(10, 10)
+        limiter.allow("192.0.2.1")
+        limiter.allow("192.0.2.2")
+        clock.monotonic.return_value += 0.5
+        limiter.allow("192.0.2.3")
+        assert len(limiter) == 3
+        clock.monotonic.return_value += 0.6
+        limiter.allow("192.0.2.3")
+        assert len(limiter) == 1
@@ -1,16 +1,35 @@
+import asyncio
 import contextlib
+import io
+import json
+import logging
 import multiprocessing
 import os
+import shutil
+import ssl
+import subprocess
 import time
-from collections import namedtuple
+from unittest.mock import Mock, patch
 
+import dns.edns
 import dns.message
+import dns.rcode
 import pytest
 import requests
 
-from quart_doh.constants import DOH_CONTENT_TYPE
-from quart_doh.server import main
-from quart_doh.utils import doh_b64_encode
+from quart_doh import wire
+from quart_doh.cache import ResponseCache
+from quart_doh.policy import Policy
+from quart_doh.ratelimit import Overloaded, RateLimiter
+from quart_doh.query_log import QueryLog
+from quart_doh.constants import (
+    DOH_BULK_CONTENT_TYPE,
+    DOH_BULK_JSON_CONTENT_TYPE,
+    DOH_CONTENT_TYPE,
+    DOH_JSON_CONTENT_TYPE,
+)
+from quart_doh.server import app, create_config, main, parse_args
+from quart_doh.utils import doh_b64_encode, split_wire_messages
 
 known_servers = [
     # URL
@@ -31,9 +50,9 @@ def connect(port, server_url):
         print(dir_path)
         cert = dir_path + "/../../cert.pem"
         key = dir_path + "/../../key.pem"
-        args = namedtuple("args", ["debug", "resolver", "cert", "key", "port", "host"])
-        args = args(
-            True, "8.8.8.8", cert, key, str(port), "127.0.0.1"
+        args = parse_args(
+            ["--debug", "--resolver", "8.8.8.8", "--cert", cert, "--key", key]
+            + ["--port", str(port), "--host", "127.0.0.1"]
         )
         p = multiprocessing.Process(target=main, name="Main", args=(args,))
         p.start()
@@ -44,6 +63,10 @@ def connect(port, server_url):
         yield
 
 
+def make_query_wire(name):
+    return dns.message.make_query(name, "A").to_wire()
+
+
 @pytest.fixture
 def dns_query_answer():
     q = dns.message.make_query(qname="www.example.com", rdtype="A")
@@ -123,3 +146,572 @@ class TestIntegrationServer:
                 server_url, data=dns_query_no_answer, headers=headers, verify=False
             )
             assert_no_answer(r)
+
+
+def frozen_time(now: float):
+    """Freeze the clock of the cache only, the event loop keeps the real one."""
+    return patch("quart_doh.cache.time", Mock(monotonic=Mock(return_value=now)))
+
+
+class TestRouteDnsQuery:
+    @pytest.mark.asyncio
+    async def test_post(self, resolver_stub, dns_query_answer):
+        client = app.test_client()
+        r = await client.post(
+            "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+        )
+        assert r.status_code == 200
+        msg = dns.message.from_wire(await r.get_data())
+        assert msg.id == 0
+        assert "www.example.com. 300 IN A 127.0.0.1" == str(msg.answer[0])
+        assert r.headers["cache-control"] == "max-age=300"
+
+    @pytest.mark.asyncio
+    async def test_get(self, resolver_stub, dns_query_answer):
+        client = app.test_client()
+        r = await client.get(
+            "/dns-query", query_string={"dns": doh_b64_encode(dns_query_answer)}
+        )
+        assert r.status_code == 200
+        msg = dns.message.from_wire(await r.get_data())
+        assert "www.example.com. 300 IN A 127.0.0.1" == str(msg.answer[0])
+
+    @pytest.mark.asyncio
+    async def test_timeout(self, resolver_stub, stub_upstream, dns_query_answer):
+        stub_upstream.silent = True
+        client = app.test_client()
+        r = await client.post(
+            "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+        )
+        assert r.status_code == 200
+        msg = dns.message.from_wire(await r.get_data())
+        assert msg.rcode() == dns.rcode.SERVFAIL
+
+    @pytest.mark.asyncio
+    async def test_cache(self, resolver_stub, stub_upstream, dns_query_answer, monkeypatch):
+        from quart_doh import server
+
+        monkeypatch.setattr(server, "response_cache", ResponseCache())
+        client = app.test_client()
+        for _ in range(3):
+            r = await client.post(
+                "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+            )
+            msg = dns.message.from_wire(await r.get_data())
+            assert "www.example.com. 300 IN A 127.0.0.1" == str(msg.answer[0])
+        assert stub_upstream.queries == 1
+        assert server.response_cache.hits == 2
+        # the question as sent by the client, whatever the case of the cached one
+        mixed = dns.message.make_query("WwW.ExAmPlE.CoM", "A").to_wire()
+        response, _ = await server.resolve(mixed)
+        assert dns.message.from_wire(response).question[0].name.to_text() == "WwW.ExAmPlE.CoM."
+        assert server.response_cache.hits == 3
+        # checking disabled, not the answer validated for the others
+        unchecked = dns.message.make_query("www.example.com", "A")
+        unchecked.flags |= dns.flags.CD
+        await server.resolve(unchecked.to_wire())
+        assert stub_upstream.queries == 2
+
+    @pytest.mark.asyncio
+    async def test_cache_edns(self, resolver_stub, stub_upstream, monkeypatch):
+        from quart_doh import server
+
+        monkeypatch.setattr(server, "response_cache", ResponseCache())
+        edns = dns.message.make_query("x.example.com", "A", use_edns=0).to_wire()
+        response, _ = await server.resolve(edns)
+        assert dns.message.from_wire(response).edns == 0
+        # no OPT record for a client without EDNS (RFC 6891)
+        response, _ = await server.resolve(make_query_wire("x.example.com"))
+        assert dns.message.from_wire(response).edns == -1
+        assert stub_upstream.queries == 2
+
+    @pytest.mark.asyncio
+    async def test_servfail_cached(self, resolver_stub, stub_upstream, dns_query_answer, monkeypatch):
+        from quart_doh import server
+
+        monkeypatch.setattr(server, "response_cache", ResponseCache())
+        stub_upstream.silent = True
+        client = app.test_client()
+        for _ in range(2):
+            r = await client.post(
+                "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+            )
+            msg = dns.message.from_wire(await r.get_data())
+            assert msg.rcode() == dns.rcode.SERVFAIL
+            assert r.headers["cache-control"] == "max-age=5"
+        assert server.response_cache.hits == 1
+
+    @pytest.mark.asyncio
+    async def test_prefetch(self, resolver_stub, stub_upstream, dns_query_answer, monkeypatch):
+        from quart_doh import server
+
+        monkeypatch.setattr(server, "response_cache", ResponseCache(prefetch_hits=1))
+        stub_upstream.ttl = 10
+        client = app.test_client()
+        with frozen_time(100.0):
+            await client.post(
+                "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+            )
+        stub_upstream.ttl = 300
+        with frozen_time(109.0):
+            r = await client.post(
+                "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+            )
+            msg = dns.message.from_wire(await r.get_data())
+            assert msg.answer[0].ttl == 1
+            await asyncio.gather(*server.background_tasks)
+            r = await client.post(
+                "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+            )
+            msg = dns.message.from_wire(await r.get_data())
+            assert msg.answer[0].ttl == 300
+        assert stub_upstream.queries == 2
+        assert server.response_cache.prefetches == 1
+
+    @pytest.mark.asyncio
+    async def test_serve_stale(self, resolver_stub, stub_upstream, dns_query_answer, monkeypatch):
+        from quart_doh import server
+
+        monkeypatch.setattr(server, "response_cache", ResponseCache(stale=3600))
+        monkeypatch.setattr(server, "stale_answer_timeout", 0.01)
+        client = app.test_client()
+        with frozen_time(100.0):
+            await client.post(
+                "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+            )
+        stub_upstream.silent = True
+        with frozen_time(1000.0):
+            r = await client.post(
+                "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+            )
+            await asyncio.gather(*server.background_tasks)
+        msg = dns.message.from_wire(await r.get_data())
+        assert msg.rcode() == dns.rcode.NOERROR
+        assert msg.answer[0].ttl == 30
+        assert r.headers["cache-control"] == "max-age=30"
+        assert server.response_cache.stale_hits == 1
+
+    @pytest.mark.asyncio
+    async def test_serve_stale_refreshed(
+        self, resolver_stub, stub_upstream, dns_query_answer, monkeypatch
+    ):
+        from quart_doh import server
+
+        monkeypatch.setattr(server, "response_cache", ResponseCache(stale=3600))
+        client = app.test_client()
+        with frozen_time(100.0):
+            await client.post(
+                "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+            )
+        with frozen_time(1000.0):
+            r = await client.post(
+                "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+            )
+            msg = dns.message.from_wire(await r.get_data())
+            assert msg.answer[0].ttl == 300
+            assert server.response_cache.get_wire(wire.query_key(dns_query_answer)) is not None
+        assert stub_upstream.queries == 2
+
+    @pytest.mark.asyncio
+    async def test_http_cache(self, resolver_stub, dns_query_answer, monkeypatch):
+        from quart_doh import server
+
+        monkeypatch.setattr(server, "response_cache", ResponseCache())
+        client = app.test_client()
+        query_string = {"dns": doh_b64_encode(dns_query_answer)}
+        with frozen_time(100.0):
+            r = await client.get("/dns-query", query_string=query_string)
+        assert r.headers["cache-control"] == "max-age=300"
+        assert "age" not in r.headers
+        entity_tag = r.headers["etag"]
+        with frozen_time(110.0):
+            r = await client.get("/dns-query", query_string=query_string)
+            assert r.headers["cache-control"] == "max-age=300"
+            assert r.headers["age"] == "10"
+            assert r.headers["etag"] == entity_tag
+            assert dns.message.from_wire(await r.get_data()).answer[0].ttl == 290
+            r = await client.get(
+                "/dns-query", query_string=query_string, headers={"If-None-Match": entity_tag}
+            )
+        assert r.status_code == 304
+        assert await r.get_data() == b""
+        for if_none_match, status in (
+            ("*", 304),
+            ('"0", ' + entity_tag[2:], 304),
+            (entity_tag[:-2] + '"', 200),
+        ):
+            r = await client.get(
+                "/dns-query", query_string=query_string, headers={"If-None-Match": if_none_match}
+            )
+            assert r.status_code == status
+        r = await client.post(
+            "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+        )
+        assert "etag" not in r.headers
+
+    @pytest.mark.asyncio
+    async def test_no_pseudo_headers(self, resolver_stub, dns_query_answer, monkeypatch):
+        from quart_doh import server
+
+        client = app.test_client()
+        r = await client.post(
+            "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+        )
+        assert r.headers["authority"] == "quart_doh"
+        monkeypatch.setattr(server, "pseudo_headers", False)
+        r = await client.post(
+            "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+        )
+        assert "authority" not in r.headers
+        assert "scheme" not in r.headers
+
+    @pytest.mark.asyncio
+    async def test_query_log(self, resolver_stub, dns_query_answer, monkeypatch):
+        from quart_doh import server
+
+        stream = io.BytesIO()
+        monkeypatch.setattr(server, "response_cache", ResponseCache())
+        monkeypatch.setattr(server, "query_log", QueryLog(stream))
+        client = app.test_client()
+        for _ in range(2):
+            await client.post(
+                "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+            )
+        server.query_log.close()
+        lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert [(line["cache"], line["upstream"]) for line in lines] == [
+            ("miss", "127.0.0.1"), ("hit", None)
+        ]
+        assert lines[0]["qname"] == "www.example.com."
+        assert lines[0]["rcode"] == "NOERROR"
+
+    @pytest.mark.asyncio
+    async def test_policy(self, resolver_stub, dns_query_answer, monkeypatch, tmp_path):
+        from quart_doh import server
+
+        blocklist = tmp_path / "blocklist.txt"
+        blocklist.write_text("example.com\n")
+        monkeypatch.setattr(server, "response_cache", ResponseCache())
+        monkeypatch.setattr(server, "policy", Policy(blocklists=[str(blocklist)]))
+        client = app.test_client()
+        r = await client.post(
+            "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+        )
+        response = dns.message.from_wire(await r.get_data())
+        assert response.rcode() == dns.rcode.NXDOMAIN
+        assert len(server.response_cache) == 0
+
+    @pytest.mark.asyncio
+    async def test_watch_policy(self, monkeypatch, tmp_path):
+        from quart_doh import server
+
+        blocklist = tmp_path / "blocklist.txt"
+        blocklist.write_text("example.com\n")
+        monkeypatch.setattr(server, "policy", Policy(blocklists=[str(blocklist)]))
+        first = server.policy
+        task = asyncio.ensure_future(server.watch_policy(0.01))
+        await asyncio.sleep(0.05)
+        assert server.policy is first
+        blocklist.write_text("example.org\n")
+        os.utime(str(blocklist), ns=(0, 0))
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if server.policy is not first:
+                break
+        task.cancel()
+        assert server.policy is not first
+        query = dns.message.make_query("example.org", "A").to_wire()
+        assert server.policy.answer(query, wire.query_key(query)) is not None
+
+    @pytest.mark.asyncio
+    async def test_rate_limit(self, resolver_stub, dns_query_answer, monkeypatch):
+        from quart_doh import server
+
+        monkeypatch.setattr(server, "rate_limiter", RateLimiter(0.001, 2))
+        client = app.test_client()
+        statuses = []
+        for _ in range(3):
+            r = await client.post(
+                "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+            )
+            statuses.append(r.status_code)
+        assert statuses == [200, 200, 429]
+        assert r.headers["retry-after"] == "1"
+        monkeypatch.setattr(server, "refuse_overloaded", True)
+        r = await client.post(
+            "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+        )
+        assert r.status_code == 200
+        assert dns.message.from_wire(await r.get_data()).rcode() == dns.rcode.REFUSED
+
+    @pytest.mark.asyncio
+    async def test_max_upstream_queries(self, resolver_stub, stub_upstream, monkeypatch):
+        from quart_doh import server
+
+        monkeypatch.setattr(server, "max_upstream_queries", 1)
+        monkeypatch.setattr(server, "refuse_overloaded", True)
+        stub_upstream.silent = True
+        resolver_stub.timeout = 0.2
+        first = make_query_wire("first.example.com")
+        task = asyncio.ensure_future(server.resolve(first))
+        await asyncio.sleep(0.01)
+        assert server.upstream_queries == 1
+        with pytest.raises(Overloaded):
+            await server.resolve(make_query_wire("second.example.com"))
+        # coalesced with the first one, not shed
+        follower = asyncio.ensure_future(server.resolve(make_query_wire("first.example.com")))
+        await asyncio.sleep(0.01)
+        assert not follower.done()
+        assert server.upstream_queries == 2
+        client = app.test_client()
+        r = await client.post(
+            "/dns-query",
+            data=make_query_wire("third.example.com"),
+            headers={"content-type": DOH_CONTENT_TYPE},
+        )
+        assert dns.message.from_wire(await r.get_data()).rcode() == dns.rcode.REFUSED
+        for pending in (task, follower):
+            pending.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await pending
+        assert server.upstream_queries == 0
+
+    @pytest.mark.asyncio
+    async def test_ecs(self, resolver_stub, stub_upstream, monkeypatch):
+        from quart_doh import server
+
+        monkeypatch.setattr(server, "response_cache", ResponseCache())
+        monkeypatch.setattr(server, "ecs_prefix", (24, 56))
+        stub_upstream.ecs_scope = 24
+        data = make_query_wire("cdn.example.com")
+        response, _ = await server.resolve(data, client="8.8.8.8")
+        assert stub_upstream.last_ecs.to_text() == "ECS 8.8.8.0/24 scope/0"
+        # no OPT record for a client without EDNS (RFC 6891)
+        assert dns.message.from_wire(response).edns == -1
+        assert wire.get_id(response) == wire.get_id(data)
+        await server.resolve(data, client="8.8.8.99")
+        assert stub_upstream.queries == 1
+        await server.resolve(data, client="9.9.9.9")
+        assert stub_upstream.queries == 2
+        assert stub_upstream.last_ecs.to_text() == "ECS 9.9.9.0/24 scope/0"
+        # not a public address, no option and a global response
+        await server.resolve(data, client="127.0.0.1")
+        assert stub_upstream.last_ecs is None
+        assert stub_upstream.queries == 3
+        data = dns.message.make_query("edns.example.com", "A", use_edns=0).to_wire()
+        response, _ = await server.resolve(data, client="8.8.8.8")
+        message = dns.message.from_wire(response)
+        assert message.edns == 0
+        assert message.options == ()
+
+    @pytest.mark.asyncio
+    async def test_ecs_from_client(self, resolver_stub, stub_upstream, monkeypatch):
+        from quart_doh import server
+
+        monkeypatch.setattr(server, "response_cache", ResponseCache())
+        monkeypatch.setattr(server, "ecs_prefix", (24, 56))
+        ecs = dns.edns.ECSOption("203.0.113.0", 24)
+        data = dns.message.make_query("cdn.example.com", "A", use_edns=0, options=[ecs]).to_wire()
+        for _ in range(2):
+            await server.resolve(data, client="8.8.8.8")
+        assert stub_upstream.last_ecs.to_text() == "ECS 203.0.113.0/24 scope/0"
+        assert stub_upstream.queries == 2
+        assert len(server.response_cache) == 0
+
+    @pytest.mark.asyncio
+    async def test_bulk_json(self, resolver_stub, stub_upstream):
+        names = ["host{}.example.com".format(i) for i in range(50)]
+        body = "".join(json.dumps({"name": name, "type": "A"}) + "\n" for name in names)
+        client = app.test_client()
+        r = await client.post(
+            "/dns-query-bulk", data=body, headers={"content-type": DOH_BULK_JSON_CONTENT_TYPE}
+        )
+        assert r.status_code == 200
+        assert r.headers["content-type"] == DOH_BULK_JSON_CONTENT_TYPE
+        lines = [json.loads(line) for line in (await r.get_data()).splitlines()]
+        assert sorted(line["Question"][0]["name"] for line in lines) == sorted(n + "." for n in names)
+        assert all(line["Status"] == 0 for line in lines)
+        assert stub_upstream.queries >= 50
+
+    @pytest.mark.asyncio
+    async def test_bulk_wire(self, resolver_stub, monkeypatch):
+        from quart_doh import server
+
+        monkeypatch.setattr(server, "bulk_concurrency", 2)
+        queries = [dns.message.make_query("www.example.com", rdtype) for rdtype in ("A", "MX", "TXT")]
+        body = b"".join(len(q.to_wire()).to_bytes(2, "big") + q.to_wire() for q in queries)
+        client = app.test_client()
+        r = await client.post(
+            "/dns-query-bulk", data=body, headers={"content-type": DOH_BULK_CONTENT_TYPE}
+        )
+        assert r.status_code == 200
+        responses = [dns.message.from_wire(m) for m in split_wire_messages(await r.get_data())]
+        assert sorted(m.id for m in responses) == sorted(q.id for q in queries)
+        assert all(m.rcode() == dns.rcode.NOERROR for m in responses)
+
+    @pytest.mark.asyncio
+    async def test_bulk_failed_query(self, resolver_stub, stub_upstream):
+        stub_upstream.silent = True
+        resolver_stub.maximum = 1
+        good = dns.message.make_query("good.example.com", "A")
+        junk = dns.message.make_query("junk.example.com", "A")
+        queries = [good.to_wire(), junk.to_wire() + b"junk"]
+        body = b"".join(len(q).to_bytes(2, "big") + q for q in queries)
+        client = app.test_client()
+        r = await client.post(
+            "/dns-query-bulk", data=body, headers={"content-type": DOH_BULK_CONTENT_TYPE}
+        )
+        assert r.status_code == 200
+        responses = {
+            m.id: m for m in map(dns.message.from_wire, split_wire_messages(await r.get_data()))
+        }
+        assert responses[good.id].rcode() == dns.rcode.SERVFAIL
+        assert responses[junk.id].rcode() == dns.rcode.FORMERR
+        assert responses[junk.id].question == []
+
+    @pytest.mark.asyncio
+    async def test_bulk_invalid(self, resolver_stub, monkeypatch):
+        from quart_doh import server
+
+        client = app.test_client()
+        r = await client.post(
+            "/dns-query-bulk", data='{"type": "A"}\n', headers={"content-type": DOH_BULK_JSON_CONTENT_TYPE}
+        )
+        assert r.status_code == 400
+        r = await client.post(
+            "/dns-query-bulk", data=b"\x00\x05ab", headers={"content-type": DOH_BULK_CONTENT_TYPE}
+        )
+        assert r.status_code == 400
+        r = await client.post("/dns-query-bulk", data="", headers={"content-type": "text/plain"})
+        assert r.status_code == 415
+        monkeypatch.setattr(server, "bulk_max_queries", 1)
+        r = await client.post(
+            "/dns-query-bulk",
+            data='{"name": "a.example"}\n{"name": "b.example"}\n',
+            headers={"content-type": DOH_BULK_JSON_CONTENT_TYPE},
+        )
+        assert r.status_code == 413
+
+    @pytest.mark.asyncio
+    async def test_bulk_rate_limit(self, resolver_stub, monkeypatch):
+        from quart_doh import server
+
+        monkeypatch.setattr(server, "rate_limiter", RateLimiter(0.001, 2))
+        client = app.test_client()
+        body = "".join('{"name": "host%d.example.com"}\n' % i for i in range(3))
+        r = await client.post(
+            "/dns-query-bulk", data=body, headers={"content-type": DOH_BULK_JSON_CONTENT_TYPE}
+        )
+        # over the burst, never allowed
+        assert r.status_code == 413
+        body = "".join('{"name": "host%d.example.com"}\n' % i for i in range(2))
+        statuses = []
+        for _ in range(2):
+            r = await client.post(
+                "/dns-query-bulk", data=body, headers={"content-type": DOH_BULK_JSON_CONTENT_TYPE}
+            )
+            statuses.append(r.status_code)
+        assert statuses == [200, 429]
+
+    @pytest.mark.asyncio
+    async def test_get_json(self, resolver_stub):
+        client = app.test_client()
+        r = await client.get(
+            "/dns-query",
+            query_string={"name": "www.example.com", "type": "A"},
+            headers={"accept": DOH_JSON_CONTENT_TYPE},
+        )
+        assert r.status_code == 200
+        assert r.headers["content-type"] == DOH_JSON_CONTENT_TYPE
+        result = json.loads(await r.get_data())
+        assert result["Status"] == 0
+        assert result["Question"] == [{"name": "www.example.com.", "type": 1}]
+        assert result["Answer"] == [
+            {"name": "www.example.com.", "type": 1, "TTL": 300, "data": "127.0.0.1"}
+        ]
+
+    @pytest.mark.asyncio
+    async def test_invalid(self, resolver_stub, dns_query_answer):
+        client = app.test_client()
+        r = await client.post(
+            "/dns-query", data=dns_query_answer[:-3], headers={"content-type": DOH_CONTENT_TYPE}
+        )
+        assert r.status_code == 400
+        r = await client.get("/dns-query", query_string={"dns": "AAAB&"})
+        assert r.status_code == 400
+        r = await client.get("/dns-query")
+        assert r.status_code == 400
+
+    @pytest.mark.asyncio
+    async def test_debug(self, resolver_stub, dns_query_answer, caplog):
+        caplog.set_level(logging.DEBUG, logger="doh-server")
+        client = app.test_client()
+        r = await client.post(
+            "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+        )
+        assert r.status_code == 200
+        assert "[DNS] www.example.com. 300 IN A 127.0.0.1" in caplog.text
+
+    @pytest.mark.asyncio
+    async def test_metrics(self, resolver_stub, dns_query_answer, monkeypatch):
+        from quart_doh import server
+
+        monkeypatch.setattr(server, "response_cache", ResponseCache())
+        client = app.test_client()
+        for _ in range(2):
+            await client.post(
+                "/dns-query", data=dns_query_answer, headers={"content-type": DOH_CONTENT_TYPE}
+            )
+        r = await client.get("/metrics")
+        assert r.status_code == 200
+        assert r.headers["content-type"].startswith("text/plain; version=0.0.4")
+        body = (await r.get_data()).decode()
+        assert 'doh_requests_total{method="POST",format="wire"}' in body
+        assert 'doh_queries_total{qtype="A"}' in body
+        assert server.rdtype_name(65280) == "other"
+        assert 'doh_responses_total{rcode="NOERROR"}' in body
+        assert 'doh_upstream_seconds_count{upstream="127.0.0.1",result="success"}' in body
+        assert "doh_cache_hits_total 1\n" in body
+        assert "doh_cache_misses_total 1\n" in body
+        assert "doh_upstream_inflight 0\n" in body
+
+
+class TestCreateConfig:
+    def test_single_worker(self):
+        config = create_config(parse_args(["--port", "8443", "--host", "127.0.0.1"]))
+        assert config.bind == ["127.0.0.1:8443"]
+        assert config.workers == 1
+
+    def test_workers(self):
+        config = create_config(parse_args(["--workers", "4"]))
+        assert config.workers == 4
+
+    def test_http2_tuning(self):
+        config = create_config(
+            parse_args(
+                ["--h2-max-concurrent-streams", "500", "--keep-alive-timeout", "120"]
+                + ["--backlog", "1024", "--quic-port", "8443", "--host", "127.0.0.1"]
+            )
+        )
+        assert config.h2_max_concurrent_streams == 500
+        assert config.keep_alive_timeout == 120
+        assert config.backlog == 1024
+        assert config.quic_bind == ["127.0.0.1:8443"]
+        assert create_config(parse_args([])).quic_bind == []
+
+    @pytest.mark.skipif(shutil.which("openssl") is None, reason="openssl is required")
+    @pytest.mark.parametrize("tickets", [0, 4])
+    def test_tls_tickets(self, tmp_path, tickets):
+        cert, key = str(tmp_path / "cert.pem"), str(tmp_path / "key.pem")
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1"]
+            + ["-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+            check=True,
+            capture_output=True,
+        )
+        config = create_config(
+            parse_args(["--cert", cert, "--key", key, "--tls-tickets", str(tickets)])
+        )
+        context = config.create_ssl_context()
+        assert context.num_tickets == tickets
+        assert bool(context.options & ssl.OP_NO_TICKET) == (tickets == 0)
@@ -1,7 +1,11 @@
+import json
 from unittest.mock import Mock, MagicMock
 
 import dns
+import dns.flags
 import dns.message
+import dns.rcode
+import dns.rrset
 import pytest
 from quart import Response, Request
 from quart.datastructures import Headers
@@ -17,6 +21,11 @@ from quart_doh.utils import (
     get_name_and_type_from_dns_question,
     create_http_wire_response,
     create_http_json_response,
+    etag_matches,
+    json_dumps,
+    make_wire_query,
+    message_to_json,
+    split_wire_messages,
 )
 
 
@@ -38,6 +47,16 @@ def query_with_answer():
     return qr
 
 
+@pytest.fixture
+def response_with_answer(query):
+    qr = dns.message.make_response(query)
+    qr.flags |= dns.flags.RA
+    qr.answer.append(
+        dns.rrset.from_text("example.com.", 300, "IN", "A", "127.0.0.1", "127.0.0.2")
+    )
+    return qr
+
+
 @pytest.fixture
 def request_mock():
     mock = Mock()
@@ -88,7 +107,7 @@ class TestUtils:
         request_mock.is_secure = True
         assert get_scheme(request_mock) == "https"
 
-    def test_set_headers(self, query, query_with_answer, request_mock):
+    def test_set_headers(self, query, query_with_answer, response_with_answer, request_mock):
         response = Response("", status=200)
 
         response = set_headers(request_mock, response, query)
@@ -104,6 +123,58 @@ class TestUtils:
         assert response.headers["scheme"] == "http"
         assert response.headers["cache-control"] == "max-age=1"
 
+        response = Response("", status=200)
+        response = set_headers(request_mock, response, response_with_answer.to_wire())
+        assert response.headers["cache-control"] == "max-age=300"
+
+    def test_set_headers_age(self, response_with_answer, request_mock):
+        response = Response("", status=200)
+        response = set_headers(
+            request_mock, response, response_with_answer.to_wire(), age=10, pseudo_headers=False
+        )
+        assert response.headers["cache-control"] == "max-age=310"
+        assert response.headers["age"] == "10"
+        assert "authority" not in response.headers
+        assert "method" not in response.headers
+
+    def test_message_to_json(self, query, response_with_answer):
+        assert message_to_json(response_with_answer) == {
+            "Status": 0,
+            "TC": False,
+            "RD": True,
+            "RA": True,
+            "AD": False,
+            "CD": False,
+            "Question": [{"name": "example.com.", "type": 1}],
+            "Answer": [
+                {"name": "example.com.", "type": 1, "TTL": 300, "data": "127.0.0.1"},
+                {"name": "example.com.", "type": 1, "TTL": 300, "data": "127.0.0.2"},
+            ],
+        }
+        qr = dns.message.make_response(query)
+        qr.set_rcode(dns.rcode.NXDOMAIN)
+        qr.authority.append(
+            dns.rrset.from_text("com.", 900, "IN", "SOA", "a. b. 1 1800 900 604800 30")
+        )
+        result = message_to_json(qr)
+        assert result["Status"] == 3
+        assert "Answer" not in result
+        assert result["Authority"] == [
+            {"name": "com.", "type": 6, "TTL": 900, "data": "a. b. 1 1800 900 604800 30"}
+        ]
+
+    def test_json_dumps(self):
+        assert json_dumps({"Status": 0, "TC": False}) == b'{"Status":0,"TC":false}'
+
+    def test_etag_matches(self):
+        assert etag_matches('W/"0a"', 'W/"0a"')
+        assert etag_matches('W/"0a"', '"0a"')
+        assert etag_matches('W/"0a"', '"01" , W/"0a"')
+        assert etag_matches('W/"0a"', "*")
+        assert not etag_matches('W/"0a"', '"0"')
+        assert not etag_matches('W/"0a"', '"0a0"')
+        assert not etag_matches('W/"0a"', "")
+
     def test_extract_from_params(self):
         param = "AAABAAABAAAAAAABAnMwAndwA2NvbQAAHAABAAApEAAAAAAAAAgACAAEAAEAAA"
         assert str(extract_from_params(param).question[0]) == "s0.wp.com. IN AAAA"
@@ -205,7 +276,7 @@ class TestUtils:
         assert await result.get_data() == b"query_with_answer"
 
     @pytest.mark.asyncio
-    async def test_create_http_json_response(self, query_with_answer):
+    async def test_create_http_json_response(self, response_with_answer):
         headers = Headers()
         headers.add(key="accept", value=DOH_CONTENT_TYPE)
         request = Request(
@@ -218,14 +289,32 @@ class TestUtils:
             root_path="",
             send_push_promise=None,
         )
-        result = await create_http_json_response(request, query_with_answer)
+        result = await create_http_json_response(request, response_with_answer)
         assert result.status_code == 200
-        assert result.headers.get("content-length") == "2"
         assert result.headers.get("content-type") == DOH_JSON_CONTENT_TYPE
-        assert await result.get_data() == b"{}"
+        assert result.headers.get("cache-control") == "max-age=300"
+        assert json.loads(await result.get_data()) == message_to_json(response_with_answer)
 
         result = await create_http_json_response(request, "query_with_answer")
         assert result.status_code == 200
         assert result.headers.get("content-length") == "32"
         assert result.headers.get("content-type") == "text/html; charset=utf-8"
         assert await result.get_data() == b'{"content": "query_with_answer"}'
+
+    def test_make_wire_query(self):
+        query = dns.message.from_wire(make_wire_query("www.example.com", "MX"))
+        assert query.question[0].to_text() == "www.example.com. IN MX"
+        query = dns.message.from_wire(make_wire_query("bücher.example", 28))
+        assert query.question[0].name.to_text() == "xn--bcher-kva.example."
+        with pytest.raises(ValueError):
+            make_wire_query("www.example.com", "NOTATYPE")
+        with pytest.raises(ValueError):
+            make_wire_query(None)
+
+    def test_split_wire_messages(self):
+        assert split_wire_messages(b"\x00\x02ab\x00\x01c") == [b"ab", b"c"]
+        assert split_wire_messages(b"") == []
+        with pytest.raises(ValueError):
+            split_wire_messages(b"\x00\x03ab")
+        with pytest.raises(ValueError):
+            split_wire_messages(b"\x00\x01a\x00")
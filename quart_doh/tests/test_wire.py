@@ -0,0 +1,167 @@
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rrset
+import pytest
+
+from quart_doh import wire
+from quart_doh.cache import cache_key, get_ttl
+
+
+@pytest.fixture
+def query():
+    q = dns.message.make_query(qname="Example.com", rdtype="AAAA", want_dnssec=True)
+    q.id = 4321
+    return q
+
+
+@pytest.fixture
+def response(query):
+    r = dns.message.make_response(query)
+    r.answer.append(dns.rrset.from_text("example.com.", 300, "IN", "AAAA", "::1"))
+    r.answer.append(dns.rrset.from_text("example.com.", 60, "IN", "A", "127.0.0.1"))
+    r.authority.append(dns.rrset.from_text("example.com.", 900, "IN", "NS", "ns.example.com."))
+    r.additional.append(dns.rrset.from_text("ns.example.com.", 30, "IN", "A", "127.0.0.2"))
+    return r
+
+
+@pytest.fixture
+def negative_response(query):
+    r = dns.message.make_response(query)
+    r.set_rcode(dns.rcode.NXDOMAIN)
+    r.authority.append(
+        dns.rrset.from_text("com.", 900, "IN", "SOA", "a. b. 1 1800 900 604800 30")
+    )
+    return r
+
+
+class TestWire:
+    def test_parse_question(self, query, response):
+        query_id, question, offset = wire.parse_question(query.to_wire())
+        assert query_id == 4321
+        assert question == (b"\x07example\x03com\x00", 28, 1)
+        assert offset == 12 + 13 + 4
+        assert wire.parse_question(response.to_wire())[:2] == (query_id, question)
+
+    def test_parse_question_invalid(self, query):
+        data = query.to_wire()
+        with pytest.raises(ValueError):
+            wire.parse_question(data[:20])
+        with pytest.raises(ValueError):
+            wire.parse_question(b"")
+        with pytest.raises(ValueError):
+            wire.parse_question(data[:4] + b"\x00\x02" + data[6:])
+        with pytest.raises(ValueError):
+            wire.parse_question(data[:12] + b"\xc0\x0c" + data[25:])
+
+    def test_query_key(self, query):
+        assert wire.query_key(query.to_wire()) == cache_key(query)
+        q = dns.message.make_query(qname="example.com", rdtype="A")
+        assert wire.query_key(q.to_wire()) == cache_key(q)
+        q.use_edns(False)
+        assert wire.query_key(q.to_wire()) == cache_key(q)
+        q.flags |= dns.flags.CD
+        assert wire.query_key(q.to_wire()) == cache_key(q)
+        with pytest.raises(ValueError):
+            wire.query_key(query.to_wire()[:-2])
+
+    def test_copy_question(self, query, response):
+        data = response.to_wire()
+        mixed = wire.set_id(query.to_wire(), 99).replace(b"\x07Example", b"\x07eXaMpLe")
+        copied = dns.message.from_wire(wire.copy_question(data, mixed))
+        assert copied.id == 99
+        assert copied.question[0].name.to_text() == "eXaMpLe.com."
+        assert copied.answer == response.answer
+        empty = dns.message.make_response(query)
+        empty.question = []
+        assert wire.copy_question(empty.to_wire(), mixed) == wire.set_id(empty.to_wire(), 99)
+
+    def test_id(self, query):
+        data = query.to_wire()
+        assert wire.get_id(data) == 4321
+        assert wire.get_id(wire.set_id(data, 0)) == 0
+        assert dns.message.from_wire(wire.set_id(data, 7)).id == 7
+
+    def test_is_truncated(self, response):
+        assert not wire.is_truncated(response.to_wire())
+        response.flags |= dns.flags.TC
+        assert wire.is_truncated(response.to_wire())
+
+    def test_get_ttl(self, query, response, negative_response):
+        assert wire.get_ttl(response.to_wire()) == get_ttl(response) == 60
+        assert wire.get_ttl(query.to_wire()) is None
+        assert wire.get_ttl(negative_response.to_wire()) == get_ttl(negative_response) == 30
+        negative_response.set_rcode(dns.rcode.NOERROR)
+        assert wire.get_ttl(negative_response.to_wire()) == 30
+        negative_response.set_rcode(dns.rcode.SERVFAIL)
+        assert wire.get_ttl(negative_response.to_wire()) == 5
+        assert wire.get_ttl(negative_response.to_wire(), servfail_ttl=1) == 1
+        negative_response.set_rcode(dns.rcode.REFUSED)
+        assert wire.get_ttl(negative_response.to_wire()) is None
+
+    def test_decrement_ttls(self, response):
+        result = dns.message.from_wire(wire.decrement_ttls(response.to_wire(), 45))
+        assert [r.ttl for r in result.answer] == [255, 15]
+        assert result.authority[0].ttl == 855
+        assert result.additional[0].ttl == 0
+        assert result.edns == 0
+
+    def test_set_ttls(self, response):
+        result = dns.message.from_wire(wire.set_ttls(response.to_wire(), 30))
+        assert [r.ttl for r in result.answer] == [30, 30]
+        assert result.authority[0].ttl == 30
+        assert result.edns == 0
+
+    def test_etag(self, response, negative_response):
+        data = response.to_wire()
+        assert wire.etag(data).startswith('W/"')
+        assert wire.etag(data) == wire.etag(wire.decrement_ttls(wire.set_id(data, 1234), 10))
+        assert wire.etag(data) != wire.etag(negative_response.to_wire())
+
+    def test_decrement_negative_ttl(self, negative_response):
+        result = dns.message.from_wire(wire.decrement_ttls(negative_response.to_wire(), 10))
+        assert result.authority[0].ttl == min(negative_response.authority[0].ttl, 30) - 10
+
+    def test_encode_name(self):
+        assert wire.encode_name("WWW.Example.com.") == b"\x03www\x07example\x03com\x00"
+        assert wire.encode_name("a..b") is None
+        assert wire.encode_name("é.com") is None
+        assert wire.encode_name("") is None
+
+    def test_make_query(self):
+        data = wire.make_query(wire.encode_name("www.example.com"), 28)
+        message = dns.message.from_wire(data)
+        assert message.id == 0
+        assert message.flags == dns.flags.RD
+        assert message.question[0].to_text() == "www.example.com. IN AAAA"
+        assert wire.query_key(data) == (b"\x03www\x07example\x03com\x00", 28, 1, False, False, False)
+
+    def test_ecs(self, query):
+        subnet = bytes.fromhex("00011800010203")
+        data = query.to_wire()
+        assert wire.get_ecs(data) is None
+        with_ecs = wire.add_ecs(data, subnet)
+        message = dns.message.from_wire(with_ecs)
+        assert message.options[0].to_text() == "ECS 1.2.3.0/24 scope/0"
+        assert wire.get_ecs(with_ecs) == subnet
+        assert wire.query_key(with_ecs) == wire.query_key(data)
+        popped, option = wire.pop_ecs(with_ecs)
+        assert option == subnet
+        assert dns.message.from_wire(popped).options == ()
+        assert wire.pop_ecs(data) == (data, None)
+        assert wire.has_edns(data)
+        plain = wire.make_query(wire.encode_name("example.com"), 1)
+        assert not wire.has_edns(plain)
+        assert wire.remove_opt(plain) == plain
+        assert wire.remove_opt(wire.add_ecs(plain, subnet)) == plain
+
+    def test_ecs_existing_opt(self):
+        query = dns.message.make_query("example.com", "A", use_edns=0, want_dnssec=True, payload=4096)
+        data = query.to_wire()
+        subnet = bytes.fromhex("00023800") + bytes(7)
+        with_ecs = wire.add_ecs(data, subnet)
+        message = dns.message.from_wire(with_ecs)
+        assert message.payload == 4096
+        assert message.ednsflags & dns.flags.DO
+        assert message.options[0].to_text() == "ECS ::/56 scope/0"
+        assert wire.pop_ecs(with_ecs) == (data, subnet)
@@ -1,50 +1,54 @@
-import base64
+import atexit
 import binascii
+import functools
 import json
 import logging
-import os
-from string import Template
+import logging.handlers
+import queue
+import struct
+from typing import List, Optional, Union
 
 import dns
+import dns.exception
+import dns.flags
+import dns.name
+import dns.rdatatype
 from dns import message
 from dns.message import Message
 from quart import Response, Request
 
+from quart_doh import wire
+from quart_doh.cache import get_ttl
+from quart_doh.codec import doh_b64_decode, doh_b64_encode, json_dumps  # noqa: F401
 from quart_doh.constants import (
     AUTHORITY,
+    DOH_BULK_CONTENT_TYPE,
+    DOH_BULK_JSON_CONTENT_TYPE,
     DOH_CONTENT_TYPE,
     DOH_JSON_CONTENT_TYPE,
     DOH_DNS_PARAM,
     DOH_DNS_JSON_PARAM,
 )
 
-dir_path = os.path.dirname(os.path.realpath(__file__))
-
-
-def doh_b64_decode(s: str) -> bytes:
-    """Base 64 urlsafe decode, add padding as needed.
-    :param s: input base64 encoded string with potentially missing padding.
-    :return: decodes bytes
-    """
-    padding = "=" * (-len(s) % 4)
-    return base64.urlsafe_b64decode(s + padding)
-
-
-def doh_b64_encode(s: bytes) -> str:
-    """Base 64 urlsafe encode and remove padding.
-    :param s: input bytes-like object to be encoded.
-    :return: urlsafe base 64 encoded string.
-    """
-    return base64.urlsafe_b64encode(s).decode("utf-8").rstrip("=")
+_log_listener = None
 
 
 def configure_logger(name: str = "", level: str = "DEBUG"):
-    """
+    """The records are formatted by the caller and written to stderr by a
+    background thread, the event loop never blocks on stderr.
     :param name: (optional) name of the logger, default: ''.
     :param level: (optional) level of logging, default: DEBUG.
     :return: a logger instance.
     """
-    logging.basicConfig(format="%(asctime)s: %(levelname)8s: %(message)s")
+    global _log_listener
+    if _log_listener is None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s: %(levelname)8s: %(message)s"))
+        log_queue = queue.SimpleQueue()
+        _log_listener = logging.handlers.QueueListener(log_queue, handler)
+        _log_listener.start()
+        atexit.register(_log_listener.stop)
+        logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
     logger = logging.getLogger(name)
     level_name = level.upper()
     level = getattr(logging, level_name, None)
@@ -62,14 +66,30 @@ def get_scheme(request: Request) -> str:
 
 
 def set_headers(
-    request: Request, response: Response, query_response: Message
+    request: Request,
+    response: Response,
+    query_response: Union[Message, bytes],
+    age: int = 0,
+    pseudo_headers: bool = True,
 ) -> Response:
-    response.headers["authority"] = AUTHORITY
-    response.headers["method"] = request.method
-    response.headers["scheme"] = get_scheme(request)
-    if query_response.answer:
-        ttl = min(r.ttl for r in query_response.answer)
-        response.headers["cache-control"] = "max-age=" + str(ttl)
+    """
+    :param query_response: the DNS response, TTLs decremented by age.
+    :param age: (optional) seconds since the DNS response was cached, the Age
+        header, max-age is then the TTL of the cached response.
+    :param pseudo_headers: (optional) add the authority, method and scheme headers.
+    """
+    if pseudo_headers:
+        response.headers["authority"] = AUTHORITY
+        response.headers["method"] = request.method
+        response.headers["scheme"] = get_scheme(request)
+    if isinstance(query_response, bytes):
+        ttl = wire.get_ttl(query_response)
+    else:
+        ttl = get_ttl(query_response)
+    if ttl is not None:
+        response.headers["cache-control"] = "max-age=" + str(ttl + age)
+        if age:
+            response.headers["age"] = str(age)
     return response
 
 
@@ -79,7 +99,7 @@ def extract_from_params(dns_request: str) -> Message:
         dns_request_decoded = doh_b64_decode(dns_request)
         return dns.message.from_wire(dns_request_decoded)
     except binascii.Error as ex:
-        logger.info(str(ex))
+        logger.info("%s", ex)
     except Exception as ex:
         logger.exception(ex)
 
@@ -103,49 +123,189 @@ async def get_name_and_type_from_dns_question(request: Request) -> Message:
             try:
                 return message.from_wire(body)
             except Exception as ex:
-                logger.info(str(ex))
+                logger.info("%s", ex)
+
+
+async def get_dns_wire(request: Request) -> Optional[bytes]:
+    """
+    :param request: a GET request with the dns parameter or a POST request.
+    :return: the DNS query in wire format, not parsed.
+    """
+    logger = logging.getLogger("doh-server")
+    if request.method == "GET":
+        dns_request = request.args.get(DOH_DNS_PARAM, None)
+        if dns_request:
+            try:
+                return doh_b64_decode(dns_request)
+            except binascii.Error as ex:
+                logger.info("%s", ex)
+    elif request.method == "POST" and request.content_type == DOH_CONTENT_TYPE:
+        return await request.get_data()
+
+
+LENGTH = struct.Struct("!H")
+
+
+@functools.lru_cache(maxsize=256)
+def _rdtype(rdtype: Union[str, int]) -> int:
+    if isinstance(rdtype, int):
+        return rdtype
+    return dns.rdatatype.from_text(rdtype)
+
+
+def make_wire_query(name: str, rdtype: Union[str, int] = "A") -> bytes:
+    """Encode a query without building a Message.
+    :param name: the queried name, IDNA encoded if not ASCII.
+    :param rdtype: (optional) the queried type, as text or number.
+    :return: the DNS query in wire format, with an ID of 0.
+    """
+    try:
+        qname = wire.encode_name(name)
+        if qname is None:
+            qname = dns.name.from_text(name).to_wire()
+        return wire.make_query(qname, _rdtype(rdtype))
+    except (dns.exception.DNSException, TypeError, AttributeError, struct.error):
+        raise ValueError("Invalid query {!r} {!r}".format(name, rdtype))
+
+
+def split_wire_messages(body: bytes) -> List[bytes]:
+    """
+    :param body: DNS messages, each preceded by its length on two bytes (RFC 1035 4.2.2).
+    :return: the DNS messages.
+    """
+    messages = []
+    offset = 0
+    while offset < len(body):
+        if offset + LENGTH.size > len(body):
+            raise ValueError("Truncated message length")
+        (length,) = LENGTH.unpack_from(body, offset)
+        offset += LENGTH.size
+        if offset + length > len(body):
+            raise ValueError("Truncated message")
+        messages.append(body[offset:offset + length])
+        offset += length
+    return messages
+
+
+async def get_bulk_queries(request: Request) -> Optional[List[bytes]]:
+    """
+    :param request: a POST request, JSON lines of {"name": ..., "type": ...}
+        or length-prefixed DNS messages.
+    :return: the DNS queries in wire format, None if the content type is not supported.
+    :raise ValueError: a query is not valid.
+    """
+    if request.content_type == DOH_BULK_JSON_CONTENT_TYPE:
+        queries = []
+        for line in (await request.get_data()).splitlines():
+            if not line.strip():
+                continue
+            try:
+                question = json.loads(line)
+                name = question[DOH_DNS_JSON_PARAM["name"]]
+                rdtype = question.get(DOH_DNS_JSON_PARAM["type"], "A")
+            except (ValueError, TypeError, KeyError, AttributeError):
+                raise ValueError("Invalid JSON line {!r}".format(line[:100]))
+            queries.append(make_wire_query(name, rdtype))
+        return queries
+    elif request.content_type == DOH_BULK_CONTENT_TYPE:
+        queries = split_wire_messages(await request.get_data())
+        for query in queries:
+            wire.query_key(query)
+        return queries
+
+
+def etag_matches(entity_tag: str, if_none_match: str) -> bool:
+    """
+    :param entity_tag: the ETag of the response.
+    :param if_none_match: the If-None-Match header of the request.
+    :return: whether a tag in the header is ``*`` or weakly matches the ETag.
+    """
+    opaque_tag = entity_tag[2:] if entity_tag.startswith("W/") else entity_tag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if (tag[2:] if tag.startswith("W/") else tag) == opaque_tag:
+            return True
+    return False
 
 
 async def create_http_wire_response(
-    request: Request, query_response: Message
+    request: Request,
+    query_response: Union[Message, bytes],
+    age: int = 0,
+    pseudo_headers: bool = True,
 ) -> Response:
+    """
+    :param age: (optional) seconds since the DNS response was cached.
+    :param pseudo_headers: (optional) add the authority, method and scheme headers.
+    :return: the DNS response with an ID of 0. A GET request gets an ETag,
+        and a 304 response when it matches its If-None-Match header.
+    """
     logger = logging.getLogger("doh-server")
-    logger.debug(
-        "[HTTP] " + str(request.method) + " " + str(request.headers.get("Accept"))
-    )
+    logger.debug("[HTTP] %s %s", request.method, request.headers.get("Accept"))
     if isinstance(query_response, Message):
         query_response.id = 0
-        body = query_response.to_wire()
-        response = Response(body, content_type=DOH_CONTENT_TYPE)
-        response.headers["content-length"] = str(len(body))
-        return set_headers(request, response, query_response)
+        query_response = query_response.to_wire()
+    if isinstance(query_response, bytes):
+        body = wire.set_id(query_response, 0)
+        entity_tag = wire.etag(body) if request.method == "GET" else None
+        if entity_tag is not None and etag_matches(
+            entity_tag, request.headers.get("If-None-Match", "")
+        ):
+            response = Response("", status=304)
+        else:
+            response = Response(body, content_type=DOH_CONTENT_TYPE)
+            response.headers["content-length"] = str(len(body))
+        if entity_tag is not None:
+            response.headers["etag"] = entity_tag
+        return set_headers(request, response, body, age, pseudo_headers)
     else:
         return Response(query_response)
 
 
+def message_to_json(message: Message) -> dict:
+    """Google/Cloudflare JSON format of a DNS response.
+    :param message: a DNS response.
+    :return: a dict ready to be serialized.
+    """
+    flags = message.flags
+    result = {
+        "Status": message.rcode(),
+        "TC": bool(flags & dns.flags.TC),
+        "RD": bool(flags & dns.flags.RD),
+        "RA": bool(flags & dns.flags.RA),
+        "AD": bool(flags & dns.flags.AD),
+        "CD": bool(flags & dns.flags.CD),
+        "Question": [
+            {"name": question.name.to_text(), "type": question.rdtype}
+            for question in message.question
+        ],
+    }
+    for section, rrsets in (("Answer", message.answer), ("Authority", message.authority)):
+        if rrsets:
+            result[section] = [
+                {
+                    "name": rrset.name.to_text(),
+                    "type": rrset.rdtype,
+                    "TTL": rrset.ttl,
+                    "data": rdata.to_text(),
+                }
+                for rrset in rrsets
+                for rdata in rrset
+            ]
+    return result
+
+
 async def create_http_json_response(
-    request: Request, query_response: Message
+    request: Request, query_response: Message, age: int = 0, pseudo_headers: bool = True
 ) -> Response:
     logger = logging.getLogger("doh-server")
-    logger.debug(
-        "[HTTP] " + str(request.method) + " " + str(request.headers.get("Accept"))
-    )
-    response = Response(json.dumps({}), content_type=DOH_JSON_CONTENT_TYPE)
+    logger.debug("[HTTP] %s %s", request.method, request.headers.get("Accept"))
     if isinstance(query_response, Message):
-        if query_response.answer:
-            answers = []
-            for answer in query_response.answer:
-                answers.append(str(answer))
-            with open(dir_path + "/template.json", "r", encoding="UTF-8") as template:
-                s = Template(template.read())
-                response.content = json.dumps(
-                    s.substitute(
-                        data=json.dumps(answers),
-                        name=query_response.answer[0].name,
-                        type=query_response.answer[0].rdtype,
-                        ttl=query_response.answer[0].ttl,
-                    )
-                )
-        return set_headers(request, response, query_response)
+        response = Response(
+            json_dumps(message_to_json(query_response)), content_type=DOH_JSON_CONTENT_TYPE
+        )
+        return set_headers(request, response, query_response, age, pseudo_headers)
     else:
         return Response(json.dumps({"content": str(query_response)}), status=200)
@@ -0,0 +1,340 @@
+"""Minimal parsing of DNS messages in wire format (RFC 1035), for the hot
+path where building a full dnspython Message is not needed.
+Malformed or unsupported messages raise ValueError.
+"""
+import struct
+import zlib
+from typing import Iterator, Optional, Tuple
+
+from quart_doh.constants import SERVFAIL_TTL
+
+HEADER = struct.Struct("!HHHHHH")
+QUESTION = struct.Struct("!HH")
+RR = struct.Struct("!HHIH")
+ID = struct.Struct("!H")
+RDLENGTH = struct.Struct("!H")
+TTL = struct.Struct("!I")
+OPTION = struct.Struct("!HH")
+ECS = struct.Struct("!HBB")
+
+FLAG_QR = 0x8000
+OPCODE_MASK = 0x7800
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_CD = 0x0010
+FLAG_DO = 0x8000
+RCODE_MASK = 0x000F
+NOERROR = 0
+SERVFAIL = 2
+NXDOMAIN = 3
+TYPE_SOA = 6
+TYPE_OPT = 41
+ANSWER = 1
+AUTHORITY = 2
+ADDITIONAL = 3
+OPTION_ECS = 8
+EDNS_PAYLOAD = 1232
+
+
+def _read_name(wire: bytes, offset: int) -> Tuple[bytes, int]:
+    """Read an uncompressed name, as found in the question of a query.
+    :return: the lowercase name in wire format and the offset after it.
+    """
+    start = offset
+    while True:
+        length = wire[offset]
+        if length == 0:
+            offset += 1
+            return wire[start:offset].lower(), offset
+        if length & 0xC0:
+            raise ValueError("Compressed name in question")
+        offset += length + 1
+
+
+def _skip_name(wire: bytes, offset: int) -> int:
+    while True:
+        length = wire[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        if length & 0xC0:
+            raise ValueError("Invalid label type")
+        offset += length + 1
+
+
+def encode_name(text: str) -> Optional[bytes]:
+    """
+    :param text: a domain name, absolute or not.
+    :return: the lowercase name in wire format, None if not a valid ASCII name.
+    """
+    labels = text.strip().strip(".").lower().split(".")
+    try:
+        encoded = b"".join(bytes((len(label),)) + label.encode("ascii") for label in labels if label)
+    except (UnicodeEncodeError, ValueError):
+        return None
+    if not encoded or len(encoded) > 254 or any(not label or len(label) > 63 for label in labels):
+        return None
+    return encoded + b"\x00"
+
+
+def make_query(name: bytes, qtype: int, query_id: int = 0, qclass: int = 1) -> bytes:
+    """Same as dns.message.make_query, recursion desired and without EDNS.
+    :param name: the name in wire format, from encode_name.
+    """
+    return HEADER.pack(query_id, FLAG_RD, 1, 0, 0, 0) + name + QUESTION.pack(qtype, qclass)
+
+
+def parse_question(wire: bytes) -> Tuple[int, tuple, int]:
+    """
+    :param wire: a DNS message in wire format.
+    :return: the message ID, the question (qname, qtype, qclass) and the
+        offset after the question.
+    """
+    try:
+        query_id, _, qdcount, _, _, _ = HEADER.unpack_from(wire)
+        if qdcount != 1:
+            raise ValueError("Expected exactly one question")
+        name, offset = _read_name(wire, HEADER.size)
+        qtype, qclass = QUESTION.unpack_from(wire, offset)
+    except (IndexError, struct.error):
+        raise ValueError("Truncated message")
+    return query_id, (name, qtype, qclass), offset + QUESTION.size
+
+
+def _records(wire: bytes) -> Iterator[Tuple[int, int, int, int, int]]:
+    """
+    :return: an iterator of (section, type, TTL offset, rdata offset, rdata length)
+        of the resource records.
+    """
+    _, _, offset = parse_question(wire)
+    _, _, _, ancount, nscount, arcount = HEADER.unpack_from(wire)
+    sections = [ANSWER] * ancount + [AUTHORITY] * nscount + [ADDITIONAL] * arcount
+    try:
+        for section in sections:
+            offset = _skip_name(wire, offset)
+            rtype, _, _, rdlength = RR.unpack_from(wire, offset)
+            rdata = offset + RR.size
+            if rdata + rdlength > len(wire):
+                raise ValueError("Truncated message")
+            yield section, rtype, offset + 4, rdata, rdlength
+            offset = rdata + rdlength
+    except (IndexError, struct.error):
+        raise ValueError("Truncated message")
+
+
+def query_key(wire: bytes) -> tuple:
+    """Same key as quart_doh.cache.cache_key, without building a Message.
+    :param wire: a DNS query in wire format.
+    :return: (qname, qtype, qclass, EDNS, DO bit, CD bit).
+    """
+    _, question, _ = parse_question(wire)
+    edns = do = False
+    for section, rtype, ttl_offset, _, _ in _records(wire):
+        if section == ADDITIONAL and rtype == TYPE_OPT:
+            edns = True
+            do = bool(TTL.unpack_from(wire, ttl_offset)[0] & FLAG_DO)
+    cd = bool(HEADER.unpack_from(wire)[1] & FLAG_CD)
+    return question + (edns, do, cd)
+
+
+def _opt_record(wire: bytes) -> Optional[Tuple[int, int]]:
+    """
+    :return: the offset and length of the rdata of the OPT record, None without EDNS.
+    """
+    for section, rtype, _, rdata, rdlength in _records(wire):
+        if section == ADDITIONAL and rtype == TYPE_OPT:
+            return rdata, rdlength
+    return None
+
+
+def _options(wire: bytes, rdata: int, rdlength: int) -> Iterator[Tuple[int, int, int]]:
+    """
+    :return: an iterator of (code, offset, length) of the EDNS options.
+    """
+    offset = rdata
+    end = rdata + rdlength
+    while offset + OPTION.size <= end:
+        code, length = OPTION.unpack_from(wire, offset)
+        if offset + OPTION.size + length > end:
+            raise ValueError("Truncated EDNS option")
+        yield code, offset, OPTION.size + length
+        offset += OPTION.size + length
+
+
+def has_edns(wire: bytes) -> bool:
+    return _opt_record(wire) is not None
+
+
+def remove_opt(wire: bytes) -> bytes:
+    """
+    :param wire: a DNS response in wire format.
+    :return: the response without its OPT record, as answered to a query
+        without EDNS (RFC 6891).
+    """
+    for section, rtype, ttl_offset, rdata, rdlength in _records(wire):
+        if section == ADDITIONAL and rtype == TYPE_OPT:
+            # the owner of an OPT record is the root, a zero byte before its type and class
+            start = ttl_offset - QUESTION.size - 1
+            if wire[start] != 0:
+                raise ValueError("Invalid OPT record owner")
+            query_id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(wire)
+            header = HEADER.pack(query_id, flags, qdcount, ancount, nscount, arcount - 1)
+            return header + wire[HEADER.size:start] + wire[rdata + rdlength:]
+    return wire
+
+
+def get_ecs(wire: bytes) -> Optional[bytes]:
+    """
+    :param wire: a DNS message in wire format.
+    :return: the data of its EDNS Client Subnet option (RFC 7871): family,
+        source prefix length, scope prefix length and address, or None.
+    """
+    opt = _opt_record(wire)
+    if opt is None:
+        return None
+    for code, offset, length in _options(wire, *opt):
+        if code == OPTION_ECS:
+            return wire[offset + OPTION.size:offset + length]
+    return None
+
+
+def add_ecs(wire: bytes, subnet: bytes) -> bytes:
+    """
+    :param wire: a DNS query in wire format, without EDNS Client Subnet option.
+    :param subnet: the data of the EDNS Client Subnet option.
+    :return: the query with the option, and an OPT record if it had none.
+    """
+    option = OPTION.pack(OPTION_ECS, len(subnet)) + subnet
+    opt = _opt_record(wire)
+    if opt is None:
+        query_id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(wire)
+        header = HEADER.pack(query_id, flags, qdcount, ancount, nscount, arcount + 1)
+        record = b"\x00" + RR.pack(TYPE_OPT, EDNS_PAYLOAD, 0, len(option)) + option
+        return header + wire[HEADER.size:] + record
+    rdata, rdlength = opt
+    patched = bytearray(wire[:rdata + rdlength])
+    RDLENGTH.pack_into(patched, rdata - RDLENGTH.size, rdlength + len(option))
+    return bytes(patched) + option + wire[rdata + rdlength:]
+
+
+def pop_ecs(wire: bytes) -> Tuple[bytes, Optional[bytes]]:
+    """
+    :param wire: a DNS message in wire format.
+    :return: the message without its EDNS Client Subnet option, and the data
+        of the option or None.
+    """
+    opt = _opt_record(wire)
+    if opt is None:
+        return wire, None
+    rdata, rdlength = opt
+    for code, offset, length in _options(wire, rdata, rdlength):
+        if code == OPTION_ECS:
+            patched = bytearray(wire[:offset])
+            RDLENGTH.pack_into(patched, rdata - RDLENGTH.size, rdlength - length)
+            return bytes(patched) + wire[offset + length:], wire[offset + OPTION.size:offset + length]
+    return wire, None
+
+
+def get_id(wire: bytes) -> int:
+    return ID.unpack_from(wire)[0]
+
+
+def set_id(wire: bytes, query_id: int) -> bytes:
+    return ID.pack(query_id) + wire[2:]
+
+
+def error_header(wire: bytes, rcode: int) -> bytes:
+    """
+    :param wire: a DNS query in wire format, possibly malformed past its header.
+    :param rcode: the rcode of the response.
+    :return: a DNS response in wire format with the ID, opcode and RD flag of
+        the query, this rcode and no record, not even the question.
+    """
+    query_id, flags = struct.unpack_from("!HH", wire)
+    flags = FLAG_QR | (flags & (OPCODE_MASK | FLAG_RD)) | rcode
+    return HEADER.pack(query_id, flags, 0, 0, 0, 0)
+
+
+def copy_question(wire: bytes, query: bytes) -> bytes:
+    """
+    :param wire: a DNS response in wire format, to the same question as the query.
+    :param query: the DNS query in wire format.
+    :return: the response with the ID of the query and its question as sent,
+        in the same case, for the clients randomizing the case of the names.
+    """
+    _, _, end = parse_question(query)
+    question = wire[HEADER.size:end]
+    if wire[4:6] != query[4:6] or question.lower() != query[HEADER.size:end].lower():
+        return query[:2] + wire[2:]
+    return query[:2] + wire[2:HEADER.size] + query[HEADER.size:end] + wire[end:]
+
+
+def get_rcode(wire: bytes) -> int:
+    return HEADER.unpack_from(wire)[1] & RCODE_MASK
+
+
+def is_truncated(wire: bytes) -> bool:
+    return bool(HEADER.unpack_from(wire)[1] & FLAG_TC)
+
+
+def get_ttl(wire: bytes, servfail_ttl: int = SERVFAIL_TTL) -> Optional[int]:
+    """Same as quart_doh.cache.get_ttl, without building a Message."""
+    rcode = get_rcode(wire)
+    if rcode == SERVFAIL:
+        return servfail_ttl
+    if rcode not in (NOERROR, NXDOMAIN):
+        return None
+    ttl = None
+    negative_ttl = None
+    for section, rtype, ttl_offset, rdata, rdlength in _records(wire):
+        if section == ANSWER:
+            record_ttl = TTL.unpack_from(wire, ttl_offset)[0]
+            if ttl is None or record_ttl < ttl:
+                ttl = record_ttl
+        elif section == AUTHORITY and rtype == TYPE_SOA and negative_ttl is None:
+            minimum = TTL.unpack_from(wire, rdata + rdlength - 4)[0]
+            negative_ttl = min(TTL.unpack_from(wire, ttl_offset)[0], minimum)
+    if ttl is not None:
+        return ttl
+    return negative_ttl
+
+
+def decrement_ttls(wire: bytes, age: int) -> bytes:
+    """
+    :param wire: a DNS response in wire format.
+    :param age: seconds to remove from every TTL, OPT records excepted. The TTL
+        of a SOA record of the authority section is first capped to its MINIMUM
+        field, the negative caching TTL (RFC 2308).
+    :return: the patched response.
+    """
+    patched = bytearray(wire)
+    for section, rtype, ttl_offset, rdata, rdlength in _records(wire):
+        if rtype != TYPE_OPT:
+            ttl = TTL.unpack_from(wire, ttl_offset)[0]
+            if section == AUTHORITY and rtype == TYPE_SOA:
+                ttl = min(ttl, TTL.unpack_from(wire, rdata + rdlength - 4)[0])
+            TTL.pack_into(patched, ttl_offset, max(ttl - age, 0))
+    return bytes(patched)
+
+
+def set_ttls(wire: bytes, ttl: int) -> bytes:
+    """
+    :param wire: a DNS response in wire format.
+    :param ttl: the TTL of every record, OPT records excepted.
+    :return: the patched response.
+    """
+    patched = bytearray(wire)
+    for _, rtype, ttl_offset, _, _ in _records(wire):
+        if rtype != TYPE_OPT:
+            TTL.pack_into(patched, ttl_offset, ttl)
+    return bytes(patched)
+
+
+def etag(wire: bytes) -> str:
+    """
+    :param wire: a DNS response in wire format.
+    :return: a weak HTTP entity tag of the response, the same whatever its ID
+        and TTLs, so that it holds as the TTLs are decremented.
+    """
+    return 'W/"%08x"' % zlib.crc32(set_ttls(wire, 0)[2:])
@@ -36,6 +36,11 @@ setup(
         'dnspython >= 1.16.0',
         'requests >= 2.22.0',
     ],
+    extras_require={
+        'json': ['orjson'],
+        'async': ['httpx[http2]'],
+        'h3': ['hypercorn[h3]'],
+    },
     tests_require=[
         'pytest',
     ],
@@ -43,6 +48,8 @@ setup(
         'console_scripts': [
             'doh-client = quart_doh.client:main',
             'doh-server = quart_doh.server:main',
+            'doh-benchmark = quart_doh.benchmark:main',
+            'doh-blocklist = quart_doh.policy:main',
         ],
     },
 )